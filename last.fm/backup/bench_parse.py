@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of lastexport.py XML page parsing.
+Compares the original path (get_pageinfo() + get_tracklist() + parse_track())
+with the single-pass parse_page() on synthetic pages of 200 tracks.
+Usage: bench_parse.py [-n PAGES] [-t scrobbles|loved]
+"""
+
+import sys, time
+from optparse import OptionParser
+from xml.sax.saxutils import escape, quoteattr
+
+import lastexport
+
+TRACK = {
+    'recenttracks': u'<track><artist mbid=%s>%s</artist><name>%s</name>'
+                    u'<mbid>%s</mbid><album mbid=%s>%s</album>'
+                    u'<date uts="%d">01 Jan 2017, 00:00</date></track>',
+    'lovedtracks': u'<track><name>%s</name><mbid>%s</mbid>'
+                   u'<date uts="%d">01 Jan 2017, 00:00</date>'
+                   u'<artist><name>%s</name><mbid>%s</mbid></artist></track>',
+}
+
+def make_page(page, tracktype, ntracks=200):
+    """Generate a XML page of ntracks tracks, including an invalid character."""
+    tracks = []
+    for i in range(ntracks):
+        ts = 1500000000 - (page * ntracks + i) * 60
+        artist = escape(u'Artist ř %d' % (i % 37))
+        track = escape(u'Track & co. %d' % i)
+        mbid = u'%08d-0000-0000-0000-000000000000' % i
+        if tracktype == 'recenttracks':
+            tracks.append(TRACK[tracktype] % (quoteattr(mbid), artist, track, mbid,
+                                              quoteattr(mbid), escape(u'Album %d' % (i % 13)), ts))
+        else:
+            tracks.append(TRACK[tracktype] % (track, mbid, ts, artist, mbid))
+    tracks[0] = tracks[0].replace(u'Track', u'Track￾')
+    return (u'<?xml version="1.0" encoding="utf-8"?>\n<lfm status="ok">'
+            u'<%s user="bench" page="%d" perPage="%d" totalPages="1000" total="%d">%s</%s></lfm>'
+            % (tracktype, page, ntracks, ntracks * 1000, u''.join(tracks), tracktype)).encode('utf-8')
+
+def old_path(response, tracktype):
+    totalpages = lastexport.get_pageinfo(response, tracktype)
+    tracks = []
+    for trackelement in lastexport.get_tracklist(response):
+        if not trackelement.attrib.has_key("nowplaying") or not trackelement.attrib["nowplaying"]:
+            tracks.append(lastexport.parse_track(trackelement))
+    return totalpages, tracks
+
+def new_path(response, tracktype):
+    return lastexport.parse_page(response, tracktype)
+
+def bench(func, pages, tracktype):
+    start = time.time()
+    ntracks = 0
+    for response in pages:
+        ntracks += len(func(response, tracktype)[1])
+    return ntracks / (time.time() - start)
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--pages", dest="pages", type="int", default=200,
+                      help="Number of pages to parse, default is 200")
+    parser.add_option("-t", "--type", dest="infotype", default="scrobbles",
+                      help="Page type, scrobbles|loved, default is scrobbles")
+    options, args = parser.parse_args()
+    tracktype = "lovedtracks" if options.infotype == "loved" else "recenttracks"
+
+    pages = [make_page(i, tracktype) for i in range(options.pages)]
+    if old_path(pages[0], tracktype) != new_path(pages[0], tracktype):
+        sys.exit("Parsers disagree, aborting")
+
+    old = bench(old_path, pages, tracktype)
+    new = bench(new_path, pages, tracktype)
+    print "%s, %d pages" % (tracktype, options.pages)
+    print "get_pageinfo + get_tracklist + parse_track: %10.0f tracks/s" % old
+    print "parse_page:                                 %10.0f tracks/s" % new
+    print "speedup: %.2fx" % (new / old)
@@ -17,15 +17,35 @@
 
 """
 Script for exporting tracks through audioscrobbler API.
-Usage: lastexport.py -u USER [-o OUTFILE] [-p STARTPAGE] [-s SERVER]
+Usage: lastexport.py -u USER [-o OUTFILE] [-p STARTPAGE] [-s SERVER] [-r] [-f TIMESTAMP] [-P POOLSIZE]
 """
 
-import urllib, sys, time, re, requests
-import xml.etree.ElementTree as ET
+import urllib, sys, time, re, os, hashlib, random, requests
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 from optparse import OptionParser
 
 __version__ = '0.0.5'
 
+# The same client setup as http_session() in lastfm-backup/lastfm-backup.py,
+# kept as a copy since that script needs Python 3 and this one runs on Python 2
+_session = None
+
+def get_session(pool_size=1):
+    """Get a HTTP session which keeps the connection to the server alive."""
+    global _session
+    if _session is None:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        _session = requests.Session()
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                 'Connection': 'keep-alive'})
+    return _session
+
 def get_options(parser):
     """ Define command line options."""
     parser.add_option("-u", "--user", dest="username", default=None,
@@ -38,10 +58,18 @@ def get_options(parser):
                       help="Server to fetch track info from, default is last.fm")
     parser.add_option("-t", "--type", dest="infotype", default="scrobbles",
                       help="Type of information to export, scrobbles|loved|banned, default is scrobbles")
+    parser.add_option("-r", "--resume", dest="resume", action="store_true", default=False,
+                      help="Resume an interrupted export into an existing output file")
+    parser.add_option("-f", "--from", dest="fromts", type="int", default=None,
+                      help="Export only tracks scrobbled since given UNIX timestamp (scrobbles only)")
+    parser.add_option("-P", "--pool-size", dest="pool_size", type="int", default=1,
+                      help="Number of connections to the server kept alive, default is 1")
     options, args = parser.parse_args()
 
     if not options.username:
         sys.exit("User name not specified, see --help")
+    if options.pool_size < 1:
+        sys.exit("Pool size must be at least 1")
 
     if options.infotype == "loved":
         infotype = "lovedtracks"
@@ -50,9 +78,14 @@ def get_options(parser):
     else:
         infotype = "recenttracks"
 
-    return options.username, options.outfile, options.startpage, options.server, infotype
+    return (options.username, options.outfile, options.startpage, options.server, infotype,
+            options.resume, options.fromts, options.pool_size)
+
+def backoff(attempt, base, cap=180):
+    """Exponential backoff with full jitter (the same policy as lastfm-backup.py)."""
+    return random.uniform(base / 2.0, min(cap, base * 2 ** attempt))
 
-def connect_server(server, username, startpage, sleep_func=time.sleep, tracktype='recenttracks'):
+def connect_server(server, username, startpage, sleep_func=time.sleep, tracktype='recenttracks', fromts=None):
     """ Connect to server and get a XML page."""
     if server == "libre.fm":
         baseurl = 'http://alpha.libre.fm/2.0/?'
@@ -79,38 +112,79 @@ def connect_server(server, username, startpage, sleep_func=time.sleep, tracktype
                     page=startpage,
                     limit=200)
 
+    if fromts and tracktype == 'recenttracks':
+        urlvars['from'] = fromts
+
     url = baseurl + urllib.urlencode(urlvars)
-    for interval in (1, 5, 10, 60, 120, 180):
+    # Connection errors are retried sooner than server errors (HTTP 5xx or
+    # 429 rate limit exceeded)
+    for attempt in range(6):
         try:
-            f = requests.get(url, timeout=5)
-            if f.status_code != requests.codes.ok:
-                raise Exception("Timeout reached")
-            else:
+            f = get_session().get(url, timeout=5)
+        except requests.exceptions.RequestException, e:
+            interval = backoff(attempt, 1)
+        else:
+            if f.status_code == requests.codes.ok:
                 break
-        except Exception, e:
-            last_exc = e
-            print "Exception occured, retrying in %ds: %s" % (interval, e)
-            sleep_func(interval)
+            e = Exception("HTTP status %d" % f.status_code)
+            f.close()
+            interval = backoff(attempt, 5)
+        last_exc = e
+        print "Exception occured, retrying in %.1fs: %s" % (interval, e)
+        sleep_func(interval)
     else:
         print "Failed to open page %s" % urlvars['page']
         raise last_exc
 
-    response = f.text.encode("utf-8")
+    response = f.content
     f.close()
 
-    #bad hack to fix bad xml
-    response = re.sub('\xef\xbf\xbe', '', response)
     return response
 
+#bad hack to fix bad xml (U+FFFE is not a valid XML character)
+BAD_XML_CHAR = '\xef\xbf\xbe'
+
+def fix_xml(response):
+    """Remove invalid characters from a whole XML page."""
+    return re.sub(BAD_XML_CHAR, '', response)
+
+class XMLFixer(object):
+    """File-like object reading an XML page with invalid characters removed.
+
+    The page is fixed chunk by chunk as the parser reads it. Chunks always end
+    on a character boundary, so an invalid character is never split between
+    two of them.
+    """
+    def __init__(self, response):
+        self.response = response
+        self.pos = 0
+
+    def read(self, size=-1):
+        chunk = ''
+        # an empty chunk means EOF, so don't return one made only of
+        # invalid characters
+        while not chunk and self.pos < len(self.response):
+            end = len(self.response)
+            if size >= 0:
+                end = min(end, self.pos + max(size, 1))
+                # skip UTF-8 continuation bytes
+                while end < len(self.response) and 0x80 <= ord(self.response[end]) < 0xc0:
+                    end += 1
+            chunk = self.response[self.pos:end]
+            self.pos = end
+            if BAD_XML_CHAR in chunk:
+                chunk = chunk.replace(BAD_XML_CHAR, '')
+        return chunk
+
 def get_pageinfo(response, tracktype='recenttracks'):
     """Check how many pages of tracks the user have."""
-    xmlpage = ET.fromstring(response)
+    xmlpage = ET.fromstring(fix_xml(response))
     totalpages = xmlpage.find(tracktype).attrib.get('totalPages')
     return int(totalpages)
 
 def get_tracklist(response):
     """Read XML page and get a list of tracks and their info."""
-    xmlpage = ET.fromstring(response)
+    xmlpage = ET.fromstring(fix_xml(response))
     tracklist = xmlpage.getiterator('track')
     return tracklist
 
@@ -144,15 +218,81 @@ def parse_track(trackelement):
 
     return output
 
+def parse_track_fast(trackelement):
+    """Same as parse_track(), but walks the track's children only once."""
+    date = trackname = trackmbid = artistname = artistmbid = None
+    albumname = albummbid = ''
+    for child in trackelement:
+        tag = child.tag
+        if tag == 'artist':
+            if len(child):
+                #artist info is nested in loved/banned tracks xml
+                artistname = child.findtext('name')
+                artistmbid = child.findtext('mbid')
+            else:
+                artistname = child.text
+                artistmbid = child.get('mbid')
+        elif tag == 'name':
+            trackname = child.text
+        elif tag == 'mbid':
+            trackmbid = child.text
+        elif tag == 'album':
+            albumname = child.text
+            albummbid = child.get('mbid')
+        elif tag == 'date':
+            date = child.get('uts')
+
+    return [v if v is not None else '' for v in
+            (date, trackname, artistname, albumname, trackmbid, artistmbid, albummbid)]
+
+def parse_page(response, tracktype='recenttracks'):
+    """Get the page count and a list of track info from a XML page in a single pass.
+
+    Tracks are parsed as soon as the parser reaches their end and cleared
+    right after, the currently playing track is skipped.
+    """
+    totalpages = None
+    tracks = []
+    for event, element in ET.iterparse(XMLFixer(response)):
+        tag = element.tag
+        if tag == 'track':
+            if not element.get('nowplaying'):
+                tracks.append(parse_track_fast(element))
+            element.clear()
+        elif tag == tracktype:
+            totalpages = int(element.get('totalPages'))
+
+    if totalpages is None:
+        raise Exception("Invalid page, no %s element found" % tracktype)
+    return totalpages, tracks
+
+def format_track(fields):
+    """Format track info as a line of the output file"""
+    return ("\t".join(fields) + "\n").encode('utf-8')
+
 def write_tracks(tracks, outfileobj):
     """Write tracks to an open file"""
     for fields in tracks:
-        outfileobj.write(("\t".join(fields) + "\n").encode('utf-8'))
-
-def get_tracks(server, username, startpage=1, sleep_func=time.sleep, tracktype='recenttracks'):
+        outfileobj.write(format_track(fields))
+
+def read_track_index(outfile):
+    """Read an existing output file, return hashes of its lines and the line count."""
+    index = set()
+    count = 0
+    with open(outfile, 'rb') as outfileobj:
+        for line in outfileobj:
+            index.add(hashlib.md5(line).digest())
+            count += 1
+    return index, count
+
+def get_tracks(server, username, startpage=1, sleep_func=time.sleep, tracktype='recenttracks', fromts=None):
     page = startpage
-    response = connect_server(server, username, page, sleep_func, tracktype)
-    totalpages = get_pageinfo(response, tracktype)
+    response = connect_server(server, username, page, sleep_func, tracktype, fromts)
+    totalpages, tracks = parse_page(response, tracktype)
+
+    # nothing new since the given timestamp
+    if fromts and totalpages == 0:
+        return
 
     if startpage > totalpages:
         raise ValueError("First page (%s) is higher than total pages (%s)." % (startpage, totalpages))
@@ -160,47 +300,69 @@ def get_tracks(server, username, startpage=1, sleep_func=time.sleep, tracktype='
     while page <= totalpages:
         #Skip connect if on first page, already have that one stored.
         if page > startpage:
-            response = connect_server(server, username, page, sleep_func, tracktype)
-
-        tracklist = get_tracklist(response)
-
-        tracks = []
-        for trackelement in tracklist:
-            # do not export the currently playing track.
-            if not trackelement.attrib.has_key("nowplaying") or not trackelement.attrib["nowplaying"]:
-                tracks.append(parse_track(trackelement))
+            response = connect_server(server, username, page, sleep_func, tracktype, fromts)
+            tracks = parse_page(response, tracktype)[1]
 
         yield page, totalpages, tracks
 
         page += 1
 
-def main(server, username, startpage, outfile, infotype='recenttracks'):
-    tracklist = []
+def main(server, username, startpage, outfile, infotype='recenttracks', resume=False, fromts=None,
+         pool_size=1):
+    # the session is created with the first call
+    get_session(pool_size)
+
+    # Hashes of already written tracks, so duplicates (tracks shifted to the
+    # next page by new scrobbles during the export) are found in O(1)
+    index = set()
+    ntracks = 0
+    # Tracks of the first page which were already written (loved/banned
+    # tracks aren't deduplicated by the index)
+    skip = 0
+    if resume and os.path.exists(outfile):
+        index, ntracks = read_track_index(outfile)
+        # Pages only move forward as new tracks are scrobbled, so the page
+        # with the last written track is a safe place to continue from
+        startpage = max(startpage, (ntracks - 1) // 200 + 1)
+        skip = max(ntracks - (startpage - 1) * 200, 0)
+        print "Resuming from page %s (%d tracks in %s)" % (startpage, ntracks, outfile)
+
     page = startpage  # for case of exception
     totalpages = -1  # ditto
-    n = 0
-    try:
-        for page, totalpages, tracks in get_tracks(server, username, startpage, tracktype=infotype):
-            if infotype == "recenttracks":
-                for track in tracks:
-                    if int(track[0]) == 0 or track not in tracklist:
-                        tracklist.append(track)
-            else:
-                # timestamp is not unique for loved/banned tracks
-                tracklist += tracks
-
-            print "Got page %s of %s [total tracks: %d]" % (page, totalpages, len(tracklist))
-    except ValueError, e:
-        print e
-        exit(e)
-    except Exception:
-        raise
-    finally:
-        with open(outfile, 'a') as outfileobj:
-            write_tracks(tracklist, outfileobj)
+    with open(outfile, 'a') as outfileobj:
+        try:
+            for page, totalpages, tracks in get_tracks(server, username, startpage, tracktype=infotype,
+                                                       fromts=fromts):
+                if infotype == "recenttracks":
+                    newtracks = []
+                    for track in tracks:
+                        if int(track[0]) != 0:
+                            digest = hashlib.md5(format_track(track)).digest()
+                            if digest in index:
+                                continue
+                            index.add(digest)
+                        newtracks.append(track)
+                else:
+                    # timestamp is not unique for loved/banned tracks
+                    newtracks = tracks[skip:]
+                    skip = 0
+
+                # Write every page right away, so nothing is lost when
+                # the export is interrupted
+                write_tracks(newtracks, outfileobj)
+                outfileobj.flush()
+                ntracks += len(newtracks)
+
+                print "Got page %s of %s [total tracks: %d]" % (page, totalpages, ntracks)
+        except ValueError, e:
+            print e
+            exit(e)
+        except Exception:
+            raise
+        finally:
             print "Wrote page %s-%s of %s to file %s" % (startpage, page, totalpages, outfile)
 
 if __name__ == "__main__":
     parser = OptionParser()
-    username, outfile, startpage, server, infotype = get_options(parser)
-    main(server, username, startpage, outfile, infotype)
+    username, outfile, startpage, server, infotype, resume, fromts, pool_size = get_options(parser)
+    main(server, username, startpage, outfile, infotype, resume, fromts, pool_size)
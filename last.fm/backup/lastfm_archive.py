@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Columnar archives of Last.fm backups, for fast offline analytics.
+Usage: lastfm_archive.py pack -o ARCHIVE FILE|-
+       lastfm_archive.py pack -o ARCHIVE --db DBFILE -u USER [-t TYPE]
+       lastfm_archive.py info ARCHIVE
+
+pack compacts a lastexport.py backup (plain or gzipped, - for stdin, e.g. from
+lastfm_segments.sh materialize) or a data table of a lastfm-backup.py
+database into a single archive file. info prints what's inside.
+
+An archive stores the scrobbles sorted by timestamp, column by column:
+timestamps as an array of 32-bit integers, artists, tracks and albums as
+arrays of 16 or 32-bit indices into per-column dictionaries of distinct
+values (name and MBID, tracks and albums also with their artist). The reader
+(Archive) memory-maps the file and exposes the columns as memoryviews, so
+nothing is parsed or copied when an archive is opened and scans touch only
+the columns they need.
+
+File layout (little-endian, all sections aligned to 8 bytes):
+    header:   magic "LFMARCH1", section count (uint32), row count (uint32)
+    sections: name (16 bytes), item format (struct/array code, 4 bytes),
+              offset (uint64), length in bytes (uint64)
+    data of the sections
+Strings of a dictionary are stored as a UTF-8 blob ("<kind>.names") with an
+array of 32-bit offsets ("<kind>.names.idx", one more than there are strings).
+"""
+
+import argparse
+import array
+import bisect
+import collections
+import gzip
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import sys
+from datetime import datetime
+
+MAGIC = b"LFMARCH1"
+HEADER = struct.Struct("<8sII")
+SECTION = struct.Struct("<16s4sQQ")
+KINDS = ("artist", "track", "album")
+
+# lastexport.py columns
+TS, TRACK, ARTIST, ALBUM, TRACK_MBID, ARTIST_MBID, ALBUM_MBID = range(7)
+
+def read_backup_rows(path):
+    """Read (timestamp, artist, artist_mbid, track, track_mbid, album,
+    album_mbid) rows of a lastexport.py backup, skipping broken lines."""
+    if path == "-":
+        f = open(sys.stdin.fileno(), encoding="utf-8", errors="replace",
+                 newline="\n", closefd=False)
+    elif path.endswith(".gz"):
+        f = gzip.open(path, "rt", encoding="utf-8", errors="replace", newline="\n")
+    else:
+        f = open(path, encoding="utf-8", errors="replace", newline="\n")
+    with f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            fields += [""] * (7 - len(fields))
+            try:
+                ts = int(fields[TS])
+            except ValueError:
+                continue
+            yield (ts, fields[ARTIST], fields[ARTIST_MBID], fields[TRACK],
+                   fields[TRACK_MBID], fields[ALBUM], fields[ALBUM_MBID])
+
+def read_db_rows(dbname, username, scrobble_type):
+    """Read rows of a data table of a lastfm-backup.py database."""
+    db = sqlite3.connect("file:%s?mode=ro" % os.path.abspath(dbname), uri=True)
+    try:
+        cur = db.execute("SELECT timestamp, artist, artist_mbid, track, "
+                         "track_mbid, album, album_mbid FROM %s_%s"
+                         % (username, scrobble_type))
+        for row in cur:
+            yield tuple(v if v is not None else "" for v in row)
+    finally:
+        db.close()
+
+def string_sections(kind, strings):
+    """Encode a list of strings as a blob and an array of offsets."""
+    blob = bytearray()
+    offsets = array.array("I", [0])
+    for s in strings:
+        blob += s.encode("utf-8", "surrogatepass")
+        offsets.append(len(blob))
+    return [(kind, "B", bytes(blob)), (kind + ".idx", "I", offsets)]
+
+def write_archive(path, rows):
+    """Write rows (see read_backup_rows()) into an archive, return the row count."""
+    rows = sorted(rows, key=lambda row: row[0])
+    dicts = {kind: {} for kind in KINDS}
+    columns = {kind: array.array("I") for kind in KINDS}
+    timestamps = array.array("I")
+    for ts, artist, artist_mbid, track, track_mbid, album, album_mbid in rows:
+        timestamps.append(max(ts, 0))
+        a = dicts["artist"].setdefault((artist, artist_mbid), len(dicts["artist"]))
+        columns["artist"].append(a)
+        columns["track"].append(dicts["track"].setdefault((a, track, track_mbid),
+                                                          len(dicts["track"])))
+        columns["album"].append(dicts["album"].setdefault((a, album, album_mbid),
+                                                          len(dicts["album"])))
+
+    sections = [("ts", "I", timestamps)]
+    for kind in KINDS:
+        keys = list(dicts[kind])
+        column = columns[kind]
+        if len(keys) <= 0x10000:
+            column = array.array("H", column)
+        sections.append((kind, column.typecode, column))
+        if kind != "artist":
+            sections.append((kind + ".artist", "I", array.array("I", (k[0] for k in keys))))
+        sections += string_sections(kind + ".names", [k[-2] for k in keys])
+        sections += string_sections(kind + ".mbids", [k[-1] for k in keys])
+
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    data = []
+    for name, fmt, content in sections:
+        content = content.tobytes() if isinstance(content, array.array) else content
+        offset += -offset % 8
+        table.append(SECTION.pack(name.encode(), fmt.encode(), offset, len(content)))
+        data.append(content)
+        offset += len(content)
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(sections), len(rows)))
+        f.write(b"".join(table))
+        for content in data:
+            f.write(b"\0" * (-f.tell() % 8))
+            f.write(content)
+    os.replace(tmp, path)
+    return len(rows)
+
+class Strings(object):
+    """Strings of a dictionary, decoded only when accessed."""
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], "utf-8",
+                   "surrogatepass")
+
+class Dictionary(object):
+    """Distinct values of an archive column (artists, tracks or albums)."""
+    def __init__(self, archive, kind):
+        self.names = Strings(archive.section(kind + ".names"),
+                             archive.section(kind + ".names.idx"))
+        self.mbids = Strings(archive.section(kind + ".mbids"),
+                             archive.section(kind + ".mbids.idx"))
+        # indices into the artist dictionary
+        self.artists = archive.section(kind + ".artist") if kind != "artist" else None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return self.names[i]
+
+class Archive(object):
+    """Memory-mapped columnar archive (see the module documentation).
+
+    timestamps, artists, tracks and albums are memoryviews of the columns,
+    artist_names, track_names and album_names their dictionaries. Row
+    ranges of a time window are found by bisection, since the rows are
+    sorted by timestamp.
+    """
+    def __init__(self, path):
+        if sys.byteorder != "little":
+            raise ValueError("Archives can be read only on little-endian machines")
+        self.path = path
+        self.views = []
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, self.rows = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            self.map.close()
+            raise ValueError("%s is not an archive" % path)
+        self.table = {}
+        for i in range(count):
+            name, fmt, offset, length = SECTION.unpack_from(
+                self.map, HEADER.size + i * SECTION.size)
+            self.table[name.rstrip(b"\0").decode()] = (fmt.rstrip(b"\0").decode(),
+                                                       offset, length)
+
+        self.timestamps = self.section("ts")
+        self.artists, self.tracks, self.albums = [self.section(k) for k in KINDS]
+        self.artist_names, self.track_names, self.album_names = \
+            [Dictionary(self, k) for k in KINDS]
+
+    def section(self, name):
+        """Get a section as a memoryview of its items."""
+        fmt, offset, length = self.table[name]
+        view = memoryview(self.map)[offset:offset + length]
+        self.views.append(view)
+        if fmt != "B":
+            view = view.cast(fmt)
+            self.views.append(view)
+        return view
+
+    def __len__(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # the map can't be closed while there are views of it
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.map.close()
+
+    def range(self, ts_from=None, ts_to=None):
+        """Get rows [lo, hi) of a time window (both ends inclusive)."""
+        lo = 0 if ts_from is None else bisect.bisect_left(self.timestamps, ts_from)
+        hi = self.rows if ts_to is None else bisect.bisect_right(self.timestamps, ts_to)
+        return lo, max(lo, hi)
+
+    def counts(self, column, lo=0, hi=None):
+        """Count plays of each dictionary index of a column within rows [lo, hi)."""
+        return collections.Counter(column[lo:hi])
+
+    def scrobble(self, i):
+        """Get a row as (timestamp, artist, track, album)."""
+        return (self.timestamps[i], self.artist_names[self.artists[i]],
+                self.track_names[self.tracks[i]], self.album_names[self.albums[i]])
+
+    def fields(self, i):
+        """Get a row as a list of lastexport.py columns."""
+        a, t, b = self.artists[i], self.tracks[i], self.albums[i]
+        return [str(self.timestamps[i]), self.track_names[t], self.artist_names[a],
+                self.album_names[b], self.track_names.mbids[t],
+                self.artist_names.mbids[a], self.album_names.mbids[b]]
+
+def print_info(path):
+    with Archive(path) as archive:
+        print("%s: %d scrobbles, %d bytes" % (path, len(archive), os.path.getsize(path)))
+        if len(archive):
+            lo = bisect.bisect_right(archive.timestamps, 0)
+            if lo:
+                print("\twithout timestamp: %d" % lo)
+            if lo < len(archive):
+                print("\tfrom: %s\n\tto: %s" % (
+                    datetime.fromtimestamp(archive.timestamps[lo]),
+                    datetime.fromtimestamp(archive.timestamps[-1])))
+        for kind in KINDS:
+            print("\t%ss: %d" % (kind, len(getattr(archive, kind + "_names"))))
+        for name, (fmt, offset, length) in sorted(archive.table.items(),
+                                                  key=lambda s: s[1][1]):
+            print("\t\t%-16s %-2s %10d bytes" % (name, fmt, length))
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar archives of "
+                                     "Last.fm backups")
+    commands = parser.add_subparsers(dest="command", required=True)
+    pack = commands.add_parser("pack", help="write an archive")
+    pack.add_argument("source", metavar="FILE", nargs="?",
+                      help="lastexport.py backup (- for stdin)")
+    pack.add_argument("-o", "--output", required=True, metavar="ARCHIVE",
+                      help="archive file to write (replaced atomically)")
+    pack.add_argument("--db", default=None, metavar="DBFILE",
+                      help="read a lastfm-backup.py database instead")
+    pack.add_argument("-u", "--user", default=None,
+                      help="user of the database to archive")
+    pack.add_argument("-t", "--type", default="recenttracks",
+                      choices=("recenttracks", "lovedtracks"),
+                      help="scrobble type of the database to archive "
+                           "(default: recenttracks)")
+    info = commands.add_parser("info", help="describe an archive")
+    info.add_argument("archive", metavar="ARCHIVE")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        print_info(args.archive)
+        return
+
+    if args.db:
+        if not args.user or not re.match("^[a-zA-Z][a-zA-Z0-9\\-_]+$", args.user):
+            sys.exit("Valid user name must be specified with --db")
+        rows = read_db_rows(args.db, args.user, args.type)
+    elif args.source:
+        rows = read_backup_rows(args.source)
+    else:
+        sys.exit("Backup file or --db must be specified")
+    count = write_archive(args.output, rows)
+    print("Wrote %d scrobbles to %s (%d bytes)" % (count, args.output,
+                                                  os.path.getsize(args.output)))
+
+if __name__ == "__main__":
+    main()
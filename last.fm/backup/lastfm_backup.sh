@@ -1,11 +1,27 @@
 #!/usr/bin/bash
 
+# Environment:
+#   USERS     users to back up
+#   TYPES     backup types (default: "scrobbles loved")
+#   SEGMENTS  if set to 1, every run appends only new tracks as a compressed
+#             segment (see lastfm_segments.sh) instead of writing a full copy
+#             of the user's history
+#   ARCHIVE   if set to 1, the latest backup of every user and type is also
+#             compacted into a columnar archive (see lastfm_archive.py), which
+#             lastfm_stats.py reads instead of the backup
+
 if [[ ! -v USERS ]]; then
     USERS=""
 fi
 if [[ ! -v TYPES ]]; then
     TYPES="scrobbles loved"
 fi
+if [[ ! -v SEGMENTS ]]; then
+    SEGMENTS=0
+fi
+if [[ ! -v ARCHIVE ]]; then
+    ARCHIVE=0
+fi
 if [[ -z $1 ]]; then
     echo "Root directory must be specified"
     exit 1
@@ -17,6 +33,56 @@ RC=0
 
 trap "exit 1" SIGINT SIGTERM
 
+# Append new tracks of given user and type to its segment directory
+# The sanity check uses the track counts from the segment manifest, so no
+# backup file needs to be read again.
+function backup_segment() {
+    u="$1"
+    t="$2"
+    SEGDIR="$DATADIR/$u/${u}_${t}.segments"
+    mkdir -p "$SEGDIR"
+    LASTTS="$("$ROOTDIR/lastfm_segments.sh" last-ts "$SEGDIR")"
+    OLDCOUNT="$("$ROOTDIR/lastfm_segments.sh" count "$SEGDIR")"
+    DOWNLOAD="$SEGDIR/.download"
+    rm -f "$DOWNLOAD"
+    echo "Processing user $u (type: $t, destination: $SEGDIR, since: $LASTTS)"
+    SECONDS=0
+    python2.7 "$ROOTDIR/lastexport.py" -u "$u" -o "$DOWNLOAD" -t $t -f "$LASTTS"
+    DLRC=$?
+    echo "Download finished in $SECONDS seconds"
+    if [[ $DLRC -ne 0 || ! -f $DOWNLOAD ]]; then
+        rm -f "$DOWNLOAD"
+        return 1
+    fi
+    "$ROOTDIR/lastfm_segments.sh" append "$SEGDIR" "$DOWNLOAD"
+    APPENDRC=$?
+    rm -f "$DOWNLOAD"
+    if [[ $APPENDRC -ne 0 ]]; then
+        return 1
+    fi
+
+    NEWCOUNT="$("$ROOTDIR/lastfm_segments.sh" count "$SEGDIR")"
+    if [[ $OLDCOUNT -ne 0 ]] && (( $NEWCOUNT - $OLDCOUNT >= $MAXDIFF )); then
+        echo "Scrobble difference between last two backups is too big"
+        echo -e "Old: $OLDCOUNT\nNew: $NEWCOUNT"
+    fi
+}
+
+# Compact the latest backup (a file or a segment directory) of given user and
+# type into its columnar archive
+function backup_archive() {
+    u="$1"
+    t="$2"
+    SOURCE="$3"
+    ARCHIVEFILE="$DATADIR/$u/${u}_${t}.archive"
+    if [[ -d $SOURCE ]]; then
+        "$ROOTDIR/lastfm_segments.sh" materialize "$SOURCE" | \
+            python3 "$ROOTDIR/lastfm_archive.py" pack -o "$ARCHIVEFILE" -
+    else
+        python3 "$ROOTDIR/lastfm_archive.py" pack -o "$ARCHIVEFILE" "$SOURCE"
+    fi
+}
+
 for u in $USERS; do
     if [[ ! -a "$DATADIR/$u" ]]; then
         mkdir -p "$DATADIR/$u"
@@ -24,13 +90,23 @@ for u in $USERS; do
 
     TYPERC=0
     for t in $TYPES; do
+        if [[ $SEGMENTS -eq 1 ]]; then
+            if ! backup_segment "$u" "$t"; then
+                TYPERC=1
+            elif [[ $ARCHIVE -eq 1 ]]; then
+                backup_archive "$u" "$t" "$DATADIR/$u/${u}_${t}.segments" || TYPERC=1
+            fi
+            continue
+        fi
+
         FILENAME="$DATADIR/$u/${u}_${t}_$(date -Iminutes)"
         LASTBACKUP="$(find "$DATADIR/$u" -type f -name "*_${t}_*" | sort -r | head -n 1)"
         echo "Processing user $u (type: $t, destination: $FILENAME)"
         SECONDS=0
         python2.7 "$ROOTDIR/lastexport.py" -u "$u" -o "$FILENAME" -t $t
+        DLRC=$?
         echo "Download finished in $SECONDS seconds"
-        if [[ $? -ne 0 || ! -s $FILENAME ]]; then
+        if [[ $DLRC -ne 0 || ! -s $FILENAME ]]; then
             TYPERC=1
         else
             NEWCOUNT="$(wc -l "$FILENAME" | awk '{ print $1; }')"
@@ -39,6 +115,9 @@ for u in $USERS; do
             else
                 OLDCOUNT="$(wc -l "$LASTBACKUP" | awk '{ print $1; }')"
             fi
+            if [[ $ARCHIVE -eq 1 ]]; then
+                backup_archive "$u" "$t" "$FILENAME" || TYPERC=1
+            fi
             if (( $NEWCOUNT - $OLDCOUNT < $MAXDIFF )); then
                 find "$DATADIR/$u/" -type f -name "*_${t}_*" -mtime +7 -exec rm -f {} \;
             else
@@ -49,7 +128,7 @@ for u in $USERS; do
         fi
     done
 
-    if [[ $TYPERC -ne 0 && $RC -ne 0 ]]; then
+    if [[ $TYPERC -ne 0 ]]; then
         RC=1
     fi
 done
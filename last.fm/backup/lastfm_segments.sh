@@ -0,0 +1,105 @@
+#!/bin/bash
+
+# Append-only segment storage of lastexport.py backups
+#
+# Instead of a full copy of the user's history, every backup run stores only
+# tracks newer than the previous run, as a new gzip-compressed segment in
+# a segment directory. Each segment is recorded in the directory's manifest,
+# one tab-separated line per segment:
+#   sequence file tracks newest_ts oldest_ts sha256 created
+#
+# Usage:
+#   lastfm_segments.sh last-ts SEGDIR       print the newest stored timestamp
+#   lastfm_segments.sh count SEGDIR         print the number of stored tracks
+#   lastfm_segments.sh append SEGDIR FILE   store tracks from a lastexport.py
+#                                           FILE newer than the newest segment
+#   lastfm_segments.sh materialize SEGDIR   print the full backup in the
+#                                           lastexport.py format (newest first)
+#   lastfm_segments.sh verify SEGDIR        check checksums of all segments
+
+set -o pipefail
+
+CMD="$1"
+SEGDIR="$2"
+MANIFEST="$SEGDIR/manifest"
+
+if [[ -z $CMD || -z $SEGDIR ]]; then
+    echo "Usage: $0 last-ts|count|append|materialize|verify SEGDIR [FILE]"
+    exit 1
+fi
+
+case "$CMD" in
+    last-ts)
+        if [[ ! -f $MANIFEST ]]; then
+            echo 0
+        else
+            awk -F '\t' 'BEGIN { m = 0; } $4 > m { m = $4; } END { print m; }' "$MANIFEST"
+        fi
+        ;;
+    count)
+        if [[ ! -f $MANIFEST ]]; then
+            echo 0
+        else
+            awk -F '\t' '{ n += $3; } END { print n + 0; }' "$MANIFEST"
+        fi
+        ;;
+    append)
+        FILE="$3"
+        if [[ ! -f $FILE ]]; then
+            echo "File '$FILE' doesn't exist"
+            exit 1
+        fi
+        mkdir -p "$SEGDIR"
+        LASTTS="$("$0" last-ts "$SEGDIR")"
+        NEW="$SEGDIR/.new"
+        # Tracks without a timestamp (0) are kept only in the first segment
+        awk -F '\t' -v ts="$LASTTS" 'ts == 0 || $1 > ts' "$FILE" > "$NEW" || exit 1
+        COUNT="$(wc -l < "$NEW")"
+        if [[ $COUNT -eq 0 ]]; then
+            echo "No new tracks since $LASTTS"
+            rm -f "$NEW"
+            exit 0
+        fi
+        SEQ=1
+        if [[ -f $MANIFEST ]]; then
+            SEQ=$(( $(wc -l < "$MANIFEST") + 1 ))
+        fi
+        CREATED="$(date -Iminutes)"
+        NAME="$(printf "%06d_%s.tsv.gz" "$SEQ" "$CREATED")"
+        NEWEST="$(awk -F '\t' 'BEGIN { m = 0; } $1 > m { m = $1; } END { print m; }' "$NEW")"
+        OLDEST="$(awk -F '\t' '$1 > 0 && (m == 0 || $1 < m) { m = $1; } END { print m + 0; }' "$NEW")"
+        gzip -c "$NEW" > "$SEGDIR/.$NAME" && mv "$SEGDIR/.$NAME" "$SEGDIR/$NAME" || exit 1
+        SUM="$(sha256sum "$SEGDIR/$NAME" | cut -d ' ' -f 1)"
+        # The manifest line is written last, a segment without one is ignored
+        printf "%d\t%s\t%d\t%s\t%s\t%s\t%s\n" "$SEQ" "$NAME" "$COUNT" \
+               "$NEWEST" "$OLDEST" "$SUM" "$CREATED" >> "$MANIFEST" || exit 1
+        rm -f "$NEW"
+        echo "Stored $COUNT new tracks in segment $NAME"
+        ;;
+    materialize)
+        if [[ ! -f $MANIFEST ]]; then
+            exit 0
+        fi
+        # Segments are newest first, newer segments have higher sequence
+        sort -t $'\t' -k1,1nr "$MANIFEST" | cut -f 2 | while read -r name; do
+            gzip -dc "$SEGDIR/$name" || exit 1
+        done
+        ;;
+    verify)
+        if [[ ! -f $MANIFEST ]]; then
+            exit 0
+        fi
+        RC=0
+        while IFS=$'\t' read -r seq name count newest oldest sum created; do
+            if [[ "$(sha256sum "$SEGDIR/$name" 2>/dev/null | cut -d ' ' -f 1)" != "$sum" ]]; then
+                echo "Segment $name is damaged (checksum mismatch)"
+                RC=1
+            fi
+        done < "$MANIFEST"
+        exit $RC
+        ;;
+    *)
+        echo "Unknown command '$CMD'"
+        exit 1
+        ;;
+esac
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Print statistics of lastexport.py backups made by lastfm_backup.sh.
+Usage: lastfm_stats.py [-j JOBS] [-c CACHE] [-y] DATADIR
+       lastfm_stats.py [-y] -u USERDIR
+
+Every user directory of DATADIR is reported from its latest scrobbles and
+loved tracks backups. Each backup file is read in a single pass, users are
+processed in parallel, and results are cached by file path, size and mtime,
+so unchanged backups are never read again.
+
+Backups stored as segments (SEGMENTS=1 in lastfm_backup.sh) are read as
+a whole, newest segment first, exactly as if they were a single backup file.
+
+Users with a columnar archive (see lastfm_archive.py, ARCHIVE=1 in
+lastfm_backup.sh) at least as new as their latest backup are reported from the
+archive instead, which needs only a few lookups in its columns and
+dictionaries. With -y, scrobbles per year are reported as well.
+"""
+
+import argparse
+import contextlib
+import gzip
+import json
+import multiprocessing
+import os
+import re
+import sys
+from datetime import datetime
+
+import lastfm_archive
+
+FORMAT = """<pre>
+[%s]
+\tscrobbles: %d
+\tloved: %d
+\tinvalid: %d
+\tscrobble info:
+\t\tfirst scrobble:
+\t\t\tdate: %s
+\t\t\tartist: %s
+\t\t\ttrack: %s
+\t\t\talbum: %s
+\t\tlast scrobble:
+\t\t\tdate: %s
+\t\t\tartist: %s
+\t\t\ttrack: %s
+\t\t\talbum: %s
+\t\tunique MBIDs:
+\t\t\ttrack: %d
+\t\t\tartist: %d
+\t\t\talbum: %d
+\tlast backups:
+\t\tscrobbles: %s
+\t\tloved: %s\n"""
+FOOTER = "\n</pre>"
+
+# lastexport.py columns
+TS, TRACK, ARTIST, ALBUM, TRACK_MBID, ARTIST_MBID, ALBUM_MBID = range(7)
+
+def shell_fields(fields):
+    r"""Split a line the same way as the old shell script did.
+
+    Its sed 's/\t\t/\t \t/g' turned an empty field into a single space
+    (but not the second one of two adjacent empty fields, the matches don't
+    overlap) and read -a then skipped the empty fields left.
+    """
+    if not fields:
+        return fields
+    return [f for f in re.sub("\t\t", "\t \t", "\t".join(fields)).split("\t") if f]
+
+def format_date(dt):
+    """Format a datetime the same way as date(1) does by default."""
+    return dt.astimezone().strftime("%a %b %e %H:%M:%S %Z %Y")
+
+def format_timestamp(ts):
+    try:
+        return format_date(datetime.fromtimestamp(int(ts)))
+    except (ValueError, OverflowError, OSError):
+        return ts
+
+def read_manifest(segdir):
+    """Read the manifest of a segment directory (see lastfm_segments.sh)."""
+    with open(os.path.join(segdir, "manifest"), encoding="utf-8") as f:
+        return [line.rstrip("\n").split("\t") for line in f if line.strip()]
+
+def backup_date(path):
+    """Get the date of a backup from its file name (see lastfm_backup.sh)."""
+    if os.path.isdir(path):
+        # creation time of the newest segment
+        stamp = read_manifest(path)[-1][6]
+    else:
+        stamp = os.path.basename(path).rsplit("_", 1)[-1]
+    try:
+        return format_date(datetime.fromisoformat(stamp))
+    except ValueError:
+        return stamp
+
+def latest_backup(userdir, infotype):
+    """Find the latest backup file of a user, or its segment directory."""
+    latest = None
+    for root, dirs, files in os.walk(userdir):
+        for name in dirs:
+            if name.endswith("_%s.segments" % infotype) and \
+                    os.path.exists(os.path.join(root, name, "manifest")):
+                return os.path.join(root, name)
+        for name in files:
+            if "_%s_" % infotype in name:
+                path = os.path.join(root, name)
+                if latest is None or path > latest:
+                    latest = path
+    return latest
+
+def backup_stat(path):
+    if os.path.isdir(path):
+        # segments are never changed, only added to the manifest
+        return os.stat(os.path.join(path, "manifest"))
+    return os.stat(path)
+
+def latest_archive(userdir, infotype, backup):
+    """Get the archive of a user, unless it's older than the latest backup."""
+    user = os.path.basename(os.path.normpath(userdir))
+    path = os.path.join(userdir, "%s_%s.archive" % (user, infotype))
+    try:
+        if os.stat(path).st_mtime_ns >= backup_stat(backup).st_mtime_ns:
+            return path
+    except OSError:
+        pass
+    return None
+
+def open_backup(path):
+    """Open a backup file, or a segment directory as a single file."""
+    if not os.path.isdir(path):
+        return open(path, encoding="utf-8", errors="replace", newline="\n")
+    return segment_lines(path)
+
+def segment_lines(segdir):
+    # newest segment first, the same order as in a single backup file
+    segments = sorted(read_manifest(segdir), key=lambda m: int(m[0]), reverse=True)
+    for m in segments:
+        with gzip.open(os.path.join(segdir, m[1]), "rt", encoding="utf-8",
+                       errors="replace", newline="\n") as f:
+            yield from f
+
+def scan_file(path, mbids=True, years=False):
+    """Read a lastexport.py backup in a single pass.
+
+    Returns a dict with the line count, the number of invalid (zero
+    timestamp) scrobbles, the first (oldest valid) and last (newest) scrobble,
+    the number of unique track/artist/album MBIDs and with years, the number
+    of scrobbles per year.
+    """
+    if path.endswith(".archive"):
+        return scan_archive(path, mbids, years)
+
+    lines = 0
+    invalid = 0
+    first = last = None
+    unique = (set(), set(), set())
+    per_year = {}
+    with contextlib.closing(open_backup(path)) as f:
+        for line in f:
+            lines += 1
+            fields = line.rstrip("\n").split("\t")
+            if lines == 1:
+                last = fields
+            if line.startswith("0"):
+                if line.startswith("0\t"):
+                    invalid += 1
+            else:
+                first = fields
+            if mbids:
+                for s, col in zip(unique, (TRACK_MBID, ARTIST_MBID, ALBUM_MBID)):
+                    s.add(fields[col] if len(fields) > col else "")
+            if years:
+                try:
+                    ts = int(fields[TS])
+                except ValueError:
+                    continue
+                if ts > 0:
+                    year = str(datetime.fromtimestamp(ts).year)
+                    per_year[year] = per_year.get(year, 0) + 1
+
+    return {
+        "lines": lines,
+        "invalid": invalid,
+        "first": first,
+        "last": last,
+        "mbids": [len(s) for s in unique],
+        "years": per_year,
+    }
+
+def scan_archive(path, mbids=True, years=False):
+    """Get the same results as scan_file() from a columnar archive.
+
+    Only the first and last rows, the dictionaries (for MBIDs) and a few
+    timestamps (for years) are read, whatever the number of scrobbles.
+    """
+    with lastfm_archive.Archive(path) as archive:
+        n = len(archive)
+        # scrobbles without a timestamp come first
+        valid = archive.range(1)[0]
+        unique = [0, 0, 0]
+        if mbids:
+            unique = [len(set(d.mbids[i] for i in range(len(d))))
+                      for d in (archive.track_names, archive.artist_names,
+                                archive.album_names)]
+        per_year = {}
+        if years and valid < n:
+            for year in range(datetime.fromtimestamp(archive.timestamps[valid]).year,
+                              datetime.fromtimestamp(archive.timestamps[-1]).year + 1):
+                lo, hi = archive.range(int(datetime(year, 1, 1).timestamp()),
+                                       int(datetime(year + 1, 1, 1).timestamp()) - 1)
+                per_year[str(year)] = hi - lo
+        return {
+            "lines": n,
+            "invalid": valid,
+            "first": archive.fields(valid) if valid < n else None,
+            "last": archive.fields(n - 1) if n else None,
+            "mbids": unique,
+            "years": per_year,
+        }
+
+def cached_scan(path, cache, mbids=True, years=False):
+    """Scan a file, unless the cache has its results for the same size and mtime."""
+    st = backup_stat(path)
+    key = [st.st_size, st.st_mtime_ns]
+    entry = cache.get(path)
+    if entry and entry["key"] == key and (entry["mbids"] is not None or not mbids) \
+            and (entry.get("years") is not None or not years):
+        return entry, False
+    entry = scan_file(path, mbids, years)
+    if not mbids:
+        entry["mbids"] = None
+    if not years:
+        entry["years"] = None
+    entry["key"] = key
+    return entry, True
+
+def get_user_stats(job):
+    """Get a report of a single user, along with updated cache entries."""
+    userdir, cache, years = job
+    user = os.path.basename(os.path.normpath(userdir))
+    f_scrobbles = latest_backup(userdir, "scrobbles")
+    f_loved = latest_backup(userdir, "loved")
+    if not f_scrobbles or not f_loved:
+        return "Incomplete data for user %s\n" % user, {}
+
+    updates = {}
+    source = latest_archive(userdir, "scrobbles", f_scrobbles) or f_scrobbles
+    scrobbles, changed = cached_scan(source, cache, years=years)
+    if changed:
+        updates[source] = scrobbles
+    source = latest_archive(userdir, "loved", f_loved) or f_loved
+    loved, changed = cached_scan(source, cache, mbids=False)
+    if changed:
+        updates[source] = loved
+
+    def field(fields, col):
+        return fields[col] if fields and len(fields) > col else ""
+
+    first, last = shell_fields(scrobbles["first"]), shell_fields(scrobbles["last"])
+    report = FORMAT % (
+        user, scrobbles["lines"], loved["lines"], scrobbles["invalid"],
+        format_timestamp(field(first, TS)), field(first, ARTIST),
+        field(first, TRACK), field(first, ALBUM),
+        format_timestamp(field(last, TS)), field(last, ARTIST),
+        field(last, TRACK), field(last, ALBUM),
+        scrobbles["mbids"][0], scrobbles["mbids"][1], scrobbles["mbids"][2],
+        backup_date(f_scrobbles), backup_date(f_loved))
+    if years:
+        report += "\tscrobbles per year:\n" + "".join(
+            "\t\t%s: %d\n" % (year, count)
+            for year, count in sorted(scrobbles["years"].items()))
+    return report + FOOTER, updates
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_cache(path, cache):
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Print statistics of "
+                                     "lastexport.py backups")
+    parser.add_argument("datadir", metavar="DATADIR", nargs="?",
+                        help="directory with a subdirectory of backups per user")
+    parser.add_argument("-u", "--user", dest="userdir", metavar="USERDIR",
+                        help="print statistics of a single user directory")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="process JOBS users in parallel, default is "
+                             "the number of CPUs")
+    parser.add_argument("-c", "--cache", default=None,
+                        help="cache file, default is DATADIR/.stats_cache.json, "
+                             "use an empty string to disable caching")
+    parser.add_argument("-y", "--years", action="store_true",
+                        help="print the number of scrobbles per year as well")
+    args = parser.parse_args()
+
+    if args.userdir:
+        userdirs = [args.userdir]
+        datadir = os.path.dirname(os.path.normpath(args.userdir))
+    elif args.datadir:
+        datadir = args.datadir
+        userdirs = sorted(e.path for e in os.scandir(datadir)
+                          if e.is_dir() and not e.name.startswith(".")
+                          and e.name != "_oneshot")
+    else:
+        sys.exit("Data dir must be specified")
+
+    cachefile = args.cache
+    if cachefile is None:
+        cachefile = os.path.join(datadir or ".", ".stats_cache.json")
+    cache = load_cache(cachefile) if cachefile else {}
+
+    def user_cache(userdir):
+        prefix = os.path.join(userdir, "")
+        return {k: v for k, v in cache.items() if k.startswith(prefix)}
+
+    jobs = [(d, user_cache(d), args.years) for d in userdirs]
+    if args.jobs > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(min(args.jobs, len(jobs))) as pool:
+            results = pool.map(get_user_stats, jobs)
+    else:
+        results = [get_user_stats(job) for job in jobs]
+
+    changed = False
+    for report, updates in results:
+        sys.stdout.write(report)
+        cache.update(updates)
+        changed = changed or bool(updates)
+
+    if cachefile and changed:
+        # forget files which don't exist anymore
+        cache = {k: v for k, v in cache.items() if os.path.exists(k)}
+        try:
+            save_cache(cachefile, cache)
+        except (IOError, OSError) as e:
+            sys.stderr.write("Couldn't save cache %s: %s\n" % (cachefile, e))
+
+if __name__ == "__main__":
+    main()
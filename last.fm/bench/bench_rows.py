@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of lastfm-backup.py page processing.
+Compares the original path (a Scrobble object per track, unpacked into a row
+by db_save_scrobbles()) with lastfm_page_rows(), which builds the rows right
+away, on decoded synthetic pages of 200 tracks (see lastfm_replay.py).
+Usage: bench_rows.py [-n ROWS] [-t scrobbles|loved]
+
+JSON decoding is the same for both paths, so it's left out. Reported are CPU
+time and allocated memory per row (peak traced by tracemalloc while
+processing a page).
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import lastfm_replay
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+LASTFM_BACKUP = os.path.join(os.path.dirname(BENCHDIR), "lastfm-backup",
+                             "lastfm-backup.py")
+PAGE_SIZE = 200
+# Distinct pages, the rest of the rows are made by processing them repeatedly
+DISTINCT_PAGES = 50
+
+def load_lastfm_backup():
+    spec = importlib.util.spec_from_file_location("lastfm_backup", LASTFM_BACKUP)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# The original path, before lastfm_page_rows()
+class OldScrobble(object):
+    def __init__(self, ts=0, artist="", artist_mbid="", track="", track_mbid="",
+                 album="", album_mbid="", type="recenttracks"):
+        self.ts = ts
+        self.artist = artist
+        self.artist_mbid = artist_mbid
+        self.track = track
+        self.track_mbid = track_mbid
+        self.album = album
+        self.album_mbid = album_mbid
+        self.type = type
+
+def old_process_scrobbles(scrobble_page, scrobble_type):
+    for scb in scrobble_page[scrobble_type]["track"]:
+        try:
+            if scb["@attr"]["nowplaying"]:
+                continue
+        except:
+            pass
+
+        name_tag = "#text" if scrobble_type == "recenttracks" else "name"
+        scrobble = OldScrobble(
+                ts=int(scb["date"]["uts"]),
+                artist=scb["artist"][name_tag],
+                artist_mbid=scb["artist"]["mbid"],
+                track=scb["name"],
+                track_mbid=scb["mbid"],
+                type=scrobble_type
+        )
+
+        if "album" in scb:
+            scrobble.album = scb["album"][name_tag]
+            scrobble.album_mbid = scb["album"]["mbid"]
+
+        yield scrobble
+
+def old_path(page, scrobble_type, last_ts=0):
+    scrobbles = []
+    for scrobble in old_process_scrobbles(page, scrobble_type):
+        if scrobble.ts <= last_ts:
+            break
+        scrobbles.append(scrobble)
+    # db_save_scrobbles()
+    return [(s.ts, s.artist, s.artist_mbid, s.track, s.track_mbid, s.album,
+             s.album_mbid) for s in scrobbles]
+
+def make_pages(scrobble_type):
+    opts = argparse.Namespace(scrobbles=PAGE_SIZE * DISTINCT_PAGES, start=1262304000,
+                              interval=180, loved_every=1, artists=2000, tracks=50,
+                              albums=5, bad_chars=False)
+    catalog = lastfm_replay.Catalog(opts)
+    pages = []
+    for n in range(1, DISTINCT_PAGES + 1):
+        scrobbles, _ = catalog.page(scrobble_type, n, PAGE_SIZE)
+        tracks = [lastfm_replay.json_track(s, scrobble_type) for s in scrobbles]
+        # decoded the same way as a real response
+        pages.append(json.loads(json.dumps({scrobble_type: {"track": tracks}})))
+    return pages
+
+def bench_cpu(func, pages, scrobble_type, rows):
+    count = 0
+    start = time.process_time()
+    while count < rows:
+        for page in pages:
+            count += len(func(page, scrobble_type))
+    return (time.process_time() - start) / count, count
+
+def bench_memory(func, pages, scrobble_type):
+    peak = 0
+    count = 0
+    for page in pages:
+        tracemalloc.start()
+        count += len(func(page, scrobble_type))
+        peak += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return peak / count
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the original and "
+            "the row based page processing of lastfm-backup.py")
+    parser.add_argument("-n", "--rows", type=int, default=1000000,
+            help="number of rows to process by each path (default: 1000000)")
+    parser.add_argument("-t", "--type", default="scrobbles",
+            choices=("scrobbles", "loved"),
+            help="page type (default: scrobbles)")
+    opts = parser.parse_args()
+    scrobble_type = "lovedtracks" if opts.type == "loved" else "recenttracks"
+
+    lastfm_backup = load_lastfm_backup()
+    new_path = lastfm_backup.lastfm_page_rows
+    pages = make_pages(scrobble_type)
+    for page in pages:
+        if old_path(page, scrobble_type) != new_path(page, scrobble_type):
+            sys.exit("Paths disagree, aborting")
+
+    print("{}, {} rows".format(scrobble_type, opts.rows))
+    print("{:<36} {:>10} {:>12}".format("", "us/row", "bytes/row"))
+    results = []
+    for name, func in (("Scrobble + db_save_scrobbles()", old_path),
+                       ("lastfm_page_rows()", new_path)):
+        cpu, _ = bench_cpu(func, pages, scrobble_type, opts.rows)
+        memory = bench_memory(func, pages, scrobble_type)
+        results.append((cpu, memory))
+        print("{:<36} {:>10.3f} {:>12.0f}".format(name, cpu * 1e6, memory))
+
+    (old_cpu, old_memory), (new_cpu, new_memory) = results
+    print("speedup: {:.2f}x, memory: {:.2f}x less".format(old_cpu / new_cpu,
+            old_memory / new_memory))
+
+if __name__ == "__main__":
+    main()
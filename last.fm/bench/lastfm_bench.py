@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Benchmark lastfm-backup.py and lastexport.py against lastfm_replay.py.
+Usage: lastfm_bench.py [--scales 10k,100k,1M] [--scripts backup,export]
+                       [--autocorrect] [-- REPLAY OPTIONS]
+
+For every scale a fresh replay server with that many scrobbles is started,
+and each script backs up the scrobbles of a single user into a temporary
+directory. Reported are the wall time, pages and rows (stored tracks) per
+second, peak RSS of the script, the number of autocorrect (*.getinfo) calls
+and the number of failed and rate limited requests seen by the server.
+
+Options after -- are passed to lastfm_replay.py, e.g. "-- --latency 50
+--error-rate 0.01 --rate-limit 20" to mimic the real API.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+ROOTDIR = os.path.dirname(BENCHDIR)
+REPLAY = os.path.join(BENCHDIR, "lastfm_replay.py")
+LASTFM_BACKUP = os.path.join(ROOTDIR, "lastfm-backup", "lastfm-backup.py")
+LASTEXPORT = os.path.join(ROOTDIR, "backup", "lastexport.py")
+USER = "bench"
+
+# Reported columns, their widths and formats
+COLUMNS = (("script", -14, "s"), ("scrobbles", 10, "d"), ("seconds", 9, ".2f"),
+           ("pages/s", 8, ".1f"), ("rows/s", 9, ".0f"), ("peak RSS MB", 11, ".1f"),
+           ("autocorrect", 11, "d"), ("errors", 6, "d"), ("limited", 7, "d"))
+
+def parse_scale(string):
+    units = {"k": 10**3, "m": 10**6}
+    try:
+        if string[-1:].lower() in units:
+            return int(float(string[:-1]) * units[string[-1].lower()])
+        return int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid scale '{}'".format(string))
+
+class Replay(object):
+    """A lastfm_replay.py server running in the background."""
+    def __init__(self, scrobbles, extra_args):
+        self.proc = subprocess.Popen(
+                [sys.executable, REPLAY, "--port", "0", "--scrobbles",
+                 str(scrobbles)] + extra_args,
+                stdout=subprocess.PIPE, universal_newlines=True)
+        line = self.proc.stdout.readline()
+        if not line.startswith("Listening on "):
+            self.stop()
+            raise Exception("Replay server failed to start")
+        self.url = line.split()[-1]
+        self.host = self.url.split("/")[2]
+
+    def stats(self, reset=False):
+        url = "http://{}/stats{}".format(self.host, "?reset=1" if reset else "")
+        with urllib.request.urlopen(url) as f:
+            return json.loads(f.read().decode())
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+def run(cmd, log):
+    """Run a command, return its wall time and peak RSS in MB."""
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    # wait4() gives resource usage of this very process only
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.monotonic() - start
+    if proc.returncode != 0:
+        raise Exception("{} failed with exit code {}, see {}".format(
+            " ".join(cmd), proc.returncode, log.name))
+    return elapsed, usage.ru_maxrss / 1024
+
+def bench_backup(replay, workdir, opts, log):
+    dbname = os.path.join(workdir, "backup.db3")
+    cmd = [sys.executable, LASTFM_BACKUP, "-u", USER, "-s", "-d", dbname,
+           "--api-url", replay.url, "--api-key", "bench",
+           "--rate", "0", "--jobs", str(opts.jobs)]
+    if opts.autocorrect:
+        cmd.append("--autocorrect")
+    elapsed, rss = run(cmd, log)
+    db = sqlite3.connect(dbname)
+    rows = db.execute("SELECT COUNT(*) FROM {}_recenttracks".format(USER)).fetchone()[0]
+    db.close()
+    return elapsed, rss, rows
+
+def bench_export(replay, workdir, opts, log):
+    outfile = os.path.join(workdir, "export.txt")
+    # the interpreter may be more than one word (e.g. "env PYENV_VERSION=...")
+    cmd = opts.python2.split() + [LASTEXPORT, "-u", USER, "-o", outfile,
+                                  "-s", replay.host]
+    elapsed, rss = run(cmd, log)
+    with open(outfile, "rb") as f:
+        rows = sum(1 for _ in f)
+    return elapsed, rss, rows
+
+SCRIPTS = {
+    "backup": ("lastfm-backup", bench_backup),
+    "export": ("lastexport", bench_export),
+}
+
+def main():
+    argv = sys.argv[1:]
+    replay_args = []
+    if "--" in argv:
+        replay_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser(description="Benchmark lastfm-backup.py "
+            "and lastexport.py against a local replay server (options after "
+            "-- are passed to lastfm_replay.py)")
+    parser.add_argument("--scales", default="10k,100k,1M",
+            type=lambda s: [parse_scale(x) for x in s.split(",")],
+            help="comma separated numbers of scrobbles (default: 10k,100k,1M)")
+    parser.add_argument("--scripts", default="backup,export",
+            type=lambda s: s.split(","),
+            help="comma separated scripts to run: backup (lastfm-backup.py), "
+                 "export (lastexport.py) (default: both)")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+            help="lastfm-backup.py --jobs (default: 4)")
+    parser.add_argument("--autocorrect", action="store_true",
+            help="run lastfm-backup.py with --autocorrect")
+    parser.add_argument("--python2", default="python2.7", metavar="CMD",
+            help="interpreter of lastexport.py (default: python2.7)")
+    parser.add_argument("--json", default=None, metavar="FILE",
+            help="also write results into FILE as JSON")
+    parser.add_argument("--keep", action="store_true",
+            help="keep the working directory (databases, exports and logs)")
+    opts = parser.parse_args(argv)
+
+    for script in opts.scripts:
+        if script not in SCRIPTS:
+            parser.error("unknown script '{}'".format(script))
+
+    workdir = tempfile.mkdtemp(prefix="lastfm-bench-")
+    results = []
+    print("  ".join("%*s" % (width, name) for name, width, _ in COLUMNS))
+    try:
+        for scale in opts.scales:
+            replay = Replay(scale, replay_args)
+            try:
+                for script in opts.scripts:
+                    name, bench = SCRIPTS[script]
+                    rundir = os.path.join(workdir, "{}-{}".format(script, scale))
+                    os.mkdir(rundir)
+                    replay.stats(reset=True)
+                    with open(os.path.join(rundir, "output.log"), "w") as log:
+                        elapsed, rss, rows = bench(replay, rundir, opts, log)
+                    stats = replay.stats()
+                    requests = stats["requests"]
+                    pages = requests.get("user.getrecenttracks", 0)
+                    autocorrect = sum(n for method, n in requests.items()
+                                      if method in ("artist.getinfo",
+                                                    "track.getinfo", "album.getinfo"))
+                    res = {"script": name, "scrobbles": scale, "seconds": elapsed,
+                           "pages/s": pages / elapsed, "rows/s": rows / elapsed,
+                           "peak RSS MB": rss, "autocorrect": autocorrect,
+                           "errors": stats["errors"], "limited": stats["rate_limited"],
+                           "pages": pages, "rows": rows, "bytes": stats["bytes"]}
+                    results.append(res)
+                    print("  ".join("%*{}".format(conv) % (width, res[name])
+                                    for name, width, conv in COLUMNS), flush=True)
+            finally:
+                replay.stop()
+    finally:
+        if opts.keep:
+            print("Results kept in {}".format(workdir))
+        else:
+            shutil.rmtree(workdir)
+
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+#-*- coding: utf-8 -*-
+
+"""
+Local stand-in for the Last.fm API, for benchmarks and offline tests.
+Usage: lastfm_replay.py [-p PORT] [-n SCROBBLES] [--latency MS] [--error-rate P]
+                        [--rate-limit N] [--replay DIR | --record DIR]
+
+Serves user.getrecenttracks, user.getlovedtracks, user.getinfo and
+artist/track/album.getinfo in both the JSON (format=json, lastfm-backup.py)
+and the XML (lastexport.py) format. Any user name is accepted.
+
+Responses are synthetic by default: every user has SCROBBLES scrobbles made
+each INTERVAL seconds since START, drawn from a fixed set of artists, tracks
+and albums (some of them misspelled, which *.getinfo autocorrects), and every
+LOVED_EVERY-th scrobble is also a loved track. With --live, the newest of the
+SCROBBLES scrobbles is made when the server starts and new ones keep coming
+every INTERVAL seconds (for lastfm-backup.py --watch). With --record, requests are
+passed to the real API and its responses are saved to a directory, from which
+--replay serves them later.
+
+GET /stats returns request counters (per method, errors, rate limited
+requests, sent bytes) as JSON, /stats?reset=1 also resets them.
+"""
+
+import argparse
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from xml.sax.saxutils import escape, quoteattr
+
+UPSTREAM = "http://ws.audioscrobbler.com/2.0/"
+MAX_LIMIT = 200
+
+# Last.fm error codes used by the server
+ERR_INVALID_PARAMS = 6
+ERR_OPERATION_FAILED = 8
+ERR_UNAVAILABLE = 16
+ERR_RATE_LIMIT = 29
+
+ERRORS = {
+    ERR_INVALID_PARAMS: "Invalid parameters",
+    ERR_OPERATION_FAILED: "Operation failed - Most likely the backend service failed. Please try again.",
+    ERR_UNAVAILABLE: "There was a temporary error processing your request. Please try again",
+    ERR_RATE_LIMIT: "Rate Limit Exceeded - Your IP has made too many requests in a short period",
+}
+
+class ApiError(Exception):
+    def __init__(self, code, status=400, message=None):
+        super().__init__(message or ERRORS.get(code, "Error"))
+        self.code = code
+        self.status = status
+
+class Catalog(object):
+    """Deterministic synthetic music library and scrobble history.
+
+    Scrobble i of a user is made at START + i * INTERVAL, so any page of any
+    time window is computed directly, without keeping the history in memory.
+    """
+    def __init__(self, opts):
+        self.count = opts.scrobbles
+        self.start = opts.start
+        self.live = None
+        if opts.live:
+            self.live = time.time()
+            self.start = int(self.live) - (opts.scrobbles - 1) * opts.interval
+        self.interval = opts.interval
+        self.loved_every = opts.loved_every
+        self.artists = opts.artists
+        self.tracks = opts.tracks
+        self.albums = opts.albums
+        self.bad_chars = opts.bad_chars
+
+    @property
+    def scrobbles(self):
+        """Number of scrobbles made so far."""
+        if self.live is None:
+            return self.count
+        return self.count + int((time.time() - self.live) // self.interval)
+
+    # Artist/track/album names, a few of them with characters which need
+    # escaping, or are not even valid in XML (see lastexport.py)
+    def artist_name(self, a):
+        if a % 50 == 7:
+            return "Ärtist & Sons <{}>".format(a)
+        return "Artist {}".format(a)
+
+    def track_name(self, a, t):
+        if self.bad_chars and t % 100 == 42:
+            return "Track ￾{}-{}".format(a, t)
+        return "Track {}-{}".format(a, t)
+
+    def album_name(self, a, b):
+        return "Album {}-{}".format(a, b)
+
+    def mbid(self, kind, *key):
+        # about 3/4 of everything has a MusicBrainz ID
+        h = hashlib.md5("{}:{}".format(kind, key).encode()).hexdigest()
+        if int(h[0], 16) < 4:
+            return ""
+        return "{}-{}-{}-{}-{}".format(h[:8], h[8:12], h[12:16], h[16:20], h[20:32])
+
+    def entry(self, i):
+        """Get (artist, track, album) numbers of scrobble i."""
+        h = (i * 2654435761) & 0xffffffff
+        # skewed towards low numbers, like real listening habits
+        a = (h % self.artists) * (h % 7 + 1) // 7 % self.artists
+        t = (h >> 8) % self.tracks
+        b = t % self.albums
+        return a, t, b
+
+    def scrobble(self, i, misspell=True):
+        a, t, b = self.entry(i)
+        artist = self.artist_name(a)
+        track = self.track_name(a, t)
+        # every 10th scrobble has a misspelled (lower case) artist and track
+        if misspell and i % 10 == 3:
+            artist = artist.lower()
+            track = track.lower()
+        return {
+            "ts": self.start + i * self.interval,
+            "artist": artist,
+            "artist_mbid": self.mbid("artist", a),
+            "track": track,
+            "track_mbid": self.mbid("track", a, t),
+            "album": self.album_name(a, b) if i % 20 else "",
+            "album_mbid": self.mbid("album", a, b) if i % 20 else "",
+        }
+
+    def range(self, ts_from=None, ts_to=None):
+        """Get indices [lo, hi) of scrobbles within a time window."""
+        lo, hi = 0, self.scrobbles
+        if ts_from is not None:
+            lo = max(lo, -(-(ts_from - self.start) // self.interval))
+        if ts_to is not None:
+            hi = min(hi, (ts_to - self.start) // self.interval + 1)
+        return lo, max(lo, hi)
+
+    def loved_count(self):
+        return (self.scrobbles + self.loved_every - 1) // self.loved_every
+
+    def page(self, kind, page, limit, ts_from=None, ts_to=None):
+        """Get (scrobbles of the page newest first, total count)."""
+        if kind == "lovedtracks":
+            total = self.loved_count()
+            index = lambda n: n * self.loved_every
+            lo = 0
+        else:
+            lo, hi = self.range(ts_from, ts_to)
+            total = hi - lo
+            index = lambda n: n
+        first = total - (page - 1) * limit - 1
+        last = max(total - page * limit, 0)
+        return [self.scrobble(index(lo + n), kind != "lovedtracks")
+                for n in range(first, last - 1, -1)], total
+
+    # Autocorrection of names made by scrobble(), a few of the artists are
+    # unknown (error 6) like on the real site. Other names are looked up as
+    # if they were known, so a real name (e.g. in lastfm-backup.py --tests)
+    # gets its title case form and an MBID.
+    def correct(self, kind, name, artist=None, mbid=None):
+        m = re.match(r"(?:artist|track|album|ärtist & sons <)\D*(\d+)(?:-(\d+))?>?$",
+                     (name or "").lower())
+        if not m or (kind == "artist") != (m.group(2) is None):
+            name = (name or "").title()
+            artist = {"name": (artist or "").title(),
+                      "mbid": self.mbid("artist", artist, "real")}
+            return self.info(kind, name, mbid or self.mbid(kind, name, "real") or
+                             self.mbid(kind, name, "real", 1), artist)
+
+        a = int(m.group(1))
+        if a % 97 == 13:
+            raise ApiError(ERR_INVALID_PARAMS, 404,
+                           "The artist you supplied could not be found")
+        artist = {"name": self.artist_name(a), "mbid": self.mbid("artist", a)}
+        if kind == "artist":
+            return artist
+        n = int(m.group(2))
+        if kind == "track":
+            return self.info(kind, self.track_name(a, n), self.mbid("track", a, n), artist)
+        return self.info(kind, self.album_name(a, n), self.mbid("album", a, n), artist)
+
+    def info(self, kind, name, mbid, artist):
+        if kind == "artist":
+            return {"name": name, "mbid": mbid}
+        if kind == "track":
+            return {"name": name, "mbid": mbid, "artist": artist}
+        return {"name": name, "mbid": mbid, "artist": artist["name"]}
+
+def json_track(s, kind):
+    track = {
+        "name": s["track"],
+        "mbid": s["track_mbid"],
+        "url": "https://www.last.fm/music/_/_",
+        "streamable": "0",
+        "image": [{"size": size, "#text": ""}
+                  for size in ("small", "medium", "large", "extralarge")],
+        "date": {"uts": str(s["ts"]),
+                 "#text": time.strftime("%d %b %Y, %H:%M", time.gmtime(s["ts"]))},
+    }
+    if kind == "lovedtracks":
+        # loved tracks have nested artist info and no album
+        track["artist"] = {"name": s["artist"], "mbid": s["artist_mbid"],
+                           "url": "https://www.last.fm/music/_"}
+    else:
+        track["artist"] = {"#text": s["artist"], "mbid": s["artist_mbid"]}
+        track["album"] = {"#text": s["album"], "mbid": s["album_mbid"]}
+    return track
+
+def xml_track(s, kind):
+    date = time.strftime("%d %b %Y, %H:%M", time.gmtime(s["ts"]))
+    if kind == "lovedtracks":
+        return ("<track><name>{}</name><mbid>{}</mbid><url>https://www.last.fm/music/_/_</url>"
+                "<date uts=\"{}\">{}</date><artist><name>{}</name><mbid>{}</mbid>"
+                "<url>https://www.last.fm/music/_</url></artist></track>").format(
+                    escape(s["track"]), s["track_mbid"], s["ts"], date,
+                    escape(s["artist"]), s["artist_mbid"])
+    return ("<track><artist mbid=\"{}\">{}</artist><name>{}</name><streamable>0</streamable>"
+            "<mbid>{}</mbid><album mbid=\"{}\">{}</album><url>https://www.last.fm/music/_/_</url>"
+            "<date uts=\"{}\">{}</date></track>").format(
+                s["artist_mbid"], escape(s["artist"]), escape(s["track"]),
+                s["track_mbid"], s["album_mbid"], escape(s["album"]), s["ts"], date)
+
+def xml_value(key, value):
+    if isinstance(value, dict):
+        return "<{0}>{1}</{0}>".format(key, "".join(xml_value(k, v) for k, v in value.items()))
+    return "<{0}>{1}</{0}>".format(key, escape(str(value)))
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = {}
+        self.errors = 0
+        self.rate_limited = 0
+        self.bytes = 0
+
+    def add(self, method, status, size):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            self.bytes += size
+            if status == 429:
+                self.rate_limited += 1
+            elif status != 200:
+                self.errors += 1
+
+    def dump(self, reset=False):
+        with self.lock:
+            data = {"requests": self.requests, "errors": self.errors,
+                    "rate_limited": self.rate_limited, "bytes": self.bytes}
+            if reset:
+                self.reset()
+            return data
+
+class TokenBucket(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+def request_key(params):
+    """Get the file name of a recorded response (the API key is not a part of it)."""
+    items = sorted((k, v) for k, v in params.items() if k != "api_key")
+    digest = hashlib.sha1(urllib.parse.urlencode(items).encode()).hexdigest()
+    return "{}_{}.json".format(params.get("method", "none"), digest[:16])
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # send headers and body at once, a separate small write would wait for
+    # the delayed ACK of the client on keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        if self.server.opts.verbose:
+            super().log_message(fmt, *args)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path.rstrip("/") == "/stats":
+            stats = self.server.stats.dump("reset" in params)
+            return self.send(200, json.dumps(stats).encode(), "application/json")
+
+        opts = self.server.opts
+        method = params.get("method", "").lower()
+        fmt = "json" if params.get("format") == "json" else "xml"
+        try:
+            self.faults()
+            if opts.record:
+                status, body, ctype = self.record(params)
+            elif opts.replay:
+                status, body, ctype = self.replay(params)
+            else:
+                status = 200
+                body, ctype = self.synthetic(method, params, fmt)
+        except ApiError as e:
+            status = e.status
+            body, ctype = self.error(e, fmt)
+
+        if opts.latency or opts.jitter:
+            time.sleep(max(0, random.gauss(opts.latency, opts.jitter)) / 1000)
+        self.server.stats.add(method, status, len(body))
+        self.send(status, body, ctype)
+
+    # Random failures, in the order the real API would produce them
+    def faults(self):
+        opts = self.server.opts
+        if self.server.bucket and not self.server.bucket.take():
+            raise ApiError(ERR_RATE_LIMIT, 429)
+        if opts.stall_rate and random.random() < opts.stall_rate:
+            time.sleep(opts.stall)
+        if opts.error_rate and random.random() < opts.error_rate:
+            if random.random() < 0.5:
+                raise ApiError(ERR_OPERATION_FAILED, 500)
+            raise ApiError(ERR_UNAVAILABLE, 503)
+
+    def synthetic(self, method, params, fmt):
+        catalog = self.server.catalog
+        user = params.get("user", "")
+        if method in ("user.getrecenttracks", "user.getlovedtracks"):
+            if not user:
+                raise ApiError(ERR_INVALID_PARAMS)
+            kind = method[len("user.get"):]
+            try:
+                page = max(1, int(params.get("page", 1)))
+                limit = min(MAX_LIMIT, max(1, int(params.get("limit", 50))))
+                ts_from = int(params["from"]) if "from" in params else None
+                ts_to = int(params["to"]) if "to" in params else None
+            except ValueError:
+                raise ApiError(ERR_INVALID_PARAMS)
+            if self.server.opts.exclusive_range:
+                ts_from = ts_from + 1 if ts_from is not None else None
+                ts_to = ts_to - 1 if ts_to is not None else None
+            scrobbles, total = catalog.page(kind, page, limit, ts_from, ts_to)
+            attr = {"user": user, "page": str(page), "perPage": str(limit),
+                    "totalPages": str(-(-total // limit)), "total": str(total)}
+            # the currently playing track comes on top of the first page
+            nowplaying = self.server.opts.now_playing and kind == "recenttracks" \
+                    and page == 1 and ts_to is None
+            if fmt == "json":
+                tracks = [json_track(s, kind) for s in scrobbles]
+                if nowplaying:
+                    np = json_track(catalog.scrobble(catalog.scrobbles), kind)
+                    del np["date"]
+                    np["@attr"] = {"nowplaying": "true"}
+                    tracks.insert(0, np)
+                return json.dumps({kind: {"track": tracks, "@attr": attr}}).encode(), \
+                        "application/json"
+
+            tracks = "".join(xml_track(s, kind) for s in scrobbles)
+            if nowplaying:
+                np = xml_track(catalog.scrobble(catalog.scrobbles), kind)
+                np = re.sub("<date [^>]*>[^<]*</date>", "", np)
+                tracks = np.replace("<track>", "<track nowplaying=\"true\">", 1) + tracks
+            attrs = " ".join("{}={}".format(k, quoteattr(v)) for k, v in attr.items())
+            return self.xml("<{0} {1}>{2}</{0}>".format(kind, attrs, tracks)), "text/xml"
+
+        if method == "user.getinfo":
+            data = {"user": {"name": user, "playcount": str(catalog.scrobbles),
+                             "registered": {"unixtime": str(catalog.start - 86400),
+                                            "#text": catalog.start - 86400}}}
+        elif method in ("artist.getinfo", "track.getinfo", "album.getinfo"):
+            kind = method.split(".")[0]
+            data = {kind: catalog.correct(kind, params.get(kind), params.get("artist"),
+                                          params.get("mbid"))}
+        else:
+            raise ApiError(3, 400, "Invalid Method - No method with that name in this package")
+
+        if fmt == "json":
+            return json.dumps(data).encode(), "application/json"
+        return self.xml("".join(xml_value(k, v) for k, v in data.items())), "text/xml"
+
+    def xml(self, content):
+        return ("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n<lfm status=\"ok\">\n"
+                + content + "</lfm>\n").encode("utf-8")
+
+    def error(self, e, fmt):
+        if fmt == "json":
+            return json.dumps({"error": e.code, "message": str(e)}).encode(), \
+                    "application/json"
+        return ("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n<lfm status=\"failed\">"
+                "<error code=\"{}\">{}</error></lfm>\n".format(e.code, escape(str(e)))
+                .encode()), "text/xml"
+
+    def replay(self, params):
+        path = os.path.join(self.server.opts.replay, request_key(params))
+        try:
+            with open(path) as f:
+                rec = json.load(f)
+        except IOError:
+            raise ApiError(ERR_INVALID_PARAMS, 404, "No recorded response")
+        return rec["status"], rec["body"].encode("utf-8"), rec["content_type"]
+
+    def record(self, params):
+        url = self.server.opts.upstream + "?" + urllib.parse.urlencode(params)
+        try:
+            with urllib.request.urlopen(url, timeout=30) as f:
+                status, body, ctype = f.status, f.read(), f.headers.get("Content-Type", "")
+        except urllib.error.HTTPError as e:
+            status, body, ctype = e.code, e.read(), e.headers.get("Content-Type", "")
+        except urllib.error.URLError:
+            raise ApiError(ERR_OPERATION_FAILED, 502)
+        path = os.path.join(self.server.opts.record, request_key(params))
+        with open(path + ".tmp", "w") as f:
+            json.dump({"status": status, "content_type": ctype,
+                       "body": body.decode("utf-8", "replace")}, f)
+        os.replace(path + ".tmp", path)
+        return status, body, ctype
+
+    def send(self, status, body, ctype):
+        if self.server.opts.gzip and len(body) > 1024 and \
+                "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, 1)
+            encoding = "gzip"
+        else:
+            encoding = None
+        self.send_response(status)
+        self.send_header("Content-Type", ctype + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, opts):
+        super().__init__(address, Handler)
+        self.opts = opts
+        self.catalog = Catalog(opts)
+        self.stats = Stats()
+        self.bucket = TokenBucket(opts.rate_limit) if opts.rate_limit else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the "
+            "Last.fm API (see the module documentation)")
+    parser.add_argument("-b", "--bind", default="127.0.0.1",
+            help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("-p", "--port", type=int, default=8080,
+            help="port to listen on, 0 picks a free one (default: 8080)")
+    parser.add_argument("-n", "--scrobbles", type=int, default=10000,
+            help="number of scrobbles of every user (default: 10000)")
+    parser.add_argument("--start", type=int, default=1262304000,
+            help="UNIX timestamp of the first scrobble (default: 2010-01-01)")
+    parser.add_argument("--interval", type=int, default=180,
+            help="seconds between two scrobbles (default: 180)")
+    parser.add_argument("--loved-every", type=int, default=20, metavar="N",
+            help="every N-th scrobble is a loved track (default: 20)")
+    parser.add_argument("--artists", type=int, default=2000,
+            help="number of distinct artists (default: 2000)")
+    parser.add_argument("--tracks", type=int, default=50,
+            help="number of tracks of every artist (default: 50)")
+    parser.add_argument("--albums", type=int, default=5,
+            help="number of albums of every artist (default: 5)")
+    parser.add_argument("--bad-chars", action="store_true",
+            help="put characters invalid in XML into some track names")
+    parser.add_argument("--live", action="store_true",
+            help="keep scrobbling every --interval seconds, the history "
+                 "ends at the server start instead of --start")
+    parser.add_argument("--exclusive-range", action="store_true",
+            help="leave scrobbles at the from and to timestamps out of "
+                 "ranges (by default both ends are included)")
+    parser.add_argument("--now-playing", action="store_true",
+            help="put a currently playing track on top of the first page")
+    parser.add_argument("--latency", type=float, default=0, metavar="MS",
+            help="mean response latency in milliseconds (default: 0)")
+    parser.add_argument("--jitter", type=float, default=0, metavar="MS",
+            help="standard deviation of the latency (default: 0)")
+    parser.add_argument("--error-rate", type=float, default=0, metavar="P",
+            help="fail requests with probability P (error 8 or 16)")
+    parser.add_argument("--stall-rate", type=float, default=0, metavar="P",
+            help="stall requests for --stall seconds with probability P")
+    parser.add_argument("--stall", type=float, default=10, metavar="SECONDS",
+            help="how long stalled requests take (default: 10)")
+    parser.add_argument("--rate-limit", type=float, default=0, metavar="N",
+            help="allow only N requests per second, reply with error 29 "
+                 "otherwise (default: no limit)")
+    parser.add_argument("--no-gzip", dest="gzip", action="store_false",
+            help="never compress responses")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--replay", default=None, metavar="DIR",
+            help="serve responses recorded by --record from DIR")
+    source.add_argument("--record", default=None, metavar="DIR",
+            help="pass requests to --upstream and record responses into DIR")
+    parser.add_argument("--upstream", default=UPSTREAM, metavar="URL",
+            help="API used by --record (default: {})".format(UPSTREAM))
+    parser.add_argument("-v", "--verbose", action="store_true",
+            help="log every request")
+    opts = parser.parse_args()
+
+    if opts.scrobbles < 0 or opts.interval < 1 or opts.loved_every < 1 or \
+            opts.artists < 1 or opts.tracks < 1 or opts.albums < 1:
+        sys.exit("Invalid library size, see --help")
+    if opts.record:
+        os.makedirs(opts.record, exist_ok=True)
+
+    server = Server((opts.bind, opts.port), opts)
+    # the first line of output is for scripts using --port 0
+    print("Listening on http://{}:{}/2.0/".format(*server.server_address[:2]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
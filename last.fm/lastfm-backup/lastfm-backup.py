@@ -16,10 +16,40 @@
 #    instead of a full one (until the corresponding DB is deleted)
 #
 #  2) Re-sync (useful when the first sync unexpectedly ended)
+#    $ ./lastfm-backup.py -u mrc0mmand -s --verify
+#    Find time ranges with missing tracks (by comparing track counts with
+#    Last.FM) and download only those
+#
 #    $ ./lastfm-backup.py -u mrc0mmand -s --force
 #    This forces a full backup, but skips tracks already saved in the DB
 #
-#  3) Export to a plaintext file
+#  3) Faster and partial syncs
+#    $ ./lastfm-backup.py -u mrc0mmand -s --jobs 8
+#    Download 8 pages at once (they're still saved in order)
+#
+#    $ ./lastfm-backup.py -u mrc0mmand -s --window 90 --from 2010-01-01 \
+#          --to 2015-01-01
+#    Back up only scrobbles from given time range, in 90 days long windows
+#
+#    $ ./lastfm-backup.py -u mrc0mmand -u someoneelse -U users.txt -s -l
+#    Back up multiple users at once (4 at a time by default, see -P), sharing
+#    the connection pool and the request rate limit (see --rate)
+#
+#    $ ./lastfm-backup.py -u mrc0mmand -s --enrich --jobs 8
+#    Autocorrect artist, track and album names of already stored scrobbles
+#    (--autocorrect does the same right after a backup)
+#
+#    $ ./lastfm-backup.py -u mrc0mmand -u someoneelse -s -l --watch
+#    Back up given users and keep polling them for new scrobbles instead of
+#    running from cron (every 30s while they're listening, up to every 15
+#    minutes when idle), currently playing tracks are kept in the now_playing
+#    table (see ../lyrics.php)
+#
+#  4) Import backups made by lastexport.py (lastfm_backup.sh)
+#    $ ./lastfm-backup.py --import data/mrc0mmand/mrc0mmand_scrobbles_* -j 4
+#    User and scrobble type are taken from the file names (or use -u and -s/-l)
+#
+#  5) Export to a plaintext file
 #    $ ./lastfm-backup.py -u mrc0mmand -s --export exp.txt
 #    This will export all scrobbles of given user into a tab-separated file
 #    exp.txt
@@ -29,6 +59,40 @@
 #    $ ./lastfm-backup.py -u mrc0mmand -s --export exp.txt --separator \;
 #    Same as above, but with a semicolon as a separator instead of a tab
 #
+#    $ ./lastfm-backup.py -u mrc0mmand -s --export delta.jsonl.gz \
+#          --format jsonl --incremental nightly
+#    Export only scrobbles newer than the last "nightly" export, as gzipped
+#    JSON Lines (CSV is supported as well)
+#
+#  6) Full-text search, queries and analytics
+#    $ ./lastfm-backup.py -u mrc0mmand -s --search 'artist: beat* track: "let it"'
+#    Print scrobbles matching given words, prefixes or phrases (in any field,
+#    or only in artist, track or album), newest first; --from and --to limit
+#    the time range. The search index is built on the first search (or by
+#    --search-index) and kept up to date by backups
+#
+#    $ ./lastfm-backup.py --serve 8081 &
+#    $ curl 'http://localhost:8081/top?user=mrc0mmand&kind=artist&limit=5'
+#    Answer JSON queries (users, stats, recent, top, periods, search,
+#    nowplaying) over HTTP, e.g. for a web page, responses are cached until
+#    the next commit of a backup
+#
+#    $ ./lastfm-backup.py -u mrc0mmand -s --analytics --top 20
+#    Print listening analytics (needs NumPy): a weekday/hour heatmap, streaks,
+#    sessions and monthly trends of the top 20 artists; results are cached in
+#    the database, so later runs process only new scrobbles
+#
+#  7) Benchmarks and offline tests
+#    $ ../bench/lastfm_replay.py --port 8080 &
+#    $ ./lastfm-backup.py -u mrc0mmand -s --tests \
+#          --api-url http://localhost:8080/2.0/ --api-key x
+#    Run against a local stand-in of the Last.FM API instead of the real one
+#    (see ../bench/lastfm_bench.py for throughput benchmarks)
+#
+#    $ ./lastfm-backup.py -u mrc0mmand -s --profile profile.json
+#    Write a JSON summary of where the time went (downloads, decoding,
+#    autocorrect, database writes), request latencies, retries and sleeps
+#
 # Supported srobble types: recenttracks, lovedtracks
 #
 # API key:
@@ -59,10 +123,32 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from datetime import datetime
+from datetime import datetime, timedelta
+import concurrent.futures
+import collections
+import gzip
+import lzma
+import csv
+import os
+import contextlib
+import itertools
+import threading
 import argparse
+import cProfile
+import heapq
+import http.server
+import io
+import queue
+import signal
+import urllib.parse
 import requests
 import sqlite3
+try:
+    import numpy as np
+except ImportError:
+    # Needed only by --analytics
+    np = None
+import random
 import time
 import json
 import sys
@@ -71,9 +157,43 @@ import re
 API_KEY=""
 BASEURL = "http://ws.audioscrobbler.com/2.0/?"
 
+# Scrobble type IDs in the normalized database schema
+SCROBBLE_TYPES = {
+    "recenttracks" : 0,
+    "lovedtracks"  : 1
+}
+# Columns with aggregated play counts and distinct value counts (the
+# corresponding stats_totals columns), see db_stats_init()
+STATS_COLUMNS = collections.OrderedDict((
+    ("artist"      , "artists"),
+    ("artist_mbid" , "artists_mbid"),
+    ("track"       , "tracks"),
+    ("track_mbid"  , "tracks_mbid"),
+    ("album"       , "albums"),
+    ("album_mbid"  , "albums_mbid")
+))
+# Periods with aggregated play counts and their strftime() formats
+STATS_PERIODS = collections.OrderedDict((
+    ("day"   , "%Y-%m-%d"),
+    ("week"  , "%Y-W%W"),
+    ("month" , "%Y-%m")
+))
+# Interned dimension tables of the normalized database schema and their
+# unique keys
+DIMENSIONS = {
+    "artists" : ("name", "mbid"),
+    "tracks"  : ("artist_id", "name", "mbid"),
+    "albums"  : ("artist_id", "name", "mbid")
+}
+
+# A single scrobble, used only where it's handy (verbose output, tests),
+# backups pass scrobbles around as plain rows (see lastfm_page_rows())
 class Scrobble(object):
+    __slots__ = ("ts", "artist", "artist_mbid", "track", "track_mbid", "album",
+                 "album_mbid")
+
     def __init__(self, ts=0, artist="", artist_mbid="", track="", track_mbid="",
-            album="", album_mbid="", type="recenttracks"):
+            album="", album_mbid=""):
         self.ts = ts
         self.artist = artist
         self.artist_mbid = artist_mbid
@@ -81,7 +201,15 @@ class Scrobble(object):
         self.track_mbid = track_mbid
         self.album = album
         self.album_mbid = album_mbid
-        self.type = type
+
+    # Rows have the columns of the data table
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+    def row(self):
+        return (self.ts, self.artist, self.artist_mbid, self.track,
+                self.track_mbid, self.album, self.album_mbid)
 
     def __str__(self):
         return "Timestamp:\t{}\nArtist:\t\t{}\nArist MBID:\t{}\nTrack:\t\t{}\n" \
@@ -93,94 +221,437 @@ def printv(string):
     if args.verbose:
         print(string)
 
-def url_get(url, urlvars, timeout=5):
-    for interval in (1, 5, 10, 60, 120, 180):
+# Print a message about given user, prefixed with the user name when backing
+# up multiple users at once
+def printu(username, string):
+    if len(args.usernames) > 1:
+        string = "\n".join("[{}] {}".format(username, line)
+                for line in string.split("\n"))
+    print(string)
+
+class LastfmError(Exception):
+    def __init__(self, code, message):
+        super(LastfmError, self).__init__("[Error {}] {}".format(code, message))
+        self.code = code
+        self.message = message
+
+# Token bucket rate limiter with a circuit breaker, shared by all requests
+# (and threads)
+# The request rate adapts to the API: it's halved every time the API says
+# the rate limit was exceeded and slowly restored back to the configured rate
+# with each successful request, so the throughput stays just below the limit.
+# A rate limit error or too many failures in a row trip the breaker, which
+# pauses all requests instead of letting each of them retry on its own.
+class RateLimiter(object):
+    def __init__(self, rate, failure_threshold=5, cooldown=60):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = 1.0
+        self.stamp = time.monotonic()
+        self.paused_until = 0
+        self.failures = 0
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+
+    # Wait until a request can be made
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if not self.rate:
+                        return
+
+                    burst = max(1.0, self.rate)
+                    self.tokens = min(burst,
+                            self.tokens + (now - self.stamp) * self.rate)
+                    self.stamp = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until,
+                    time.monotonic() + seconds)
+            self.tokens = 0
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            if self.rate:
+                self.rate = min(self.max_rate,
+                        self.rate + self.max_rate / 100)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            trip = self.failures >= self.failure_threshold
+            if trip:
+                self.failures = 0
+
+        if trip:
+            print("Too many failed requests, pausing all requests for {}s"
+                    .format(self.cooldown))
+            self.pause(self.cooldown)
+
+    def rate_limited(self):
+        with self.lock:
+            if self.rate:
+                self.rate = max(self.max_rate / 20, self.rate / 2)
+
+        print("Rate limit exceeded, pausing all requests for {}s"
+                .format(self.cooldown / 2))
+        self.pause(self.cooldown / 2)
+
+# Run profile: time spent in each phase of the backup, shared by all threads
+# Phases are timed per page (see Profile.PHASES), requests by their latency
+# and outcome. The profile is always collected, as it costs next to nothing
+# compared to the requests, and written as a JSON summary with --profile.
+class Profile(object):
+    # Per page phases
+    #  - download: url_get() of a page, including retries and sleeps
+    #  - decode: JSON decoding of a page
+    #  - wait: waiting for the next page to be downloaded (with --jobs
+    #    the pages are downloaded in the background)
+    #  - process: page to scrobbles
+    #  - db_write: saving a page into the database (including commits)
+    #  - enrich: a whole autocorrect pass after the backup of a user (see
+    #    db_enrich())
+    PHASES = ("download", "decode", "wait", "process", "db_write", "enrich")
+    # Upper bounds of the request latency histogram buckets (in seconds)
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.phases = {phase : [] for phase in self.PHASES}
+        self.latency = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self.latency_total = 0
+        self.latency_max = 0
+        self.requests = collections.Counter()
+        self.retries = 0
+        self.sleep = collections.Counter()
+        self.autocorrect_calls = 0
+        self.autocorrect_cached = 0
+        self.pages = 0
+        self.processed = 0
+        self.stored = 0
+
+    # Add a sample (duration of a phase for a single page)
+    def add(self, phase, seconds):
+        with self.lock:
+            self.phases[phase].append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
         try:
-            f = requests.get(url, params=urlvars, timeout=timeout)
-            if f.status_code != requests.codes.ok:
-                raise Exception("Timeout reached ({})".format(f.status_code))
-            else:
-                break
-        except Exception as e:
-            last_exc = e
-            print("Exception occured, retrying in {}s: {}".format(interval, e))
-            time.sleep(interval)
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    # Record a request, outcome is "ok", or the reason why it failed
+    def request(self, seconds, outcome):
+        bucket = 0
+        while bucket < len(self.LATENCY_BUCKETS) and \
+                seconds > self.LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        with self.lock:
+            self.latency[bucket] += 1
+            self.latency_total += seconds
+            self.latency_max = max(self.latency_max, seconds)
+            self.requests[outcome] += 1
+
+    # Record time spent sleeping: "backoff" before a retry, "throttle" while
+    # waiting for the rate limiter
+    def slept(self, reason, seconds):
+        with self.lock:
+            self.sleep[reason] += seconds
+            if reason == "backoff":
+                self.retries += 1
+
+    def autocorrect(self, cached):
+        with self.lock:
+            self.autocorrect_calls += 1
+            if cached:
+                self.autocorrect_cached += 1
+
+    def page(self, processed, stored):
+        with self.lock:
+            self.pages += 1
+            self.processed += processed
+            self.stored += stored
+
+    def summary(self):
+        def percentile(samples, p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+        with self.lock:
+            elapsed = time.monotonic() - self.start
+            phases = collections.OrderedDict()
+            for phase in self.PHASES:
+                samples = sorted(self.phases[phase])
+                if not samples:
+                    continue
+                phases[phase] = collections.OrderedDict((
+                    ("pages"   , len(samples)),
+                    ("total"   , sum(samples)),
+                    ("mean"    , sum(samples) / len(samples)),
+                    ("p50"     , percentile(samples, 0.5)),
+                    ("p95"     , percentile(samples, 0.95)),
+                    ("max"     , samples[-1])
+                ))
+
+            count = sum(self.latency)
+            buckets = ["<={}".format(b) for b in self.LATENCY_BUCKETS] + \
+                      [">{}".format(self.LATENCY_BUCKETS[-1])]
+
+            return collections.OrderedDict((
+                ("seconds"         , elapsed),
+                ("pages"           , self.pages),
+                ("processed"       , self.processed),
+                ("stored"          , self.stored),
+                ("pages_per_s"     , self.pages / elapsed),
+                ("tracks_per_s"    , self.processed / elapsed),
+                ("phases"          , phases),
+                ("requests"        , collections.OrderedDict((
+                    ("count"       , count),
+                    ("outcomes"    , dict(self.requests)),
+                    ("retries"     , self.retries),
+                    ("latency_mean", self.latency_total / count if count else 0),
+                    ("latency_max" , self.latency_max),
+                    ("latency"     , collections.OrderedDict(
+                        zip(buckets, self.latency)))
+                ))),
+                ("sleep"           , dict(self.sleep)),
+                ("autocorrect"     , collections.OrderedDict((
+                    ("lookups"     , self.autocorrect_calls),
+                    ("cached"      , self.autocorrect_cached)
+                )))
+            ))
+
+profile = Profile()
+
+# Format progress of a backup: throughput since start and the estimated time
+# to download the remaining pages (an upper bound for incremental backups,
+# which end at the last stored track)
+def progress(start, pages_done, page_count, processed):
+    elapsed = max(time.monotonic() - start, 1e-6)
+    rate = pages_done / elapsed
+    eta = (page_count - pages_done) / rate if rate else 0
+
+    return "{:.1f} pages/s, {:.0f} tracks/s, ETA {}".format(rate,
+            processed / elapsed, str(timedelta(seconds=int(eta))))
+
+# Write the run profile as JSON into given file ("-" means stdout)
+def profile_write(filename):
+    data = json.dumps(profile.summary(), indent=4)
+    if filename == "-":
+        print(data)
     else:
-        print("Failed to open page {}".format(page))
-        raise last_exc
+        with open(filename, "w") as f:
+            f.write(data + "\n")
+
+# Run the body (any mode) with --profile and --cprofile, the profiles are
+# written even if it fails
+@contextlib.contextmanager
+def profiled():
+    if args.cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if args.cprofile:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+        if args.profile:
+            profile_write(args.profile)
 
-    data = f.text
-    f.close()
+# HTTP session and rate limiter shared by all requests (and threads)
+# The session keeps a pool of --pool-size connections to the API server alive
+# and negotiates compressed responses.
+session = None
+limiter = None
+http_lock = threading.Lock()
 
-    return data
+def http_session():
+    global session
+    with http_lock:
+        if session is None:
+            pool_size = args.pool_size or args.jobs * min(args.parallel_users,
+                    len(args.usernames))
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                    pool_maxsize=pool_size, pool_block=True)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({
+                "Accept-Encoding" : "gzip, deflate",
+                "Connection"      : "keep-alive"
+            })
 
-# Autocorrect type: artist, track, album
-def lastfm_autocorrect_get(urlvars, a_type):
-    data = url_get(BASEURL, urlvars)
-    res = json.loads(data)
+    return session
 
+def http_limiter():
+    global limiter
+    with http_lock:
+        if limiter is None:
+            limiter = RateLimiter(args.rate)
+
+    return limiter
+
+# Exponential backoff with full jitter, so concurrent requests failing at the
+# same time don't retry at the same time as well
+def url_backoff(attempt, base, cap=180):
+    return random.uniform(base / 2, min(cap, base * 2 ** attempt))
+
+# Get the error code and message from an API error response
+def url_error(f):
     try:
-        name = res[a_type]["name"]
-        if "mbid" in res[a_type]:
-            mbid = res[a_type]["mbid"]
+        res = f.json()
+        return int(res["error"]), res.get("message", "")
+    except Exception:
+        return None, None
+
+# Retryable failures are retried with a backoff depending on the failure:
+#  - timeouts and connection errors: short backoff
+#  - server errors (HTTP 5xx, API errors 8, 11 and 16): longer backoff
+#  - rate limit exceeded (HTTP 429, API error 29): pauses all requests and
+#    lowers the request rate (see RateLimiter)
+# Other API errors (e.g. a non-existent user or artist) raise LastfmError
+# right away.
+def url_get(url, urlvars, timeout=5, retries=6):
+    limiter = http_limiter()
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        limiter.acquire()
+        sent = time.perf_counter()
+        profile.slept("throttle", sent - start)
+        try:
+            f = http_session().get(url, params=urlvars, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            profile.request(time.perf_counter() - sent, "connection_error")
+            last_exc = e
+            delay = url_backoff(attempt, 1)
+            limiter.failure()
         else:
-            mbid = ""
-    except Exception as e:
-        error = lastfm_error(res)
-        if not error:
-            error = e
-        raise Exception("[Autocorrect]: {} autocorrection failed, reason: {}"
-                "(name: {}, mbid: {})"
-                .format(a_type, error, urlvars.get(a_type, ""),
-                    urlvars.get("mbid", "")))
+            if f.status_code == requests.codes.ok:
+                limiter.success()
+                data = f.text
+                f.close()
+                profile.request(time.perf_counter() - sent, "ok")
+
+                return data
+
+            code, message = url_error(f)
+            f.close()
+            last_exc = LastfmError(code, message or "HTTP status {}"
+                    .format(f.status_code))
+            if f.status_code == 429 or code == 29:
+                profile.request(time.perf_counter() - sent, "rate_limited")
+                delay = 0
+                limiter.rate_limited()
+            elif f.status_code >= 500 or code in (8, 11, 16):
+                profile.request(time.perf_counter() - sent, "server_error")
+                delay = url_backoff(attempt, 5)
+                limiter.failure()
+            else:
+                profile.request(time.perf_counter() - sent, "api_error")
+                raise last_exc
+
+        if attempt < retries:
+            print("Exception occured, retrying in {:.1f}s: {}"
+                    .format(delay, last_exc))
+            time.sleep(delay)
+            profile.slept("backoff", delay)
 
-    return name, mbid
+    print("Failed to open page {}".format(urlvars.get("page", url)))
+    raise last_exc
 
-def lastfm_autocorrect(scrobble):
+# Get API call parameters of an autocorrect lookup
+# Autocorrect type: artist, track, album. Tracks and albums are looked up
+# along with their (already autocorrected) artist.
+def lastfm_autocorrect_vars(a_type, artist, name, mbid):
     urlvars = {
         "api_key"     : API_KEY,
         "format"      : "json",
-        "autocorrect" : 1
+        "autocorrect" : 1,
+        "method"      : "{}.getinfo".format(a_type),
+        "artist"      : artist
     }
+    if a_type != "artist":
+        urlvars[a_type] = name
+    if mbid:
+        urlvars["mbid"] = mbid
 
-    # Artist autocorrect
-    vars_artist = urlvars.copy()
-    vars_artist["method"] = "artist.getinfo"
-    vars_artist["artist"] = scrobble.artist
-    if scrobble.artist_mbid:
-        vars_artist["mbid"] = scrobble.artist_mbid
-
-    artist, artist_mbid = lastfm_autocorrect_get(vars_artist, "artist")
-
-    # Track autocorrect
-    vars_track = urlvars.copy()
-    vars_track["method"] = "track.getinfo"
-    vars_track["artist"] = artist # Use autocorrected artist
-    vars_track["track"] = scrobble.track
-    if scrobble.track_mbid:
-        vars_track["mbid"] = scrobble.track_mbid
-
-    track, track_mbid = lastfm_autocorrect_get(vars_track, "track")
-
-    # Album autocorrect
-    if scrobble.album or scrobble.album_mbid:
-        vars_album = urlvars.copy()
-        vars_album["method"] = "album.getinfo"
-        vars_album["artist"] = artist # Use autocorrected artist
-        vars_album["album"] = scrobble.album
-        if scrobble.album_mbid:
-            vars_album["mbid"] = scrobble.album_mbid
-
-        album, album_mbid = lastfm_autocorrect_get(vars_album, "album")
-
-    # Replace original data with the autocorrected data
-    scrobble.artist = artist
-    scrobble.artist_mbid = artist_mbid
-    scrobble.track = track
-    scrobble.track_mbid = track_mbid
-    if scrobble.album or scrobble.album_mbid:
-        scrobble.album = album
-        scrobble.album_mbid = album_mbid
+    return urlvars
+
+# Look up autocorrected name and MBID, without the cache
+# Returns (name, mbid, error), where error is None for successful lookups and
+# the reason if Last.FM doesn't know the name (error 6), or None if the lookup
+# failed otherwise (e.g. the API kept failing after all the retries), which
+# says nothing about the name and mustn't be cached.
+def lastfm_autocorrect_lookup(urlvars, a_type):
+    try:
+        data = url_get(BASEURL, urlvars)
+        res = json.loads(data)
+    except LastfmError as e:
+        res = {"error" : e.code, "message" : e.message}
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+    try:
+        name = res[a_type]["name"]
+        if "mbid" in res[a_type]:
+            mbid = res[a_type]["mbid"]
+        else:
+            mbid = ""
+    except Exception:
+        if not isinstance(res, dict) or res.get("error") != 6:
+            return None
+        return None, None, lastfm_error(res) or "not found"
+
+    return name, mbid, None
+
+# Look up autocorrect keys (see db_autocorrect_get()) concurrently, by
+# a pool of --jobs workers
+# Yields (key, result of lastfm_autocorrect_lookup()) in the order of the
+# keys. Only a limited window of lookups is in flight at once, like in
+# lastfm_get_pages().
+def lastfm_autocorrect_many(keys):
+    def lookup(key):
+        a_type, artist, name, mbid = key
+        if a_type == "artist":
+            artist = name
+        urlvars = lastfm_autocorrect_vars(a_type, artist, name, mbid)
+
+        return lastfm_autocorrect_lookup(urlvars, a_type)
+
+    keys = iter(keys)
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        def submit(count):
+            for key in itertools.islice(keys, count):
+                pending.append((key, pool.submit(lookup, key)))
+
+        try:
+            submit(args.jobs * 2)
+            while pending:
+                key, future = pending.popleft()
+                res = future.result()
+                submit(1)
+                yield key, res
+        finally:
+            for _, future in pending:
+                future.cancel()
 
 def lastfm_error(json):
     if "message" in json and json["message"]:
@@ -189,117 +660,749 @@ def lastfm_error(json):
         return None
 
 # Get a page of scrobbles from Last.FM
-def lastfm_get_scrobbles(username, page, scrobble_type):
+# The window is a (from, to) pair of timestamps limiting the time range of
+# returned scrobbles (None means unlimited), Last.FM supports it only for
+# recenttracks.
+def lastfm_get_scrobbles(username, page, scrobble_type, window=(None, None),
+        limit=200):
     urlvars = {
         "api_key" : API_KEY,
         "format"  : "json",
-        "limit"   : 200, # Max limit is 200
+        "limit"   : limit, # Max limit is 200
         "method"  : "user.get{}".format(scrobble_type),
         "page"    : page,
         "user"    : username
     }
+    if window[0] is not None:
+        urlvars["from"] = window[0]
+    if window[1] is not None:
+        urlvars["to"] = window[1]
 
-    data = url_get(BASEURL, urlvars)
-    response = json.loads(data)
+    with profile.timer("download"):
+        data = url_get(BASEURL, urlvars)
+    with profile.timer("decode"):
+        response = json.loads(data)
 
     #print(json.dumps(response, indent=4))
     return response
 
-def lastfm_process_scrobbles(scrobble_page, scrobble_type):
-    for scb in scrobble_page[scrobble_type]["track"]:
+# Get pages 2..page_count of scrobbles from Last.FM, in order
+# With --jobs N the pages are downloaded concurrently by a pool of N workers,
+# but they're still yielded (and thus saved) one by one, in order. Only a
+# limited window of pages is in flight at once, so an early stop (incremental
+# backup) doesn't waste too many requests, and closing the generator cancels
+# all pending downloads.
+def lastfm_get_pages(username, page_count, scrobble_type, window=(None, None)):
+    pages = iter(range(2, page_count + 1))
+
+    if args.jobs <= 1:
+        for page in pages:
+            yield page, lastfm_get_scrobbles(username, page, scrobble_type,
+                    window)
+        return
+
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        def submit(count):
+            for page in itertools.islice(pages, count):
+                pending.append((page, pool.submit(lastfm_get_scrobbles,
+                    username, page, scrobble_type, window)))
+
         try:
-            if scb["@attr"]["nowplaying"]:
-                continue
-        except:
-            pass
-
-        # Loved tracks have the text info nested in a "name" tag
-        name_tag = "#text" if scrobble_type == "recenttracks" else "name"
-        scrobble = Scrobble(
-                ts=int(scb["date"]["uts"]),
-                artist=scb["artist"][name_tag],
-                artist_mbid=scb["artist"]["mbid"],
-                track=scb["name"],
-                track_mbid=scb["mbid"],
-                type=scrobble_type
-        )
+            submit(args.jobs * 2)
+            while pending:
+                page, future = pending.popleft()
+                res = future.result()
+                submit(1)
+                yield page, res
+        finally:
+            for _, future in pending:
+                future.cancel()
 
+# Get the registration timestamp of given user
+def lastfm_get_registered(username):
+    urlvars = {
+        "api_key" : API_KEY,
+        "format"  : "json",
+        "method"  : "user.getinfo",
+        "user"    : username
+    }
+
+    res = json.loads(url_get(BASEURL, urlvars))
+    try:
+        return int(res["user"]["registered"]["unixtime"])
+    except (KeyError, TypeError, ValueError):
+        # Last.FM (Audioscrobbler) started in 2002
+        return int(datetime(2002, 1, 1).timestamp())
+
+# Time windows
+# A window is a (from, to) pair of timestamps (None means unlimited). Windows
+# are inclusive on both ends everywhere in this script, the same as the
+# database counts them (see db_count()). Last.FM doesn't document whether its
+# from/to parameters include the ends, so:
+#  - backups (lastfm_get_windows()) make neighbouring windows overlap by two
+#    seconds, so every second is inside one of them whether the ends are
+#    included or not (scrobbles downloaded twice are stored once)
+#  - --verify compares exact counts, it finds out which ends Last.FM includes
+#    (see lastfm_get_range_ends()) and shifts the ends it excludes by
+#    a second (see lastfm_api_window())
+# --from and --to are passed to Last.FM as they are.
+
+# Get time windows of scrobbles to back up, newest first
+# Incremental backups ask only for scrobbles since the last backup (the window
+# starts at the last stored timestamp, so the last stored scrobble is returned
+# too and ends the processing as usual), --from/--to limit the range (a range
+# wholly before the last backup gets last_ts 0, see lastfm_process_user()) and
+# --window splits it into independent windows of given number of days.
+# Loved tracks can't be filtered by time, so they always use a single
+# unlimited window.
+def lastfm_get_windows(username, scrobble_type, last_ts):
+    if scrobble_type != "recenttracks":
+        return [(None, None)]
+
+    time_from = args.time_from
+    if last_ts and (time_from is None or time_from < last_ts):
+        time_from = last_ts
+    time_to = args.time_to
+
+    if not args.window:
+        return [(time_from, time_to)]
+
+    if time_from is None:
+        time_from = lastfm_get_registered(username)
+    if time_to is None:
+        time_to = int(time.time())
+
+    # Neighbouring windows overlap by two seconds (see Time windows above)
+    windows = []
+    length = max(int(args.window * 86400), 2)
+    end = time_to
+    while True:
+        start = max(time_from, end - length)
+        windows.append((start, end))
+        if start <= time_from:
+            break
+        end = start + 1
+
+    return windows
+
+# Get rows of the data table (see db_save_rows()) from a page of scrobbles
+# This runs for every single scrobble, so it builds the row tuples right away,
+# without any intermediate objects.
+def lastfm_page_rows(scrobble_page, scrobble_type):
+    # Loved tracks have the text info nested in a "name" tag
+    name_tag = "#text" if scrobble_type == "recenttracks" else "name"
+    rows = []
+    append = rows.append
+    for scb in scrobble_page[scrobble_type]["track"]:
+        attr = scb.get("@attr")
+        if attr and attr.get("nowplaying"):
+            continue
+
+        artist = scb["artist"]
         # Loved tracks usually don't contain album
-        if "album" in scb:
-            scrobble.album = scb["album"][name_tag]
-            scrobble.album_mbid = scb["album"]["mbid"]
+        album = scb.get("album")
+        if album:
+            append((int(scb["date"]["uts"]), artist[name_tag], artist["mbid"],
+                    scb["name"], scb["mbid"], album[name_tag], album["mbid"]))
+        else:
+            append((int(scb["date"]["uts"]), artist[name_tag], artist["mbid"],
+                    scb["name"], scb["mbid"], "", ""))
+
+    return rows
+
+# Back up all selected scrobble types of given user
+# Returns a {scrobble_type: (processed, stored)} summary.
+def lastfm_process_user(username):
+    db = db_open(args.dbname)
+    summary = {}
+
+    for scrobble_type in args.stypes:
+        processed = 0
+        stored = 0
+        uncommitted = 0
+        # Uncommitted rows keep the database locked while the next page is
+        # downloaded, so with other users backed up at the same time every
+        # page is committed right away, otherwise their writers could wait
+        # for a slow download longer than the busy timeout (see db_open())
+        batch_size = args.batch_size
+        if len(args.usernames) > 1 and args.parallel_users > 1:
+            batch_size = 1
+
+        db_init(db, username, scrobble_type, args.drop)
+        last_ts = db_get_last_ts(db, username, scrobble_type)
+        new_last_ts = last_ts
+        # A --to before the last backup is a backfill of the past, which
+        # neither starts nor stops at the last stored scrobble (scrobbles
+        # stored already are stored once)
+        cut_ts = last_ts
+        if args.time_to is not None and args.time_to < last_ts:
+            cut_ts = 0
+        windows = lastfm_get_windows(username, scrobble_type, cut_ts)
+
+        printu(username, "[Backup] User: {}, type: {}".format(username,
+            scrobble_type))
+        start = time.monotonic()
+        pages_done = 0
+        pages_total = 0
+        for window in windows:
+            if len(windows) > 1:
+                printu(username, "[Window] {} - {}".format(
+                    datetime.fromtimestamp(window[0]),
+                    datetime.fromtimestamp(window[1])))
+
+            end = False
+            res = lastfm_get_scrobbles(username, 1, scrobble_type, window)
+            page_count = int(res[scrobble_type]["@attr"]["totalPages"])
+            pages_total += page_count
+            # The first page is already downloaded, the rest is fetched
+            # lazily, i.e. only when the first page doesn't end the processing
+            first_page = [(1, res)] if page_count else []
+            with contextlib.closing(lastfm_get_pages(username, page_count,
+                    scrobble_type, window)) as pages:
+                waited = time.perf_counter()
+                for page, res in itertools.chain(first_page, pages):
+                    page_start = time.perf_counter()
+                    profile.add("wait", page_start - waited)
+                    rows = lastfm_page_rows(res, scrobble_type)
+                    # Check if the processed track is already in the DB.
+                    # If so, end the processing, as the remaining tracks
+                    # were already saved
+                    cut = next((i for i, row in enumerate(rows)
+                            if row[0] <= cut_ts), None)
+                    if cut is not None:
+                        rows = rows[:cut]
+                        end = True
+                        printu(username, "Found track from the last "
+                                "backup, skipping the rest.")
+
+                    if rows:
+                        new_last_ts = max(new_last_ts,
+                                max(row[0] for row in rows))
+                    if args.verbose:
+                        for n, row in enumerate(rows, processed + 1):
+                            printu(username, "[Scrobble #{}]\n{}\n"
+                                    .format(n, Scrobble.from_row(row)))
+                    processed += len(rows)
+
+                    written = time.perf_counter()
+                    profile.add("process", written - page_start)
 
-        if args.autocorrect:
+                    page_stored = db_save_rows(db, rows, username,
+                            scrobble_type)
+                    stored += page_stored
+                    uncommitted += len(rows)
+                    if uncommitted >= batch_size:
+                        db.commit()
+                        uncommitted = 0
+                    profile.add("db_write", time.perf_counter() - written)
+                    profile.page(len(rows), page_stored)
+                    pages_done += 1
+
+                    printu(username, "[Stats] pages: {}/{}, processed: {} "
+                            "tracks, stored: {} tracks, {}"
+                            .format(page, page_count, processed, stored,
+                                progress(start, pages_done, pages_total,
+                                    processed)))
+                    if end:
+                        break
+                    waited = time.perf_counter()
+
+            if end:
+                break
+
+        # Move the watermark only after the whole backup is saved, so an
+        # interrupted backup is resumed by the next run instead of being
+        # skipped as already done. A backup of a limited time range moves it
+        # only if the range continues right after the last backup, up to now.
+        if args.time_to is None and (args.time_from is None
+                or args.time_from <= last_ts):
+            db_set_last_ts(db, username, scrobble_type, new_last_ts)
+        db.commit()
+        summary[scrobble_type] = (processed, stored)
+
+    # Autocorrect only after the backup, so it doesn't slow the download down
+    if args.autocorrect:
+        db_enrich(db, [(username, t) for t in args.stypes])
+
+    db.close()
+
+    return summary
+
+# Back up all given users
+# Up to --parallel-users users are backed up concurrently, each of them with
+# its own database connection, but all of them share the HTTP connection pool
+# and the request rate limit. A failed user doesn't stop the others, all
+# failures are reported in the final summary.
+def lastfm_process():
+    if len(args.usernames) == 1:
+        lastfm_process_user(args.usernames[0])
+        return True
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.parallel_users) as pool:
+        futures = {pool.submit(lastfm_process_user, username) : username
+                   for username in args.usernames}
+        for future in concurrent.futures.as_completed(futures):
+            username = futures[future]
             try:
-                lastfm_autocorrect(scrobble)
+                results[username] = future.result()
             except Exception as e:
-                sys.stderr.write(str(e) + "\n")
+                sys.stderr.write("[{}] Backup failed: {}\n".format(username, e))
+                results[username] = e
 
-        yield scrobble
+    failed = 0
+    print("[Summary]")
+    for username in args.usernames:
+        res = results[username]
+        if isinstance(res, Exception):
+            failed += 1
+            print("\t{}: FAILED ({})".format(username, res))
+        else:
+            print("\t{}: {}".format(username, "; ".join(
+                "{}: processed {}, stored {}".format(t, *res[t])
+                for t in args.stypes)))
+    print("\tusers: {}, failed: {}".format(len(args.usernames), failed))
 
-def lastfm_process():
-    db = sqlite3.connect(args.dbname)
+    return failed == 0
+
+# Get the currently playing track from a page of recent tracks, as an
+# (artist, track, album) tuple, or None if nothing is playing
+def lastfm_page_nowplaying(scrobble_page):
+    for scb in scrobble_page["recenttracks"]["track"][:1]:
+        attr = scb.get("@attr")
+        if attr and attr.get("nowplaying"):
+            return (scb["artist"]["#text"], scb["name"],
+                    (scb.get("album") or {}).get("#text", ""))
+
+    return None
+
+# Save scrobbles of given window newer than last_ts, starting with an already
+# downloaded first page of the window (see lastfm_watch() and lastfm_verify())
+# The rest of the pages is downloaded only when the first page doesn't reach
+# last_ts, e.g. when a watched user scrobbled more than a page since the last
+# poll. Returns the number of stored scrobbles and the new watermark, the
+# scrobbles are not committed.
+def lastfm_save_window(db, username, scrobble_type, res, window, last_ts):
+    stored = 0
+    new_last_ts = last_ts
+    page_count = int(res[scrobble_type]["@attr"]["totalPages"])
+    first_page = [(1, res)] if page_count else []
+    with contextlib.closing(lastfm_get_pages(username, page_count,
+            scrobble_type, window)) as pages:
+        for page, res in itertools.chain(first_page, pages):
+            rows = lastfm_page_rows(res, scrobble_type)
+            cut = next((i for i, row in enumerate(rows)
+                    if row[0] <= last_ts), None)
+            if cut is not None:
+                rows = rows[:cut]
+            page_stored = 0
+            if rows:
+                new_last_ts = max(new_last_ts, max(row[0] for row in rows))
+                page_stored = db_save_rows(db, rows, username, scrobble_type)
+                stored += page_stored
+            profile.page(len(rows), page_stored)
+            if cut is not None:
+                break
+
+    return stored, new_last_ts
+
+# Keep backups of all given users current (--watch)
+# After a regular (catch-up) backup, a single process polls the first page
+# of every user and scrobble type since its last stored scrobble and saves
+# new scrobbles right away, over a single database connection. Each of them
+# is polled on its own interval: --watch-interval while the user is active
+# (has scrobbled since the last poll, or is playing something), doubled after
+# every idle poll up to --watch-max. The currently playing track comes with
+# the same page of recent tracks and is kept in the now_playing table (see
+# lyrics.php). Runs until interrupted (SIGINT or SIGTERM).
+def lastfm_watch():
+    try:
+        ok = lastfm_process()
+    except Exception as e:
+        sys.stderr.write("[Watch] Catch-up backup failed: {}\n".format(e))
+        ok = False
+    if not ok:
+        sys.stderr.write("[Watch] Watching anyway, failed users are caught "
+                "up by their polls\n")
+
+    db = db_open(args.dbname)
+    db_nowplaying_init(db)
+    state = {}
+    schedule = []
+    for n, (username, scrobble_type) in enumerate(itertools.product(
+            args.usernames, args.stypes)):
+        db_init(db, username, scrobble_type)
+        state[(username, scrobble_type)] = {
+            # --force applies only to the catch-up backup
+            "last_ts"  : db_get_last_ts(db, username, scrobble_type,
+                force=False),
+            "interval" : args.watch_interval
+        }
+        # Spread the first polls over the interval, so they don't come
+        # all at once
+        schedule.append((time.monotonic() + args.watch_interval * n /
+            (len(args.usernames) * len(args.stypes)), username, scrobble_type))
+    heapq.heapify(schedule)
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop.set())
+
+    print("[Watch] Watching {} user(s), polling every {}-{}s".format(
+        len(args.usernames), args.watch_interval, args.watch_max))
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.parallel_users) as pool:
+        while not stop.is_set():
+            now = time.monotonic()
+            if schedule[0][0] > now:
+                stop.wait(schedule[0][0] - now)
+                continue
+
+            futures = {}
+            while schedule and schedule[0][0] <= now:
+                _, username, scrobble_type = heapq.heappop(schedule)
+                window = lastfm_get_windows(username, scrobble_type,
+                        state[(username, scrobble_type)]["last_ts"])[0]
+                futures[pool.submit(lastfm_get_scrobbles, username, 1,
+                    scrobble_type, window)] = (username, scrobble_type, window)
+
+            for future in concurrent.futures.as_completed(futures):
+                username, scrobble_type, window = futures[future]
+                st = state[(username, scrobble_type)]
+                active = False
+                try:
+                    res = future.result()
+                    stored, st["last_ts"] = lastfm_save_window(db, username,
+                            scrobble_type, res, window, st["last_ts"])
+                    db_set_last_ts(db, username, scrobble_type, st["last_ts"])
+                    if scrobble_type == "recenttracks":
+                        playing = lastfm_page_nowplaying(res)
+                        if db_nowplaying_set(db, username, playing):
+                            printu(username, "[Watch] Now playing: {}".format(
+                                "{} - {}".format(*playing) if playing
+                                else "nothing"))
+                        active = playing is not None
+                    db.commit()
+                    if stored:
+                        active = True
+                        printu(username, "[Watch] {}: {} new tracks".format(
+                            scrobble_type, stored))
+                        if args.autocorrect:
+                            db_enrich(db, [(username, scrobble_type)])
+                except Exception as e:
+                    db.rollback()
+                    sys.stderr.write("[{}] Poll failed: {}\n".format(username,
+                        e))
+
+                st["interval"] = args.watch_interval if active \
+                        else min(args.watch_max, st["interval"] * 2)
+                printv("[Watch] {}_{}: next poll in {}s".format(username,
+                    scrobble_type, st["interval"]))
+                heapq.heappush(schedule, (time.monotonic() + st["interval"],
+                    username, scrobble_type))
+
+    print("[Watch] Stopped")
+    db.close()
+
+# Get the number of scrobbles of given window reported by Last.FM
+# Only the total is needed, so the page has just a single track.
+def lastfm_get_total(username, scrobble_type, window=(None, None)):
+    res = lastfm_get_scrobbles(username, 1, scrobble_type, window, limit=1)
+    return int(res[scrobble_type]["@attr"]["total"])
+
+# Find out which ends of a from/to range Last.FM includes (see Time windows)
+# It's probed with ranges ending at the newest (t) and the oldest (u) stored
+# scrobble, whose neighbouring seconds t + 1 and u - 1 have none: (t, t + 1)
+# contains t only if the start is included, (u - 1, u) contains u only if the
+# end is. Both ends are assumed to be included if there are no scrobbles
+# stored, or Last.FM doesn't have those (ranges around them are empty).
+# Returns a (from included, to included) pair.
+def lastfm_get_range_ends(db, username, scrobble_type):
+    cur = db.cursor()
+    cur.execute("SELECT MAX(timestamp), MIN(timestamp) FROM {}_{}"
+            .format(username, scrobble_type))
+    t, u = cur.fetchone()
+    if t is None:
+        return True, True
+
+    totals = [lastfm_get_total(username, scrobble_type, window) for window in
+            ((t - 1, t + 1), (u - 1, u + 1), (t, t + 1), (u - 1, u))]
+    if not totals[0] or not totals[1]:
+        return True, True
+
+    return totals[2] > 0, totals[3] > 0
+
+# Get the from/to API parameters of an (inclusive) window, given which ends
+# Last.FM includes (see lastfm_get_range_ends())
+def lastfm_api_window(window, ends):
+    if window[0] is None:
+        return window
+
+    return (window[0] if ends[0] else window[0] - 1,
+            window[1] if ends[1] else window[1] + 1)
+
+# Format a time window for the --verify report
+def verify_window_str(window):
+    if window[0] is None:
+        return "all"
+
+    return "{} - {}".format(datetime.fromtimestamp(window[0]),
+            datetime.fromtimestamp(window[1]))
+
+# Find and repair gaps in the backup of given user (--verify)
+# The stored scrobbles of each time window (--window days, a year by default)
+# are counted and compared with the total reported by Last.FM. A window with
+# missing scrobbles is bisected (both halves are counted again) until it
+# fits into a couple of pages, or has nothing stored at all, and only then
+# downloaded again, so a few missing pages cost a few dozen requests instead
+# of a --force re-download of the whole history. Windows are inclusive on both
+# ends, neighbouring windows don't overlap, and they're passed to Last.FM
+# according to the ends of ranges it includes (see Time windows), so both
+# sides count exactly the same scrobbles. Loved tracks can't be filtered by
+# time, they're all downloaded again when some are missing.
+# Windows with more stored scrobbles than Last.FM reports (deleted there) are
+# only reported, as well as gaps which can't be repaired (e.g. more scrobbles
+# with the same timestamp, which the database stores only once). Returns
+# False if any of those were found.
+def lastfm_verify_user(username):
+    db = db_open(args.dbname)
+    ok = True
 
     for scrobble_type in args.stypes:
-        processed = 0
-        stored = 0
-        page = 1
-        end = False
-        res = lastfm_get_scrobbles(args.username, page, scrobble_type)
-        page_count = int(res[scrobble_type]["@attr"]["totalPages"])
-
-        db_init(db, args.username, scrobble_type, args.drop)
-        last_ts = db_get_last_ts(db, args.username, scrobble_type)
-
-        print("[Backup] User: {}, type: {}".format(args.username, scrobble_type))
-        while page <= page_count and not end:
-            for scrobble in lastfm_process_scrobbles(res, scrobble_type):
-                # Check if the processed track is already in the DB.
-                # If so, end the processing, as the remaining tracks
-                # were already saved
-                if scrobble.ts <= last_ts:
-                    end = True
-                    print("Found track from the last backup, skipping the rest.")
-                    break
-
-                rv = db_save_scrobble(db, scrobble, args.username)
-                stored += rv
-                processed += 1
-                printv("[Scrobble #{}]\n{}\n".format(processed, scrobble))
-
-            print("[Stats] pages: {}/{}, processed: {} tracks, stored: {} tracks"
-                    .format(page, page_count, processed, stored))
-            page += 1
-            res = lastfm_get_scrobbles(args.username, page, scrobble_type)
+        db_init(db, username, scrobble_type)
+        requests_before = sum(profile.requests.values())
+        if scrobble_type == "recenttracks":
+            time_from = args.time_from
+            if time_from is None:
+                time_from = lastfm_get_registered(username)
+            time_to = args.time_to
+            if time_to is None:
+                time_to = int(time.time())
+            length = int((args.window or 365) * 86400)
+            level = [(start, min(start + length - 1, time_to))
+                    for start in range(time_from, time_to + 1, length)]
+            ends = lastfm_get_range_ends(db, username, scrobble_type)
+            printv("[Verify] Last.FM ranges include their start: {}, end: {}"
+                    .format(*ends))
+        else:
+            level = [(None, None)]
+            ends = (True, True)
+
+        printu(username, "[Verify] User: {}, type: {}".format(username,
+            scrobble_type))
+        checked = 0
+        missing = 0
+        repaired = 0
+        unresolved = 0
+        # Windows of the same bisection level are counted concurrently
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=args.jobs) as pool:
+            while level:
+                totals = list(pool.map(lambda window: lastfm_get_total(
+                    username, scrobble_type, lastfm_api_window(window, ends)),
+                    level))
+                checked += len(level)
+                next_level = []
+                for window, expected in zip(level, totals):
+                    found = db_count(db, username, scrobble_type, window)
+                    if found > expected:
+                        printu(username, "[Verify] {}: {} more tracks stored "
+                                "than on Last.FM".format(
+                                    verify_window_str(window),
+                                    found - expected))
+                        ok = False
+                    if found >= expected:
+                        continue
+
+                    if window[0] is not None and window[0] < window[1] and \
+                            found and expected > 400:
+                        mid = (window[0] + window[1]) // 2
+                        next_level += [(window[0], mid), (mid + 1, window[1])]
+                        continue
+
+                    api_window = lastfm_api_window(window, ends)
+                    res = lastfm_get_scrobbles(username, 1, scrobble_type,
+                            api_window)
+                    stored = lastfm_save_window(db, username, scrobble_type,
+                            res, api_window, 0)[0]
+                    db.commit()
+                    missing += expected - found
+                    repaired += stored
+                    printu(username, "[Repair] {}: Last.FM: {}, stored: {}, "
+                            "repaired: {}".format(verify_window_str(window),
+                                expected, found, stored))
+                    if found + stored < expected:
+                        unresolved += expected - found - stored
+                        printu(username, "[Verify] {}: {} tracks can't be "
+                                "repaired".format(verify_window_str(window),
+                                    expected - found - stored))
+                        ok = False
+                level = next_level
+
+        # A complete backup (e.g. a repaired interrupted first sync) can
+        # continue incrementally from its newest scrobble
+        if scrobble_type == "recenttracks" and not unresolved and \
+                args.time_to is None:
+            cur = db.cursor()
+            cur.execute("SELECT MAX(timestamp) FROM {}_{}".format(username,
+                scrobble_type))
+            db_set_last_ts(db, username, scrobble_type, cur.fetchone()[0] or 0)
+            db.commit()
+
+        printu(username, "[Verify] {}: {} windows checked, {} requests, "
+                "missing: {} tracks, repaired: {} tracks, unresolved: {} "
+                "tracks".format(scrobble_type, checked,
+                    sum(profile.requests.values()) - requests_before, missing,
+                    repaired, unresolved))
 
     db.close()
 
+    return ok
+
+# Verify backups of all given users, return False if any of them has gaps
+# which couldn't be repaired
+def lastfm_verify():
+    ok = True
+    for username in args.usernames:
+        ok = lastfm_verify_user(username) and ok
+
+    return ok
+
+# Open the database
+# The WAL journal allows reading the database (--stats, --export) while
+# a backup is running, the synchronous level trades the durability of the last
+# committed batch for speed (a crash never corrupts the database itself).
+def db_open(dbname):
+    # Wait for other writers when backing up multiple users at once
+    db = sqlite3.connect(dbname, timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous={}".format(args.synchronous))
+
+    return db
+
 # Initialize database (create a data table if it doesn't exist)
+# In a normalized database (see db_init_normalized()) the data table is a view
+# of the user's scrobbles of given type, with the same columns as the plain
+# data table.
 def db_init(db, username, scrobble_type, drop=False):
     cur = db.cursor()
+    # A dropped table keeps its (emptied) search index
+    indexed = drop and db_search_exists(db,
+            "{}_{}".format(username, scrobble_type))
+    if args.normalized and not db_is_normalized(db):
+        if db_legacy_tables(db):
+            raise Exception("The database contains per-user tables, "
+                    "use --migrate to normalize it")
+        db_init_normalized(db)
+
+    if db_is_normalized(db):
+        user_id = db_user_id(db, username)
+        if drop:
+            cur.execute("DELETE FROM scrobbles WHERE user_id = ? AND type = ?",
+                    (user_id, SCROBBLE_TYPES[scrobble_type]))
+        db_create_view(db, username, scrobble_type)
+    else:
+        if drop:
+            cur.execute("DROP TABLE IF EXISTS {}_{}"
+                    .format(username, scrobble_type))
+
+        cur.execute("CREATE TABLE IF NOT EXISTS {}_{}("
+                "timestamp INTEGER PRIMARY KEY,"
+                "artist DATA NOT NULL,"
+                "artist_mbid DATA,"
+                "track DATA NOT NULL,"
+                "track_mbid DATA,"
+                "album DATA,"
+                "album_mbid DATA)".format(username, scrobble_type))
+    # Timestamp of the newest scrobble of the last finished backup of each
+    # data table
+    cur.execute("CREATE TABLE IF NOT EXISTS backup_state("
+            "name TEXT PRIMARY KEY,"
+            "last_ts INTEGER NOT NULL)")
+    # Autocorrect results shared by all users, see db_autocorrect_get()
+    cur.execute("CREATE TABLE IF NOT EXISTS autocorrect_cache("
+            "type TEXT NOT NULL,"
+            "artist TEXT NOT NULL,"
+            "name TEXT NOT NULL,"
+            "mbid TEXT NOT NULL,"
+            "corrected_name TEXT,"
+            "corrected_mbid TEXT,"
+            "error TEXT,"
+            "updated INTEGER NOT NULL,"
+            "PRIMARY KEY(type, artist, name, mbid))")
     if drop:
-        cur.execute("DROP TABLE IF EXISTS {}_{}".format(username, scrobble_type))
-
-    cur.execute("CREATE TABLE IF NOT EXISTS {}_{}("
-            "timestamp INTEGER PRIMARY KEY,"
-            "artist DATA NOT NULL,"
-            "artist_mbid DATA,"
-            "track DATA NOT NULL,"
-            "track_mbid DATA,"
-            "album DATA,"
-            "album_mbid DATA)".format(username, scrobble_type))
+        cur.execute("DELETE FROM backup_state WHERE name = ?",
+                ("{}_{}".format(username, scrobble_type),))
+        db_analytics_clear(db, "{}_{}".format(username, scrobble_type))
+    db_stats_init(db, username, scrobble_type, drop)
+    if indexed:
+        db_search_init(db, username, scrobble_type)
+
+    # A new (empty) table starts with a zero watermark, tables created before
+    # the backup_state table was introduced fall back to their newest
+    # timestamp in db_get_last_ts()
+    cur.execute("SELECT 1 FROM {}_{} LIMIT 1".format(username, scrobble_type))
+    if not cur.fetchone():
+        cur.execute("INSERT OR IGNORE INTO backup_state VALUES(?, 0)",
+                ("{}_{}".format(username, scrobble_type),))
     db.commit()
 
+# Currently playing tracks of watched users (see lastfm_watch())
+# A user has a row only while playing something, since is the time the track
+# was first seen playing and updated the time of the last poll, so readers
+# can tell a stale row of a stopped watch.
+def db_nowplaying_init(db):
+    db.execute("CREATE TABLE IF NOT EXISTS now_playing("
+            "username TEXT PRIMARY KEY,"
+            "artist TEXT NOT NULL,"
+            "track TEXT NOT NULL,"
+            "album TEXT,"
+            "since INTEGER NOT NULL,"
+            "updated INTEGER NOT NULL)")
+    db.commit()
+
+# Save the currently playing (artist, track, album) of given user, or None,
+# and return True if it changed
+# The change is committed by the caller.
+def db_nowplaying_set(db, username, playing):
+    now = int(time.time())
+    cur = db.cursor()
+    cur.execute("SELECT artist, track, album FROM now_playing "
+            "WHERE username = ?", (username,))
+    res = cur.fetchone()
+    if playing is None:
+        cur.execute("DELETE FROM now_playing WHERE username = ?", (username,))
+    elif res == playing:
+        cur.execute("UPDATE now_playing SET updated = ? WHERE username = ?",
+                (now, username))
+    else:
+        cur.execute("INSERT OR REPLACE INTO now_playing VALUES(?, ?, ?, ?, ?, ?)",
+                (username,) + playing + (now, now))
+
+    return res != playing
+
 # Get the last timestamp from given db/table combination
 # This timestamp is used to find the end of the previous backup, to create
 # an incremental backup instead of another full one. This behavior can
 # be overridden using --force option.
-def db_get_last_ts(db, username, scrobble_type):
+# With --force, all tracks are downloaded again, unless the watermark is read
+# with force=False (e.g. by --watch, once its catch-up backup is done)
+def db_get_last_ts(db, username, scrobble_type, force=None):
+    if force is None:
+        force = args.force
     # We want to re-download all tracks
-    if args.force:
+    if force:
         return 0
 
     cur = db.cursor()
+    cur.execute("SELECT last_ts FROM backup_state WHERE name = ?",
+            ("{}_{}".format(username, scrobble_type),))
+    res = cur.fetchone()
+    if res:
+        return res[0]
+
     cur.execute("SELECT timestamp FROM {}_{} ORDER BY timestamp DESC LIMIT 1"
             .format(username, scrobble_type))
     res = cur.fetchone()
@@ -308,87 +1411,1588 @@ def db_get_last_ts(db, username, scrobble_type):
     else:
         return 0
 
-# Save the given track into the DB
-def db_save_scrobble(db, scrobble, username):
+# Save the timestamp of the newest backed up scrobble (the watermark never
+# moves back, even after a --force backup)
+# The change is committed by the caller, together with the last batch of
+# scrobbles.
+def db_set_last_ts(db, username, scrobble_type, last_ts):
+    name = "{}_{}".format(username, scrobble_type)
+    cur = db.cursor()
+    cur.execute("SELECT last_ts FROM backup_state WHERE name = ?", (name,))
+    res = cur.fetchone()
+    if res:
+        last_ts = max(last_ts, res[0])
+
+    cur.execute("INSERT OR REPLACE INTO backup_state VALUES(?, ?)",
+            (name, last_ts))
+
+# Get the number of stored scrobbles of given time window (inclusive)
+def db_count(db, username, scrobble_type, window=(None, None)):
+    cur = db.cursor()
+    cur.execute("SELECT COUNT(*) FROM {}_{} WHERE timestamp BETWEEN ? AND ?"
+            .format(username, scrobble_type), (window[0] or 0,
+                window[1] if window[1] is not None else 1 << 62))
+
+    return cur.fetchone()[0]
+
+# Save the given tracks (rows in the data table format, see Scrobble.row())
+# into the DB and return the number of stored tracks
+# The tracks are not committed, it's up to the caller to commit them in
+# reasonably large batches.
+def db_save_rows(db, rows, username, scrobble_type):
+    if db_is_normalized(db):
+        stored = db_save_rows_normalized(db, rows, username, scrobble_type)
+    else:
+        # The row count doesn't include changes made by triggers
+        cur = db.executemany("INSERT OR IGNORE INTO {}_{} "
+                "VALUES(?, ?, ?, ?, ?, ?, ?)".format(username, scrobble_type),
+                rows)
+        stored = max(cur.rowcount, 0)
+    if stored:
+        db_export_rewind(db, "{}_{}".format(username, scrobble_type),
+                min(row[0] for row in rows))
+
+    return stored
+
+# Normalized database schema
+# Artist, track and album names and MBIDs are stored only once, in the
+# dimension tables (see DIMENSIONS), and all scrobbles of all users are stored
+# in a single table referencing them by their integer IDs. Data tables of the
+# plain schema are replaced by views with the same name and columns, so
+# reading them (--export, --stats) works the same way for both schemas.
+def db_init_normalized(db):
+    cur = db.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS users("
+            "id INTEGER PRIMARY KEY,"
+            "name TEXT NOT NULL UNIQUE)")
+    cur.execute("CREATE TABLE IF NOT EXISTS artists("
+            "id INTEGER PRIMARY KEY,"
+            "name TEXT NOT NULL,"
+            "mbid TEXT NOT NULL,"
+            "UNIQUE(name, mbid))")
+    for table in ("tracks", "albums"):
+        cur.execute("CREATE TABLE IF NOT EXISTS {}("
+                "id INTEGER PRIMARY KEY,"
+                "artist_id INTEGER NOT NULL REFERENCES artists(id),"
+                "name TEXT NOT NULL,"
+                "mbid TEXT NOT NULL,"
+                "UNIQUE(artist_id, name, mbid))".format(table))
+    cur.execute("CREATE TABLE IF NOT EXISTS scrobbles("
+            "user_id INTEGER NOT NULL REFERENCES users(id),"
+            "type INTEGER NOT NULL,"
+            "timestamp INTEGER NOT NULL,"
+            "track_id INTEGER NOT NULL REFERENCES tracks(id),"
+            "album_id INTEGER REFERENCES albums(id),"
+            "PRIMARY KEY(user_id, type, timestamp)) WITHOUT ROWID")
+    cur.execute("CREATE INDEX IF NOT EXISTS scrobbles_track "
+            "ON scrobbles(track_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS scrobbles_album "
+            "ON scrobbles(album_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS tracks_artist "
+            "ON tracks(artist_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS albums_artist "
+            "ON albums(artist_id)")
+
+    # All scrobbles of all users share a single statistics trigger
+    type_name = "CASE NEW.type {} END".format(" ".join(
+            "WHEN {} THEN '{}'".format(i, t) for t, i in SCROBBLE_TYPES.items()))
+    artist = "(SELECT ar.{} FROM tracks AS t JOIN artists AS ar " \
+             "ON ar.id = t.artist_id WHERE t.id = NEW.track_id)"
+    db_stats_tables(db)
+    db_stats_trigger(db, "scrobbles_stats", "scrobbles",
+            "((SELECT name FROM users WHERE id = NEW.user_id) || '_' || {})"
+            .format(type_name), {
+            "artist"      : artist.format("name"),
+            "artist_mbid" : artist.format("mbid"),
+            "track"       : "(SELECT name FROM tracks WHERE id = NEW.track_id)",
+            "track_mbid"  : "(SELECT mbid FROM tracks WHERE id = NEW.track_id)",
+            "album"       : "COALESCE((SELECT name FROM albums "
+                            "WHERE id = NEW.album_id), '')",
+            "album_mbid"  : "COALESCE((SELECT mbid FROM albums "
+                            "WHERE id = NEW.album_id), '')"
+    })
+
+def db_is_normalized(db):
+    cur = db.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'scrobbles'")
+
+    return cur.fetchone() is not None
+
+# Get names of all data tables of the plain schema
+def db_legacy_tables(db):
+    cur = db.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+
+    return [row[0] for row in cur if re.match(
+            r"^[a-zA-Z][a-zA-Z0-9\-_]+_(recenttracks|lovedtracks)$", row[0])]
+
+def db_user_id(db, username):
+    cur = db.cursor()
+    cur.execute("INSERT OR IGNORE INTO users(name) VALUES(?)", (username,))
+    cur.execute("SELECT id FROM users WHERE name = ?", (username,))
+
+    return cur.fetchone()[0]
+
+# Get an ID of given artist/track/album (see DIMENSIONS), insert it if it's
+# not in the table yet
+def db_intern(db, cache, table, key):
+    id = cache.get((table, key))
+    if id is not None:
+        return id
+
+    columns = DIMENSIONS[table]
+    cur = db.cursor()
+    cur.execute("SELECT id FROM {} WHERE {}".format(table,
+            " AND ".join("{} = ?".format(c) for c in columns)), key)
+    res = cur.fetchone()
+    if res:
+        id = res[0]
+    else:
+        cur.execute("INSERT INTO {}({}) VALUES({})".format(table,
+                ", ".join(columns), ", ".join("?" for c in columns)), key)
+        id = cur.lastrowid
+    cache[(table, key)] = id
+
+    return id
+
+# Save rows in the plain data table format into the normalized tables and
+# return the number of stored rows
+def db_save_rows_normalized(db, rows, username, scrobble_type, cache=None):
+    if cache is None:
+        cache = {}
+    user_id = db_user_id(db, username)
+    type_id = SCROBBLE_TYPES[scrobble_type]
+
+    scrobbles = []
+    for ts, artist, artist_mbid, track, track_mbid, album, album_mbid in rows:
+        artist_id = db_intern(db, cache, "artists",
+                (artist, artist_mbid or ""))
+        track_id = db_intern(db, cache, "tracks",
+                (artist_id, track, track_mbid or ""))
+        if album or album_mbid:
+            album_id = db_intern(db, cache, "albums",
+                    (artist_id, album or "", album_mbid or ""))
+        else:
+            album_id = None
+        scrobbles.append((user_id, type_id, ts, track_id, album_id))
+
+    cur = db.executemany("INSERT OR IGNORE INTO scrobbles VALUES(?, ?, ?, ?, ?)",
+            scrobbles)
+
+    return max(cur.rowcount, 0)
+
+# Create a view of given user's scrobbles of given type with the columns of
+# the plain data table
+def db_create_view(db, username, scrobble_type):
+    db.execute("CREATE VIEW IF NOT EXISTS {0}_{1} AS SELECT "
+            "s.timestamp AS timestamp,"
+            "ar.name AS artist,"
+            "ar.mbid AS artist_mbid,"
+            "t.name AS track,"
+            "t.mbid AS track_mbid,"
+            "COALESCE(al.name, '') AS album,"
+            "COALESCE(al.mbid, '') AS album_mbid "
+            "FROM scrobbles AS s "
+            "JOIN tracks AS t ON t.id = s.track_id "
+            "JOIN artists AS ar ON ar.id = t.artist_id "
+            "LEFT JOIN albums AS al ON al.id = s.album_id "
+            "WHERE s.user_id = (SELECT id FROM users WHERE name = '{0}') "
+            "AND s.type = {2}"
+            .format(username, scrobble_type, SCROBBLE_TYPES[scrobble_type]))
+
+# Convert all data tables of the plain schema into the normalized schema
+# Every table is converted in a single transaction and replaced by a view.
+def db_migrate():
+    db = db_open(args.dbname)
+    db_init_normalized(db)
+    db.commit()
+
+    for table in db_legacy_tables(db):
+        username, scrobble_type = table.rsplit("_", 1)
+        print("[Migrate] {}".format(table))
+        # Statistics are rebuilt by the trigger of the normalized table
+        db_stats_clear(db, table)
+        cache = {}
+        migrated = 0
+        cur = db.cursor()
+        cur.execute("SELECT timestamp, artist, artist_mbid, track, track_mbid,"
+                "album, album_mbid FROM {}".format(table))
+        while True:
+            rows = cur.fetchmany(10000)
+            if not rows:
+                break
+            migrated += db_save_rows_normalized(db, rows, username,
+                    scrobble_type, cache)
+
+        indexed = db_search_exists(db, table)
+        if indexed:
+            db.execute("DROP TABLE {}_fts".format(table))
+        db.execute("DROP TABLE {}".format(table))
+        db_create_view(db, username, scrobble_type)
+        if indexed:
+            db_search_init(db, username, scrobble_type)
+        db.commit()
+        print("[Migrate] {}: {} tracks".format(table, migrated))
+
+    print("[Migrate] Compacting the database")
+    db.execute("VACUUM")
+    db.close()
+
+# Aggregated statistics
+# Statistics of every data table (identified by its name) are kept up to date
+# by triggers as the scrobbles are inserted, so reading them doesn't need to
+# scan the data table:
+#  - stats_totals: scrobble count, first/last timestamp and distinct value
+#    counts (see STATS_COLUMNS)
+#  - stats_values: play counts of each distinct artist, track, album and their
+#    MBIDs
+#  - stats_periods: play counts per day, week and month (see STATS_PERIODS)
+def db_stats_tables(db):
+    cur = db.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS stats_totals("
+            "name TEXT PRIMARY KEY,"
+            "scrobbles INTEGER NOT NULL DEFAULT 0,"
+            "first_ts INTEGER,"
+            "last_ts INTEGER,{})".format(",".join(
+                "{} INTEGER NOT NULL DEFAULT 0".format(c)
+                for c in STATS_COLUMNS.values())))
+    cur.execute("CREATE TABLE IF NOT EXISTS stats_values("
+            "name TEXT NOT NULL,"
+            "kind TEXT NOT NULL,"
+            "value TEXT NOT NULL,"
+            "plays INTEGER NOT NULL,"
+            "PRIMARY KEY(name, kind, value)) WITHOUT ROWID")
+    cur.execute("CREATE TABLE IF NOT EXISTS stats_periods("
+            "name TEXT NOT NULL,"
+            "period TEXT NOT NULL,"
+            "start TEXT NOT NULL,"
+            "plays INTEGER NOT NULL,"
+            "PRIMARY KEY(name, period, start)) WITHOUT ROWID")
+    # Every new distinct value increments the distinct count of its kind
+    cur.execute("CREATE TRIGGER IF NOT EXISTS stats_values_distinct "
+            "AFTER INSERT ON stats_values BEGIN "
+            "UPDATE stats_totals SET {} WHERE name = NEW.name; END"
+            .format(", ".join("{0} = {0} + (NEW.kind = '{1}')".format(c, k)
+                for k, c in STATS_COLUMNS.items())))
+
+# Create a trigger updating the statistics on every insert into given table
+# The name and columns are SQL expressions of the NEW row evaluating to the
+# data table name and the STATS_COLUMNS values.
+def db_stats_trigger(db, trigger, table, name, columns):
+    stmts = [
+        "INSERT OR IGNORE INTO stats_totals(name, first_ts, last_ts) "
+        "VALUES({0}, NEW.timestamp, NEW.timestamp)",
+        "UPDATE stats_totals SET scrobbles = scrobbles + 1,"
+        "first_ts = MIN(first_ts, NEW.timestamp),"
+        "last_ts = MAX(last_ts, NEW.timestamp) WHERE name = {0}"
+    ]
+    for kind in STATS_COLUMNS:
+        expr = columns[kind]
+        stmts.append("INSERT OR IGNORE INTO stats_values "
+                "SELECT {{0}}, '{0}', v, 0 FROM (SELECT {1} AS v) "
+                "WHERE v IS NOT NULL".format(kind, expr))
+        stmts.append("UPDATE stats_values SET plays = plays + 1 "
+                "WHERE name = {{0}} AND kind = '{0}' AND value = {1}"
+                .format(kind, expr))
+    for period, fmt in STATS_PERIODS.items():
+        start = "strftime('{}', NEW.timestamp, 'unixepoch', 'localtime')" \
+                .format(fmt)
+        stmts.append("INSERT OR IGNORE INTO stats_periods "
+                "VALUES({{0}}, '{0}', {1}, 0)".format(period, start))
+        stmts.append("UPDATE stats_periods SET plays = plays + 1 "
+                "WHERE name = {{0}} AND period = '{0}' AND start = {1}"
+                .format(period, start))
+
+    db.execute("CREATE TRIGGER IF NOT EXISTS {} AFTER INSERT ON {} BEGIN {}; END"
+            .format(trigger, table, "; ".join(stmts).format(name)))
+
+# Set up statistics of given data table (see db_stats_tables()), statistics
+# of tables with data inserted before the trigger existed are rebuilt
+def db_stats_init(db, username, scrobble_type, clear=False):
+    name = "{}_{}".format(username, scrobble_type)
+    db_stats_tables(db)
+    if clear:
+        db_stats_clear(db, name)
+    if db_is_normalized(db):
+        # Adds the trigger to databases normalized before it existed
+        db_init_normalized(db)
+    else:
+        db_stats_trigger(db, name + "_stats", name, "'{}'".format(name),
+                {c : "NEW." + c for c in STATS_COLUMNS})
+
+    cur = db.cursor()
+    cur.execute("SELECT 1 FROM stats_totals WHERE name = ?", (name,))
+    if cur.fetchone():
+        return
+    cur.execute("SELECT 1 FROM {} LIMIT 1".format(name))
+    if cur.fetchone():
+        db_stats_rebuild(db, username, scrobble_type)
+
+def db_stats_clear(db, name):
+    for table in ("stats_totals", "stats_values", "stats_periods"):
+        db.execute("DELETE FROM {} WHERE name = ?".format(table), (name,))
+
+# Recompute statistics of given data table from scratch
+def db_stats_rebuild(db, username, scrobble_type):
+    name = "{}_{}".format(username, scrobble_type)
+    db_stats_clear(db, name)
+    cur = db.cursor()
+    cur.execute("INSERT INTO stats_totals(name, scrobbles, first_ts, last_ts) "
+            "SELECT ?, COUNT(*), MIN(timestamp), MAX(timestamp) FROM {} "
+            "HAVING COUNT(*) > 0".format(name), (name,))
+    # Distinct value counts are updated by the stats_values trigger
+    for kind in STATS_COLUMNS:
+        cur.execute("INSERT INTO stats_values SELECT ?, ?, {0}, COUNT(*) "
+                "FROM {1} WHERE {0} IS NOT NULL GROUP BY {0}"
+                .format(kind, name), (name, kind))
+    for period, fmt in STATS_PERIODS.items():
+        cur.execute("INSERT INTO stats_periods SELECT ?, ?, "
+                "strftime(?, timestamp, 'unixepoch', 'localtime') AS start, "
+                "COUNT(*) FROM {} GROUP BY start".format(name),
+                (name, period, fmt))
+
+# Rebuild statistics of all selected users and scrobble types
+def db_stats_rebuild_all():
+    db = db_open(args.dbname)
+    for username in args.usernames:
+        for scrobble_type in args.stypes:
+            print("[Stats] Rebuilding {}_{}".format(username, scrobble_type))
+            db_init(db, username, scrobble_type)
+            db_stats_rebuild(db, username, scrobble_type)
+            db.commit()
+    db.close()
+
+# Full-text search index
+# Artists, tracks and albums of a data table are indexed by an FTS5 table
+# ({table}_fts) with the data table (or view) as its external content and
+# scrobble timestamps as rowids, so matches come with their timestamps and
+# time ranges are cheap rowid ranges. Triggers keep the index in sync with
+# inserts, updates (see db_enrich()) and deletes. The index is optional, it's
+# built by --search-index or the first --search of the table.
+SEARCH_TRIGGERS = ("insert", "update", "delete")
+
+def db_search_exists(db, name):
+    cur = db.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (name + "_fts",))
+
+    return cur.fetchone() is not None
+
+# Create triggers keeping the search index of given data table in sync, or
+# drop them
+def db_search_triggers(db, username, scrobble_type, drop=False):
+    name = "{}_{}".format(username, scrobble_type)
+    for event in SEARCH_TRIGGERS:
+        db.execute("DROP TRIGGER IF EXISTS {}_fts_{}".format(name, event))
+    if drop:
+        return
+
+    if db_is_normalized(db):
+        # The view can't have triggers, the scrobbles of the user and type
+        # are picked from the shared scrobbles table
+        table = "scrobbles"
+        when = "WHEN {{0}}.user_id = {} AND {{0}}.type = {}".format(
+                db_user_id(db, username), SCROBBLE_TYPES[scrobble_type])
+        values = "{0}.timestamp, " \
+            "(SELECT ar.name FROM tracks AS t JOIN artists AS ar " \
+            "ON ar.id = t.artist_id WHERE t.id = {0}.track_id), " \
+            "(SELECT name FROM tracks WHERE id = {0}.track_id), " \
+            "COALESCE((SELECT name FROM albums WHERE id = {0}.album_id), '')"
+    else:
+        table = name
+        when = ""
+        values = "{0}.timestamp, {0}.artist, {0}.track, {0}.album"
+
+    insert = "INSERT INTO {0}_fts(rowid, artist, track, album) " \
+             "VALUES({1});".format(name, values.format("NEW"))
+    delete = "INSERT INTO {0}_fts({0}_fts, rowid, artist, track, album) " \
+             "VALUES('delete', {1});".format(name, values.format("OLD"))
+    for event, stmts, row in (("insert", insert, "NEW"),
+            ("update", delete + insert, "OLD"), ("delete", delete, "OLD")):
+        db.execute("CREATE TRIGGER {0}_fts_{1} AFTER {2} ON {3} {4} "
+                "BEGIN {5} END".format(name, event, event.upper(), table,
+                    when.format(row), stmts))
+
+# Create (or re-create) the search index of given data table and index all
+# its scrobbles
+def db_search_init(db, username, scrobble_type):
+    name = "{}_{}".format(username, scrobble_type)
+    db.execute("DROP TABLE IF EXISTS {}_fts".format(name))
+    try:
+        db.execute("CREATE VIRTUAL TABLE {0}_fts USING fts5("
+                "artist, track, album, content='{0}', "
+                "content_rowid='timestamp', "
+                "tokenize='unicode61 remove_diacritics 2')".format(name))
+    except sqlite3.OperationalError as e:
+        raise Exception("Can't create the search index (SQLite without "
+                "FTS5?): {}".format(e))
+    db_search_triggers(db, username, scrobble_type)
+    db.execute("INSERT INTO {0}_fts({0}_fts) VALUES('rebuild')".format(name))
+
+# Build search indexes of all selected users and scrobble types
+def db_search_index_all():
+    db = db_open(args.dbname)
+    for username in args.usernames:
+        for scrobble_type in args.stypes:
+            print("[Search] Indexing {}_{}".format(username, scrobble_type))
+            db_init(db, username, scrobble_type)
+            db_search_init(db, username, scrobble_type)
+            db.commit()
+    db.close()
+
+# Get (timestamp, artist, track, album) rows of given data table matching
+# a full-text query, newest first
+def db_search_query(db, name, query, time_from=None, time_to=None, limit=100):
+    # Matches are limited first and only then joined with the data, otherwise
+    # SQLite scans the whole view of a normalized database
+    cur = db.cursor()
+    cur.execute("WITH m AS MATERIALIZED (SELECT rowid FROM {0}_fts "
+            "WHERE {0}_fts MATCH ? AND rowid BETWEEN ? AND ? "
+            "ORDER BY rowid DESC LIMIT ?) "
+            "SELECT t.timestamp, t.artist, t.track, t.album "
+            "FROM m CROSS JOIN {0} AS t ON t.timestamp = m.rowid "
+            "ORDER BY m.rowid DESC".format(name),
+            (query, time_from or 0, time_to or (1 << 62), limit))
+
+    return cur.fetchall()
+
+# Print scrobbles of given user matching the --search query, newest first
+# The query uses the FTS5 syntax: words match all fields, "artist: word"
+# (or track, album) only one of them, "word*" is a prefix and quoted words
+# a phrase; AND, OR, NOT and parentheses combine them. --from and --to limit
+# the time range.
+def db_search(username):
+    db = db_open(args.dbname)
+    for scrobble_type in args.stypes:
+        name = "{}_{}".format(username, scrobble_type)
+        cur = db.cursor()
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,))
+        if not cur.fetchone():
+            print("[{}] no {} saved".format(username, scrobble_type))
+            continue
+        if not db_search_exists(db, name):
+            print("[Search] Indexing {} (only once)".format(name))
+            db_search_init(db, username, scrobble_type)
+            db.commit()
+
+        start = time.perf_counter()
+        try:
+            rows = db_search_query(db, name, args.search, args.time_from,
+                    args.time_to, args.search_limit)
+        except sqlite3.OperationalError as e:
+            sys.stderr.write("Invalid search query '{}': {}\n"
+                    .format(args.search, e))
+            sys.exit(1)
+        elapsed = time.perf_counter() - start
+
+        print("[{}] {}: {} matches{} ({:.1f} ms)".format(username,
+                scrobble_type, len(rows),
+                " (limited by --search-limit)"
+                    if len(rows) == args.search_limit else "",
+                elapsed * 1000))
+        for ts, artist, track, album in rows:
+            print("\t{}\t{}\t{}\t{}".format(datetime.fromtimestamp(ts),
+                    artist, track, album))
+    db.close()
+
+# Get a cached autocorrect result for given key (type, artist, name, mbid),
+# where artist is empty for the artist type
+# Returns (name, mbid, error), where error is None for successful lookups,
+# or None if there's no valid cache entry. Entries expire after
+# --autocorrect-ttl days, failed lookups after --autocorrect-negative-ttl days.
+def db_autocorrect_get(db, key):
     cur = db.cursor()
-    cur.execute("INSERT OR IGNORE INTO {}_{} VALUES(?, ?, ?, ?, ?, ?, ?)"
-            .format(username, scrobble.type),
-            (scrobble.ts, scrobble.artist, scrobble.artist_mbid, scrobble.track,
-                scrobble.track_mbid, scrobble.album, scrobble.album_mbid))
+    cur.execute("SELECT corrected_name, corrected_mbid, error, updated "
+            "FROM autocorrect_cache "
+            "WHERE type = ? AND artist = ? AND name = ? AND mbid = ?", key)
+    res = cur.fetchone()
+    if not res:
+        return None
+
+    name, mbid, error, updated = res
+    ttl = args.autocorrect_ttl if error is None else args.autocorrect_negative_ttl
+    if updated + ttl * 86400 < time.time():
+        return None
+
+    return name, mbid, error
+
+# Save an autocorrect result for given key into the cache (see
+# db_autocorrect_get()), the change is committed together with the scrobbles
+def db_autocorrect_save(db, key, name, mbid, error=None):
+    db.execute("INSERT OR REPLACE INTO autocorrect_cache "
+            "VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+            key + (name, mbid, error, int(time.time())))
+
+# Columns of the autocorrected values of each autocorrect type, see db_enrich()
+ENRICH_COLUMNS = collections.OrderedDict((
+    ("artist" , ("artist", "artist_mbid")),
+    ("track"  , ("track", "track_mbid")),
+    ("album"  , ("album", "album_mbid"))
+))
+
+# Autocorrect stored scrobbles of given data tables ((username, scrobble_type)
+# pairs)
+# Distinct artists, then tracks and albums (which are looked up along with
+# their already corrected artist) are collected from the data tables, the
+# ones without a cached result are looked up concurrently (see
+# lastfm_autocorrect_many()), and each correction is applied to all matching
+# rows at once. Corrected values get a cache entry of their own, so the next
+# pass looks up only values it hasn't seen yet.
+def db_enrich(db, tables):
+    start = time.perf_counter()
+    names = ["{}_{}".format(username, scrobble_type)
+             for username, scrobble_type in tables]
+    # Artists which can't be autocorrected, their tracks and albums are
+    # skipped as well (in this run only if the lookup failed, see below)
+    failed = set()
+    changed = set()
+
+    for a_type, (column, mbid_column) in ENRICH_COLUMNS.items():
+        artist = "''" if a_type == "artist" else "artist"
+        where = "WHERE album != '' OR album_mbid != ''" if a_type == "album" \
+                else ""
+        keys = set()
+        for table in names:
+            cur = db.execute("SELECT DISTINCT {}, IFNULL({}, ''), "
+                    "IFNULL({}, '') FROM {} {}".format(artist, column,
+                        mbid_column, table, where))
+            keys.update((a_type,) + tuple(row) for row in cur
+                    if a_type == "artist" or row[0] not in failed)
+
+        corrections = {}
+        def correct(key, name, mbid, error):
+            if error is not None:
+                if a_type == "artist":
+                    failed.add(key[2])
+            elif (name, mbid) != key[2:]:
+                corrections[key[1:]] = (name, mbid)
+
+        lookups = []
+        for key in keys:
+            cached = db_autocorrect_get(db, key)
+            profile.autocorrect(cached is not None)
+            if cached:
+                correct(key, *cached)
+            else:
+                lookups.append(key)
+
+        print("[Enrich] {}: {} {}s, {} to look up".format(", ".join(names),
+                len(keys), a_type, len(lookups)))
+        retry = 0
+        for count, (key, res) in enumerate(
+                lastfm_autocorrect_many(sorted(lookups)), 1):
+            # A failed lookup isn't cached, the next run looks it up again
+            if res is None:
+                retry += 1
+                if a_type == "artist":
+                    failed.add(key[2])
+                continue
+            name, mbid, error = res
+            db_autocorrect_save(db, key, name, mbid, error)
+            if error is None:
+                db_autocorrect_save(db, key[:2] + (name, mbid), name, mbid)
+            correct(key, name, mbid, error)
+            if count % 1000 == 0:
+                db.commit()
+                print("[Enrich] {}s: {}/{} looked up".format(a_type, count,
+                        len(lookups)))
+
+        if corrections:
+            if db_is_normalized(db):
+                changed.update(db_enrich_normalized(db, a_type, corrections))
+            else:
+                for table in names:
+                    if db_enrich_table(db, table, a_type, corrections):
+                        changed.add(table)
+        db.commit()
+        print("[Enrich] {}s: {} corrected".format(a_type, len(corrections)))
+        if retry:
+            print("[Enrich] {}s: {} lookups failed, left for the next run"
+                    .format(a_type, retry))
+
+    # Updates don't fire the statistics triggers, nor do they change what
+    # the analytics cache checks
+    for name in sorted(changed):
+        db_stats_rebuild(db, *name.rsplit("_", 1))
+        db_analytics_clear(db, name)
     db.commit()
+    profile.add("enrich", time.perf_counter() - start)
+
+# Apply autocorrections of given type to a data table of the plain schema
+# Corrections map (artist, name, mbid) to the corrected (name, mbid), where
+# artist is empty for the artist type. Returns the number of changed rows.
+def db_enrich_table(db, table, a_type, corrections):
+    column, mbid_column = ENRICH_COLUMNS[a_type]
+    artist = "''" if a_type == "artist" else "{}.artist".format(table)
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS enrich_map("
+            "artist TEXT NOT NULL,"
+            "name TEXT NOT NULL,"
+            "mbid TEXT NOT NULL,"
+            "new_name TEXT,"
+            "new_mbid TEXT,"
+            "PRIMARY KEY(artist, name, mbid))")
+    db.execute("DELETE FROM enrich_map")
+    db.executemany("INSERT INTO enrich_map VALUES(?, ?, ?, ?, ?)",
+            (key + value for key, value in corrections.items()))
+
+    cur = db.execute("UPDATE {0} SET ({1}, {2}) = (SELECT new_name, new_mbid "
+            "FROM enrich_map AS m WHERE m.artist = {3} "
+            "AND m.name = IFNULL({0}.{1}, '') AND m.mbid = IFNULL({0}.{2}, '')) "
+            "WHERE ({3}, IFNULL({1}, ''), IFNULL({2}, '')) IN "
+            "(SELECT artist, name, mbid FROM enrich_map)"
+            .format(table, column, mbid_column, artist))
 
     return cur.rowcount
 
+# Apply autocorrections of given type (see db_enrich_table()) to the normalized
+# schema
+# Artists, tracks and albums are shared by all users, so scrobbles are moved
+# to the corrected track or album instead of renaming it, which could clash
+# with an already existing one. Returns names of the changed data tables.
+def db_enrich_normalized(db, a_type, corrections):
+    cache = {}
+    moves = []
+    cur = db.cursor()
+    for (artist, name, mbid), (new_name, new_mbid) in corrections.items():
+        if a_type == "artist":
+            cur.execute("SELECT id FROM artists WHERE name = ? AND mbid = ?",
+                    (name, mbid))
+            res = cur.fetchone()
+            if not res:
+                continue
+            artist_id = db_intern(db, cache, "artists", (new_name, new_mbid))
+            # All tracks and albums of the artist move to the corrected one
+            for table in ("tracks", "albums"):
+                cur.execute("SELECT id, name, mbid FROM {} "
+                        "WHERE artist_id = ?".format(table), (res[0],))
+                for old_id, old_name, old_mbid in cur.fetchall():
+                    moves.append((table, old_id, db_intern(db, cache, table,
+                            (artist_id, old_name, old_mbid))))
+        else:
+            table = a_type + "s"
+            cur.execute("SELECT d.id, d.artist_id FROM {} AS d "
+                    "JOIN artists AS ar ON ar.id = d.artist_id "
+                    "WHERE ar.name = ? AND d.name = ? AND d.mbid = ?"
+                    .format(table), (artist, name, mbid))
+            for old_id, artist_id in cur.fetchall():
+                moves.append((table, old_id, db_intern(db, cache, table,
+                        (artist_id, new_name, new_mbid))))
+
+    types = {i : t for t, i in SCROBBLE_TYPES.items()}
+    changed = set()
+    for table, old_id, new_id in moves:
+        if old_id == new_id:
+            continue
+        column = "track_id" if table == "tracks" else "album_id"
+        cur.execute("SELECT DISTINCT u.name, s.type FROM scrobbles AS s "
+                "JOIN users AS u ON u.id = s.user_id "
+                "WHERE s.{} = ?".format(column), (old_id,))
+        changed.update("{}_{}".format(u, types[t]) for u, t in cur.fetchall())
+        cur.execute("UPDATE scrobbles SET {0} = ? WHERE {0} = ?"
+                .format(column), (new_id, old_id))
+
+    return changed
+
+# Autocorrect stored scrobbles of all selected users and scrobble types
+def db_enrich_all():
+    db = db_open(args.dbname)
+    tables = []
+    for username in args.usernames:
+        for scrobble_type in args.stypes:
+            db_init(db, username, scrobble_type)
+            tables.append((username, scrobble_type))
+    db_enrich(db, tables)
+    db.close()
+
+# Open an export file, compressed according to its extension (.gz, .xz)
+def export_open(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "wt", encoding="utf-8", newline="")
+    elif filename.endswith(".xz"):
+        return lzma.open(filename, "wt", encoding="utf-8", newline="")
+    else:
+        return open(filename, "w", encoding="utf-8", newline="")
+
+# Get the user and scrobble type to import given lastexport.py backup as
+# The user and type selected on the command line are used if there's exactly
+# one of each, otherwise they're taken from the file name used by
+# lastfm_backup.sh ({user}_{scrobbles|loved}_{date}), or for segments, from
+# the name of their directory ({user}_{scrobbles|loved}.segments, see
+# lastfm_segments.sh).
+def import_target(filename):
+    if len(args.usernames) == 1 and args.stypes and len(args.stypes) == 1:
+        return args.usernames[0], args.stypes[0]
+
+    m = re.match(r"^([a-zA-Z][a-zA-Z0-9\-_]+)_(scrobbles|loved)_",
+            os.path.basename(filename)) or \
+        re.match(r"^([a-zA-Z][a-zA-Z0-9\-_]+)_(scrobbles|loved)\.segments$",
+            os.path.basename(os.path.dirname(os.path.abspath(filename))))
+    if not m:
+        raise Exception("Can't determine user and scrobble type of {}, "
+                "select exactly one of each".format(filename))
+
+    return m.group(1), "recenttracks" if m.group(2) == "scrobbles" \
+            else "lovedtracks"
+
+# Parse a lastexport.py backup into rows in the data table format
+# (lastexport.py columns: timestamp, track, artist, album, track MBID,
+# artist MBID, album MBID). Rows without a valid timestamp are skipped.
+# Gzipped files (e.g. segments written by lastfm_segments.sh) are recognized
+# by their magic bytes.
+def import_parse(filename):
+    rows = []
+    skipped = 0
+    with open(filename, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    opener = gzip.open if gzipped else open
+    with opener(filename, "rt", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 7:
+                fields += [""] * (7 - len(fields))
+            try:
+                ts = int(fields[0])
+            except ValueError:
+                ts = 0
+            if not ts:
+                skipped += 1
+                continue
+            rows.append((ts, fields[2], fields[5], fields[1], fields[4],
+                fields[3], fields[6]))
+
+    return rows, skipped
+
+# Import lastexport.py backups into the database
+# Files are parsed in parallel by --jobs processes, while a single writer
+# inserts them. Durability is relaxed (synchronous=OFF) and statistics and
+# search triggers are disabled during the load, statistics and search indexes
+# of all imported tables are rebuilt at the end. All of it is done in a single
+# transaction, so an interrupted import leaves the database (and its triggers)
+# as it was, and other writers (e.g. --watch) wait for the import instead of
+# inserting scrobbles while the triggers are missing. The watermark of each
+# table is moved to its newest imported track, so the next backup downloads
+# only newer tracks.
+def db_import():
+    targets = collections.OrderedDict((f, import_target(f))
+            for f in args.import_files)
+    tables = list(collections.OrderedDict.fromkeys(targets.values()))
+
+    db = db_open(args.dbname)
+    db.execute("PRAGMA synchronous=OFF")
+    db.execute("PRAGMA cache_size=-262144")
+    for username, scrobble_type in tables:
+        db_init(db, username, scrobble_type)
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if db_is_normalized(db):
+            db.execute("DROP TRIGGER IF EXISTS scrobbles_stats")
+        else:
+            for username, scrobble_type in tables:
+                db.execute("DROP TRIGGER IF EXISTS {}_{}_stats"
+                        .format(username, scrobble_type))
+        # Search indexes are rebuilt at once as well
+        indexed = [t for t in tables
+                if db_search_exists(db, "{}_{}".format(*t))]
+        for username, scrobble_type in indexed:
+            db_search_triggers(db, username, scrobble_type, drop=True)
+
+        last_ts = collections.defaultdict(int)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) \
+                as pool:
+            futures = {pool.submit(import_parse, f) : f for f in targets}
+            for future in concurrent.futures.as_completed(futures):
+                filename = futures[future]
+                username, scrobble_type = targets[filename]
+                rows, skipped = future.result()
+                stored = db_save_rows(db, rows, username, scrobble_type)
+                if rows:
+                    last_ts[targets[filename]] = max(
+                            last_ts[targets[filename]],
+                            max(row[0] for row in rows))
+                print("[Import] {} ({}_{}): {} tracks, stored: {} tracks, "
+                        "skipped: {} lines".format(filename, username,
+                            scrobble_type, len(rows), stored, skipped))
+
+        for username, scrobble_type in tables:
+            print("[Import] Rebuilding statistics of {}_{}"
+                    .format(username, scrobble_type))
+            db_stats_init(db, username, scrobble_type)
+            db_stats_rebuild(db, username, scrobble_type)
+            db_set_last_ts(db, username, scrobble_type,
+                    last_ts[(username, scrobble_type)])
+            if (username, scrobble_type) in indexed:
+                print("[Import] Rebuilding search index of {}_{}"
+                        .format(username, scrobble_type))
+                db_search_init(db, username, scrobble_type)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        db.execute("PRAGMA synchronous={}".format(args.synchronous))
+        db.close()
+
+# Move the incremental export watermarks of given data table back before
+# given timestamp of newly stored rows, if they're past it already
+# Rows added with older timestamps (by --verify, --import or a backfill with
+# --from/--to) would never be exported otherwise, the next export includes
+# them along with the newer rows, which were exported already.
+def db_export_rewind(db, name, timestamp):
+    cur = db.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'export_state'")
+    if cur.fetchone():
+        cur.execute("UPDATE export_state SET last_ts = ? "
+                "WHERE name = ? AND last_ts >= ?",
+                (timestamp - 1, name, timestamp))
+
 # Export tracks of given scrobble_type from the database
-def db_export(scrobble_type):
-    db = sqlite3.connect(args.dbname)
-    out = open(args.export, "w")
+# Rows are streamed from the database in large batches. With --incremental,
+# only rows newer than the last incremental export of the same tag are
+# exported, and the watermark is moved once the export file is complete
+# (and back by older rows stored later, see db_export_rewind()).
+def db_export(username, scrobble_type):
+    db = sqlite3.connect(args.dbname, timeout=60)
+    name = "{}_{}".format(username, scrobble_type)
+    since = 0
+    if args.incremental:
+        db.execute("CREATE TABLE IF NOT EXISTS export_state("
+                "name TEXT NOT NULL,"
+                "tag TEXT NOT NULL,"
+                "last_ts INTEGER NOT NULL,"
+                "PRIMARY KEY(name, tag))")
+        cur = db.cursor()
+        cur.execute("SELECT last_ts FROM export_state WHERE name = ? AND tag = ?",
+                (name, args.incremental))
+        res = cur.fetchone()
+        if res:
+            since = res[0]
+
     cur = db.cursor()
-    cur.execute("SELECT * FROM {}_{} ORDER BY timestamp DESC"
-            .format(args.username, scrobble_type))
-    for row in cur:
-        out.write(args.separator.join(str(x) for x in row) + "\n")
-    out.close()
+    cur.arraysize = 10000
+    cur.execute("SELECT * FROM {} WHERE timestamp > ? ORDER BY timestamp DESC"
+            .format(name), (since,))
+    columns = [d[0] for d in cur.description]
+    last_ts = since
+    exported = 0
+
+    with export_open(args.export) as out:
+        if args.format == "csv":
+            writer = csv.writer(out, lineterminator="\n")
+            writer.writerow(columns)
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                break
+            # Rows are sorted, the first one of the first batch is the newest
+            last_ts = max(last_ts, rows[0][0])
+            exported += len(rows)
+            if args.format == "csv":
+                writer.writerows(rows)
+            elif args.format == "jsonl":
+                out.writelines(json.dumps(dict(zip(columns, row)),
+                    ensure_ascii=False) + "\n" for row in rows)
+            else:
+                out.writelines(args.separator.join(str(x) for x in row) + "\n"
+                    for row in rows)
+
+    if args.incremental:
+        db.execute("INSERT OR REPLACE INTO export_state VALUES(?, ?, ?)",
+                (name, args.incremental, last_ts))
+        db.commit()
+        printv("[Export] {}: {} tracks since {}".format(name, exported, since))
     db.close()
 
 # Get some overall statistics about saved data
-def db_stats():
-    db = sqlite3.connect(args.dbname)
+# All numbers come from the aggregated statistics (see db_stats_tables()),
+# which are built first if they're missing.
+def db_stats(username):
+    db = sqlite3.connect(args.dbname, timeout=60)
     db.row_factory = sqlite3.Row
 
-    print("[{}]".format(args.username))
+    print("[{}]".format(username))
+
+    for scrobble_type in args.stypes:
+        cur = db.cursor()
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = ?",
+                ("{}_{}".format(username, scrobble_type),))
+        if not cur.fetchone():
+            print("\tno {} saved".format(scrobble_type))
+            continue
+        db_stats_init(db, username, scrobble_type)
+        db.commit()
 
     if "recenttracks" in args.stypes:
+        name = "{}_{}".format(username, "recenttracks")
         cur = db.cursor()
         # Overall statistics
-        cur.execute("SELECT COUNT(*) AS total,"
-                    "COUNT(DISTINCT artist) AS artists,"
-                    "COUNT(DISTINCT artist_mbid) AS artists_mbid,"
-                    "COUNT(DISTINCT track) AS tracks,"
-                    "COUNT(DISTINCT track_mbid) AS tracks_mbid,"
-                    "COUNT(DISTINCT album) AS albums,"
-                    "COUNT(DISTINCT album_mbid) AS albums_mbid "
-                    "FROM {}_{}".format(args.username, "recenttracks"))
-        res = cur.fetchone()
-        print("\tscrobbles: {}\n"
-              "\tartists: {} (MBIDs: {})\n"
-              "\tatracks: {} (MBIDs: {})\n"
-              "\talbums: {} (MBIDs: {})"
-              .format(res["total"], res["artists"], res["artists_mbid"],
-                  res["tracks"], res["tracks_mbid"], res["albums"],
-                  res["albums_mbid"]))
-        # First scrobble
-        cur.execute("SELECT * FROM {}_{} ORDER BY timestamp ASC LIMIT 1"
-                .format(args.username, "recenttracks"))
-        res = cur.fetchone()
-        dt = datetime.fromtimestamp(res["timestamp"])
-        print("\tfirst scrobble:\n"
-              "\t\tdate: {}\n"
-              "\t\tartist: {}\n"
-              "\t\ttrack: {}\n"
-              "\t\talbum: {}"
-              .format(dt, res["artist"], res["track"], res["album"]))
-        # Last scrobble
-        cur.execute("SELECT * FROM {}_{} ORDER BY timestamp DESC LIMIT 1"
-                .format(args.username, "recenttracks"))
+        cur.execute("SELECT * FROM stats_totals WHERE name = ?", (name,))
         res = cur.fetchone()
-        dt = datetime.fromtimestamp(res["timestamp"])
-        print("\tlast scrobble:\n"
-              "\t\tdate: {}\n"
-              "\t\tartist: {}\n"
-              "\t\ttrack: {}\n"
-              "\t\talbum: {}"
-              .format(dt, res["artist"], res["track"], res["album"]))
+        if res:
+            print("\tscrobbles: {}\n"
+                  "\tartists: {} (MBIDs: {})\n"
+                  "\tatracks: {} (MBIDs: {})\n"
+                  "\talbums: {} (MBIDs: {})"
+                  .format(res["scrobbles"], res["artists"], res["artists_mbid"],
+                      res["tracks"], res["tracks_mbid"], res["albums"],
+                      res["albums_mbid"]))
+            first_ts, last_ts = res["first_ts"], res["last_ts"]
+            # First scrobble
+            cur.execute("SELECT * FROM {} WHERE timestamp = ?".format(name),
+                    (first_ts,))
+            res = cur.fetchone()
+            dt = datetime.fromtimestamp(res["timestamp"])
+            print("\tfirst scrobble:\n"
+                  "\t\tdate: {}\n"
+                  "\t\tartist: {}\n"
+                  "\t\ttrack: {}\n"
+                  "\t\talbum: {}"
+                  .format(dt, res["artist"], res["track"], res["album"]))
+            # Last scrobble
+            cur.execute("SELECT * FROM {} WHERE timestamp = ?".format(name),
+                    (last_ts,))
+            res = cur.fetchone()
+            dt = datetime.fromtimestamp(res["timestamp"])
+            print("\tlast scrobble:\n"
+                  "\t\tdate: {}\n"
+                  "\t\tartist: {}\n"
+                  "\t\ttrack: {}\n"
+                  "\t\talbum: {}"
+                  .format(dt, res["artist"], res["track"], res["album"]))
+
+            if args.top:
+                for kind in ("artist", "track", "album"):
+                    print("\ttop {}s:".format(kind))
+                    cur.execute("SELECT value, plays FROM stats_values "
+                            "WHERE name = ? AND kind = ? AND value != '' "
+                            "ORDER BY plays DESC, value LIMIT ?",
+                            (name, kind, args.top))
+                    for i, row in enumerate(cur, 1):
+                        print("\t\t{}. {} ({})".format(i, row["value"],
+                            row["plays"]))
+
+            if args.period:
+                print("\tscrobbles per {}:".format(args.period))
+                cur.execute("SELECT start, plays FROM stats_periods "
+                        "WHERE name = ? AND period = ? ORDER BY start",
+                        (name, args.period))
+                for row in cur:
+                    print("\t\t{}: {}".format(row["start"], row["plays"]))
 
     if "lovedtracks" in args.stypes:
         cur = db.cursor()
-        cur.execute("SELECT COUNT(*) AS total FROM {}_{}"
-                .format(args.username, "lovedtracks"))
+        cur.execute("SELECT scrobbles FROM stats_totals WHERE name = ?",
+                ("{}_{}".format(username, "lovedtracks"),))
         res = cur.fetchone()
-        print("\tloved tracks: {}".format(res["total"]))
+        print("\tloved tracks: {}".format(res["scrobbles"] if res else 0))
+
+    db.close()
+
+# Listening analytics (--analytics)
+# Timestamps and artists of a data table are loaded in bulk into NumPy arrays
+# (artists encoded as indices into a list of their names), and all reports
+# are computed by vectorized operations:
+#  - heatmap: scrobbles per weekday and hour
+#  - streaks: consecutive days with scrobbles
+#  - sessions: scrobbles separated by at most --session-gap minutes
+#  - trends: monthly plays of the top artists of the last --trend-months
+#    months
+# All times are local. The results are cached in the analytics_cache table as
+# aggregates (per day, per artist and month, closed sessions and the last,
+# still open one), which are updated only with scrobbles newer than the cached
+# ones. Scrobbles added to the past (e.g. by --verify) rebuild the cache,
+# --enrich and --drop drop it for the tables they change.
+ANALYTICS_VERSION = 1
+# Lower bounds of the session length histogram buckets (in tracks)
+SESSION_BUCKETS = (1, 2, 6, 11, 21, 51)
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+SHADES = " .:-=+*#%@"
+SPARKS = "▁▂▃▄▅▆▇█"
+
+def analytics_empty():
+    return {
+        "heatmap"         : np.zeros(7 * 24, dtype=np.int64),
+        "days"            : np.zeros(0, dtype=np.int64),
+        "day_plays"       : np.zeros(0, dtype=np.int64),
+        # count, tracks, seconds of closed sessions
+        "session_totals"  : np.zeros(3, dtype=np.int64),
+        # start, end, tracks of the longest closed session and the last one,
+        # which may go on with the next scrobbles
+        "session_longest" : np.zeros(3, dtype=np.int64),
+        "session_open"    : np.zeros(3, dtype=np.int64),
+        "session_hist"    : np.zeros(len(SESSION_BUCKETS), dtype=np.int64),
+        "artists"         : np.zeros(0, dtype=str),
+        # plays per (artist << 16 | month since 1970-01) key
+        "trend_keys"      : np.zeros(0, dtype=np.int64),
+        "trend_plays"     : np.zeros(0, dtype=np.int64)
+    }
+
+# Get local times (seconds since the epoch, as if the local time was UTC) of
+# given UNIX timestamps, the UTC offset (DST) is looked up once per hour
+def analytics_local(ts):
+    hours, inverse = np.unique(ts // 3600, return_inverse=True)
+    offsets = np.fromiter((time.localtime(int(h) * 3600).tm_gmtoff
+            for h in hours), dtype=np.int64, count=len(hours))
+
+    return ts + offsets[inverse]
+
+# Merge the sessions of new scrobbles (sorted timestamps) into the state
+def analytics_sessions(state, ts, gap):
+    breaks = np.flatnonzero(np.diff(ts) > gap) + 1
+    first = np.concatenate(([0], breaks))
+    last = np.concatenate((breaks, [len(ts)])) - 1
+    starts, ends, tracks = ts[first], ts[last], last - first + 1
+
+    start, end, count = state["session_open"]
+    if count and ts[0] - end <= gap:
+        starts[0] = start
+        tracks[0] += count
+    elif count:
+        starts = np.concatenate(([start], starts))
+        ends = np.concatenate(([end], ends))
+        tracks = np.concatenate(([count], tracks))
+
+    # All sessions but the last one are closed
+    closed = slice(0, len(tracks) - 1)
+    if len(tracks) > 1:
+        state["session_totals"] += (len(tracks) - 1, tracks[closed].sum(),
+                (ends[closed] - starts[closed]).sum())
+        longest = np.argmax(tracks[closed])
+        if tracks[longest] > state["session_longest"][2]:
+            state["session_longest"] = np.array((starts[longest],
+                ends[longest], tracks[longest]))
+        state["session_hist"] += np.bincount(np.searchsorted(SESSION_BUCKETS,
+            tracks[closed], side="right") - 1, minlength=len(SESSION_BUCKETS))
+    state["session_open"] = np.array((starts[-1], ends[-1], tracks[-1]))
+
+# Merge new scrobbles (sorted timestamps, indices into artist names) into
+# the state
+def analytics_merge(state, ts, artists, names, gap):
+    state["artists"] = np.array(names, dtype=str)
+    local = analytics_local(ts)
+    days = local // 86400
+    # 1970-01-01 was a Thursday
+    state["heatmap"] += np.bincount((days + 3) % 7 * 24 + local // 3600 % 24,
+            minlength=7 * 24)
+
+    new_days, plays = np.unique(days, return_counts=True)
+    all_days, inverse = np.unique(np.concatenate((state["days"], new_days)),
+            return_inverse=True)
+    state["day_plays"] = np.bincount(inverse, weights=np.concatenate((
+        state["day_plays"], plays))).astype(np.int64)
+    state["days"] = all_days
+
+    analytics_sessions(state, ts, gap)
+
+    months = days.astype("datetime64[D]").astype("datetime64[M]") \
+            .astype(np.int64)
+    keys, inverse = np.unique(np.concatenate((state["trend_keys"],
+        artists << 16 | months)), return_inverse=True)
+    state["trend_plays"] = np.bincount(inverse, weights=np.concatenate((
+        state["trend_plays"], np.ones(len(ts), dtype=np.int64)))) \
+            .astype(np.int64)
+    state["trend_keys"] = keys
+
+# Drop the cached analytics of given data table, if there are any
+def db_analytics_clear(db, name):
+    cur = db.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'analytics_cache'")
+    if cur.fetchone():
+        cur.execute("DELETE FROM analytics_cache WHERE name = ?", (name,))
+
+# Get the analytics state of given data table, updated with scrobbles newer
+# than the cached state (see analytics_cache)
+# Returns the state, the number of scrobbles and the number of new ones.
+def db_analytics_state(db, name):
+    gap = int(args.session_gap * 60)
+    cur = db.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS analytics_cache("
+            "name TEXT PRIMARY KEY,"
+            "last_ts INTEGER NOT NULL,"
+            "scrobbles INTEGER NOT NULL,"
+            "data BLOB NOT NULL)")
+    cur.execute("SELECT last_ts, scrobbles, data FROM analytics_cache "
+            "WHERE name = ?", (name,))
+    res = cur.fetchone()
+    state = None
+    last_ts = -1
+    scrobbles = 0
+    if res:
+        last_ts, scrobbles, data = res
+        with np.load(io.BytesIO(data)) as cached:
+            state = {key : cached[key] for key in cached.files}
+        cur.execute("SELECT COUNT(*) FROM {} WHERE timestamp <= ?"
+                .format(name), (last_ts,))
+        # A different session gap, or scrobbles added before the cached
+        # ones, need a full rebuild
+        if state.pop("version") != ANALYTICS_VERSION or \
+                state.pop("gap") != gap or cur.fetchone()[0] != scrobbles:
+            state = None
+    if state is None:
+        state = analytics_empty()
+        last_ts = -1
+        scrobbles = 0
+
+    # The rows are read into arrays at once, with the artists as integers:
+    # IDs of the normalized schema (read without the view, which joins the
+    # names of every row), or names ranked by NumPy in the plain one. Only
+    # the distinct values are then looked up by name, new names are appended
+    # to the cached ones.
+    if db_is_normalized(db):
+        username, scrobble_type = name.rsplit("_", 1)
+        cur.execute("SELECT s.timestamp, t.artist_id FROM scrobbles AS s "
+                "JOIN tracks AS t ON t.id = s.track_id "
+                "WHERE s.user_id = (SELECT id FROM users WHERE name = ?) "
+                "AND s.type = ? AND s.timestamp > ? ORDER BY s.timestamp",
+                (username, SCROBBLE_TYPES[scrobble_type], last_ts))
+        rows = np.array(cur.fetchall(), dtype=[("ts", np.int64),
+            ("artist", np.int64)])
+        ids, inverse = np.unique(rows["artist"], return_inverse=True)
+        cur.execute("SELECT name FROM artists WHERE id IN "
+                "(SELECT value FROM json_each(?)) ORDER BY id",
+                (json.dumps(ids.tolist()),))
+        values = [row[0] for row in cur]
+    else:
+        cur.execute("SELECT timestamp, artist FROM {} WHERE timestamp > ? "
+                "ORDER BY timestamp".format(name), (last_ts,))
+        rows = np.array(cur.fetchall(), dtype=[("ts", np.int64),
+            ("artist", object)])
+        values, inverse = np.unique(rows["artist"].astype(str),
+                return_inverse=True)
+    if not len(rows):
+        return state, scrobbles, 0
+
+    index = {artist : i for i, artist in enumerate(state["artists"].tolist())}
+    codes = np.array([index.setdefault(value, len(index)) for value in values],
+            dtype=np.int64)
+    analytics_merge(state, rows["ts"], codes[inverse], list(index), gap)
+    scrobbles += len(rows)
 
+    data = io.BytesIO()
+    np.savez_compressed(data, version=ANALYTICS_VERSION, gap=gap, **state)
+    cur.execute("INSERT OR REPLACE INTO analytics_cache VALUES(?, ?, ?, ?)",
+            (name, int(rows["ts"][-1]), scrobbles, data.getvalue()))
+    db.commit()
+
+    return state, scrobbles, len(rows)
+
+def analytics_date(day):
+    return str(np.datetime64(int(day), "D"))
+
+def analytics_time(ts):
+    return datetime.fromtimestamp(int(ts)).strftime("%Y-%m-%d %H:%M")
+
+def analytics_print(state, gap):
+    heatmap = state["heatmap"].reshape(7, 24)
+    peak = np.unravel_index(np.argmax(heatmap), heatmap.shape)
+    print("\tlistening by weekday and hour (peak: {} {:02}:00, {} scrobbles):"
+            .format(WEEKDAYS[peak[0]], peak[1], heatmap[peak]))
+    print("\t\t     " + "".join("{:<6}".format(h) for h in range(0, 24, 3)))
+    levels = np.ceil(heatmap / max(heatmap.max(), 1) * (len(SHADES) - 1))
+    for day, row in zip(WEEKDAYS, levels.astype(int)):
+        print("\t\t{}  {}".format(day, "".join(SHADES[v] + " " for v in row)))
+
+    days = state["days"]
+    breaks = np.flatnonzero(np.diff(days) != 1) + 1
+    first = np.concatenate(([0], breaks))
+    last = np.concatenate((breaks, [len(days)])) - 1
+    lengths = days[last] - days[first] + 1
+    longest = np.argmax(lengths)
+    busiest = np.argmax(state["day_plays"])
+    print("\tstreaks:\n"
+          "\t\tlongest: {} days ({} - {})\n"
+          "\t\tlatest: {} days ({} - {})\n"
+          "\t\tactive days: {} of {}, busiest: {} ({} scrobbles)".format(
+              lengths[longest], analytics_date(days[first[longest]]),
+              analytics_date(days[last[longest]]), lengths[-1],
+              analytics_date(days[first[-1]]), analytics_date(days[-1]),
+              len(days), days[-1] - days[0] + 1,
+              analytics_date(days[busiest]), state["day_plays"][busiest]))
+
+    count, tracks, seconds = state["session_totals"]
+    start, end, open_tracks = state["session_open"]
+    count, tracks, seconds = count + 1, tracks + open_tracks, \
+            seconds + end - start
+    hist = state["session_hist"].copy()
+    hist[np.searchsorted(SESSION_BUCKETS, open_tracks, side="right") - 1] += 1
+    longest = state["session_longest"]
+    if open_tracks > longest[2]:
+        longest = state["session_open"]
+    bounds = SESSION_BUCKETS + (None,)
+    print("\tsessions (gap: {} minutes):\n"
+          "\t\tcount: {}, average: {:.1f} tracks, {:.0f} minutes\n"
+          "\t\tlongest: {} - {}, {} tracks\n"
+          "\t\ttracks per session: {}".format(gap // 60, count,
+              tracks / count, seconds / count / 60, analytics_time(longest[0]),
+              analytics_time(longest[1]), longest[2], ", ".join(
+                  "{}: {}".format(lo if hi == lo + 1 else
+                      "{}+".format(lo) if hi is None else
+                      "{}-{}".format(lo, hi - 1), n)
+                  for lo, hi, n in zip(bounds, bounds[1:], hist))))
+
+    # Trends of the top artists of the last months, as sparklines of monthly
+    # plays and least squares slopes (computed for all artists at once)
+    keys, plays = state["trend_keys"], state["trend_plays"]
+    artists, months = keys >> 16, keys & 0xffff
+    end = months.max()
+    start = end - args.trend_months + 1
+    recent = months >= start
+    totals = np.bincount(artists[recent], weights=plays[recent],
+            minlength=len(state["artists"]))
+    top = np.lexsort((state["artists"], -totals))[:args.top or 10]
+    top = top[totals[top] > 0]
+    rows = np.full(len(state["artists"]), -1)
+    rows[top] = np.arange(len(top))
+    series = np.zeros((len(top), args.trend_months))
+    selected = recent & (rows[artists] >= 0)
+    np.add.at(series, (rows[artists[selected]], months[selected] - start),
+            plays[selected])
+    x = np.arange(args.trend_months) - (args.trend_months - 1) / 2
+    slopes = series @ x / max((x * x).sum(), 1)
+    levels = np.ceil(series / np.maximum(series.max(axis=1, keepdims=True), 1)
+            * (len(SPARKS) - 1)).astype(int)
+    print("\tartist trends ({} - {}, plays per month):".format(
+        np.datetime64(int(start), "M"), np.datetime64(int(end), "M")))
+    for i, artist in enumerate(top):
+        print("\t\t{:2}. {} {:+6.1f}/month  {} ({})".format(i + 1,
+            "".join(SPARKS[v] for v in levels[i]), slopes[i],
+            state["artists"][artist], int(series[i].sum())))
+
+# Print listening analytics of given user
+def db_analytics(username):
+    if np is None:
+        sys.stderr.write("--analytics needs NumPy (pip install numpy)\n")
+        sys.exit(1)
+
+    db = db_open(args.dbname)
+    for scrobble_type in args.stypes:
+        name = "{}_{}".format(username, scrobble_type)
+        cur = db.cursor()
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,))
+        if not cur.fetchone():
+            print("[{}] no {} saved".format(username, scrobble_type))
+            continue
+
+        start = time.perf_counter()
+        state, scrobbles, new = db_analytics_state(db, name)
+        print("[{}] {}: {} scrobbles ({} new since the cached analytics, "
+                "{:.0f} ms)".format(username, scrobble_type, scrobbles, new,
+                    (time.perf_counter() - start) * 1000))
+        if scrobbles:
+            analytics_print(state, int(args.session_gap * 60))
     db.close()
 
+# Read-only query service (--serve)
+# A small HTTP server answering JSON queries about the database (e.g. for
+# a web page), instead of a process and a new database connection per query:
+#  /users                       data tables with scrobble counts
+#  /stats?user=U                totals, first and last scrobble
+#  /recent?user=U               latest scrobbles
+#  /top?user=U&kind=K           top artists (K: artist, track or album)
+#  /periods?user=U&period=P     scrobble counts per day, week or month
+#  /search?user=U&q=QUERY       full-text search (see db_search_query())
+#  /nowplaying?user=U           currently playing track (see lastfm_watch())
+# All queries accept type (recenttracks by default), most of them limit,
+# from and to. Queries are answered by a pool of read-only connections, WAL
+# readers which never block the writer (a backup or --watch running at the
+# same time). Responses are cached in memory until any writer commits.
+SERVE_CACHE_SIZE = 1024
+# Memory-mapped I/O of every pooled connection (in bytes)
+SERVE_MMAP_SIZE = 256 * 1024 * 1024
+
+class QueryError(Exception):
+    def __init__(self, status, message):
+        super(QueryError, self).__init__(message)
+        self.status = status
+
+# Pool of read-only connections and the response cache
+class QueryPool(object):
+    def __init__(self, dbname, size):
+        self.uri = "file:{}?mode=ro".format(urllib.parse.quote(
+            os.path.abspath(dbname)))
+        self.pool = queue.Queue()
+        for i in range(size):
+            self.pool.put(self.connect())
+        # Not used for queries, so its data version changes only with commits
+        # of other connections (and processes)
+        self.watcher = self.connect()
+        self.version = None
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        db = sqlite3.connect(self.uri, uri=True, timeout=60,
+                check_same_thread=False)
+        db.execute("PRAGMA mmap_size={}".format(SERVE_MMAP_SIZE))
+        db.row_factory = sqlite3.Row
+
+        return db
+
+    # Get a JSON response of given query (a function of a connection),
+    # cached under given key, along with a flag if it came from the cache
+    def get(self, key, query):
+        with self.lock:
+            version = self.watcher.execute("PRAGMA data_version").fetchone()[0]
+            if version != self.version:
+                self.cache.clear()
+                self.version = version
+            body = self.cache.get(key)
+            if body is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return body, True
+            self.misses += 1
+
+        db = self.pool.get()
+        try:
+            body = json.dumps(query(db)).encode("utf-8")
+        finally:
+            self.pool.put(db)
+
+        # A commit during the query makes the response newer than the
+        # version, it's dropped with the rest of the cache on the next check
+        with self.lock:
+            if self.version == version:
+                self.cache[key] = body
+                if len(self.cache) > SERVE_CACHE_SIZE:
+                    self.cache.popitem(last=False)
+
+        return body, False
+
+# Get the data table name of a query (user and type), checking it exists
+def db_query_table(db, params):
+    username = params.get("user", "")
+    scrobble_type = params.get("type", "recenttracks")
+    if not re.match(r"^[a-zA-Z][a-zA-Z0-9\-_]+$", username):
+        raise QueryError(400, "invalid or missing user")
+    if scrobble_type not in SCROBBLE_TYPES:
+        raise QueryError(400, "invalid type '{}'".format(scrobble_type))
+
+    name = "{}_{}".format(username, scrobble_type)
+    cur = db.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,))
+    if not cur.fetchone():
+        raise QueryError(404, "no {} saved for {}".format(scrobble_type,
+            username))
+
+    return name
+
+# Get an integer or time parameter of a query, at least minimum and small
+# enough for SQLite (larger timestamps are dates which can't be stored
+# anyway, SQLite would fail to bind them)
+def db_query_int(params, key, default=None, parse=int, minimum=None):
+    if key not in params:
+        return default
+    try:
+        value = parse(params[key])
+    except (ValueError, OverflowError, OSError, argparse.ArgumentTypeError):
+        raise QueryError(400, "invalid {} '{}'".format(key, params[key]))
+    if abs(value) > 1 << 62:
+        raise QueryError(400, "{} out of range".format(key))
+    if minimum is not None and value < minimum:
+        raise QueryError(400, "{} must be at least {}".format(key, minimum))
+
+    return value
+
+def db_query_scrobble(row):
+    return collections.OrderedDict((
+        ("timestamp" , row["timestamp"]),
+        ("date"      , datetime.fromtimestamp(row["timestamp"]).isoformat()),
+        ("artist"    , row["artist"]),
+        ("track"     , row["track"]),
+        ("album"     , row["album"])
+    ))
+
+def db_query_users(db, params):
+    cur = db.cursor()
+    cur.execute("SELECT name, scrobbles, first_ts, last_ts FROM stats_totals "
+            "ORDER BY name")
+
+    return [collections.OrderedDict((
+        ("user"      , row["name"].rsplit("_", 1)[0]),
+        ("type"      , row["name"].rsplit("_", 1)[1]),
+        ("scrobbles" , row["scrobbles"]),
+        ("first_ts"  , row["first_ts"]),
+        ("last_ts"   , row["last_ts"]))) for row in cur]
+
+def db_query_stats(db, params):
+    name = db_query_table(db, params)
+    cur = db.cursor()
+    cur.execute("SELECT * FROM stats_totals WHERE name = ?", (name,))
+    totals = cur.fetchone()
+    res = collections.OrderedDict((("scrobbles", 0),))
+    if not totals:
+        return res
+
+    res["scrobbles"] = totals["scrobbles"]
+    for column in STATS_COLUMNS.values():
+        res[column] = totals[column]
+    for key in ("first", "last"):
+        cur.execute("SELECT timestamp, artist, track, album FROM {} "
+                "WHERE timestamp = ?".format(name), (totals[key + "_ts"],))
+        row = cur.fetchone()
+        res[key] = db_query_scrobble(row) if row else None
+
+    return res
+
+def db_query_recent(db, params):
+    name = db_query_table(db, params)
+    cur = db.cursor()
+    cur.execute("SELECT timestamp, artist, track, album FROM {} "
+            "WHERE timestamp BETWEEN ? AND ? ORDER BY timestamp DESC LIMIT ?"
+            .format(name), (db_query_int(params, "from", 0, parse_time),
+                db_query_int(params, "to", 1 << 62, parse_time),
+                db_query_int(params, "limit", 50, minimum=1)))
+
+    return [db_query_scrobble(row) for row in cur]
+
+def db_query_top(db, params):
+    name = db_query_table(db, params)
+    kind = params.get("kind", "artist")
+    if kind not in STATS_COLUMNS:
+        raise QueryError(400, "invalid kind '{}'".format(kind))
+    cur = db.cursor()
+    cur.execute("SELECT value, plays FROM stats_values "
+            "WHERE name = ? AND kind = ? AND value != '' "
+            "ORDER BY plays DESC, value LIMIT ?",
+            (name, kind, db_query_int(params, "limit", 10, minimum=1)))
+
+    return [collections.OrderedDict((("value", row["value"]),
+        ("plays", row["plays"]))) for row in cur]
+
+def db_query_periods(db, params):
+    name = db_query_table(db, params)
+    period = params.get("period", "month")
+    if period not in STATS_PERIODS:
+        raise QueryError(400, "invalid period '{}'".format(period))
+    cur = db.cursor()
+    cur.execute("SELECT start, plays FROM stats_periods "
+            "WHERE name = ? AND period = ? ORDER BY start", (name, period))
+
+    return collections.OrderedDict((row["start"], row["plays"]) for row in cur)
+
+def db_query_search(db, params):
+    name = db_query_table(db, params)
+    if not params.get("q"):
+        raise QueryError(400, "missing query (q)")
+    if not db_search_exists(db, name):
+        raise QueryError(404, "{} has no search index (see --search-index)"
+                .format(name))
+    try:
+        rows = db_search_query(db, name, params["q"],
+                db_query_int(params, "from", None, parse_time),
+                db_query_int(params, "to", None, parse_time),
+                db_query_int(params, "limit", 100, minimum=1))
+    except sqlite3.OperationalError as e:
+        raise QueryError(400, "invalid query: {}".format(e))
+
+    return [db_query_scrobble(row) for row in rows]
+
+def db_query_nowplaying(db, params):
+    username = params.get("user", "")
+    cur = db.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'now_playing'")
+    if not cur.fetchone():
+        return None
+    cur.execute("SELECT artist, track, album, since, updated FROM now_playing "
+            "WHERE username = ?", (username,))
+    row = cur.fetchone()
+
+    return collections.OrderedDict(zip(row.keys(), row)) if row else None
+
+QUERIES = {
+    "/users"      : db_query_users,
+    "/stats"      : db_query_stats,
+    "/recent"     : db_query_recent,
+    "/top"        : db_query_top,
+    "/periods"    : db_query_periods,
+    "/search"     : db_query_search,
+    "/nowplaying" : db_query_nowplaying
+}
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send headers and body at once, a separate small write would wait for
+    # the delayed ACK of the client on keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *log_args):
+        printv("[Serve] {} {}".format(self.address_string(), fmt % log_args))
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        query = QUERIES.get(url.path.rstrip("/") or "/")
+        status = 200
+        cached = False
+        try:
+            if query is None:
+                raise QueryError(404, "unknown query {}, use one of {}"
+                        .format(url.path, ", ".join(sorted(QUERIES))))
+            body, cached = self.server.pool.get((url.path, url.query),
+                    lambda db: query(db, params))
+        except QueryError as e:
+            status = e.status
+            body = json.dumps({"error" : str(e)}).encode("utf-8")
+        except sqlite3.Error as e:
+            status = 500
+            body = json.dumps({"error" : str(e)}).encode("utf-8")
+        except Exception as e:
+            # Any other failure still gets a response, the connection isn't
+            # just dropped
+            sys.stderr.write("[Serve] {} failed: {!r}\n".format(self.path, e))
+            status = 500
+            body = json.dumps({"error" : "internal error"}).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Cache", "hit" if cached else "miss")
+        self.end_headers()
+        self.wfile.write(body)
+
+# Run the query service on --serve [HOST:]PORT until interrupted
+def db_serve():
+    host, _, port = args.serve.rpartition(":")
+    if not port.isdigit():
+        sys.stderr.write("Invalid port '{}'\n".format(port))
+        sys.exit(1)
+    if not os.path.exists(args.dbname):
+        sys.stderr.write("Database {} doesn't exist\n".format(args.dbname))
+        sys.exit(1)
+
+    server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)),
+            QueryHandler)
+    server.daemon_threads = True
+    server.pool = QueryPool(args.dbname, args.serve_pool)
+    print("[Serve] Serving {} on http://{}:{}/".format(args.dbname,
+        *server.server_address[:2]), flush=True)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("[Serve] Stopped, cache hits: {}, misses: {}".format(
+            server.pool.hits, server.pool.misses))
+
+# Parse a UNIX timestamp or an ISO date (time) given on the command line
+def parse_time(string):
+    try:
+        return int(string)
+    except ValueError:
+        pass
+
+    try:
+        return int(datetime.fromisoformat(string).timestamp())
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid time '{}'".format(string))
+
 def _tests():
     scrobble = Scrobble(
         artist="c lekktor",
@@ -398,7 +3002,18 @@ def _tests():
     )
 
     print("Before autocorrect:\n{}\n".format(scrobble))
-    lastfm_autocorrect(scrobble)
+    # The same lookups as by --enrich (see db_enrich()), tracks and albums
+    # along with their corrected artist
+    key = ("artist", "", scrobble.artist, scrobble.artist_mbid)
+    for _, res in lastfm_autocorrect_many([key]):
+        if res and res[2] is None:
+            scrobble.artist, scrobble.artist_mbid = res[:2]
+    keys = [("track", scrobble.artist, scrobble.track, scrobble.track_mbid),
+            ("album", scrobble.artist, scrobble.album, scrobble.album_mbid)]
+    for key, res in lastfm_autocorrect_many(keys):
+        if res and res[2] is None:
+            setattr(scrobble, key[0], res[0])
+            setattr(scrobble, key[0] + "_mbid", res[1])
     print("After autocorrect:\n{}".format(scrobble))
 
     if not scrobble.artist_mbid or not scrobble.track_mbid \
@@ -407,15 +3022,23 @@ def _tests():
         return 1
 
 if __name__ == "__main__":
-    if not API_KEY:
-        print("Missing API key")
-        sys.exit(1)
-
     parser = argparse.ArgumentParser()
     parser.add_argument("--autocorrect", action="store_true",
-            help="autocorrects scrobble data using Last.FM database "
-                 "(warning: this is really slow as it requires another "
-                 "three API calls)")
+            help="autocorrects scrobble data using Last.FM database after "
+                 "the backup (see --enrich)")
+    parser.add_argument("--enrich", action="store_true",
+            help="autocorrect already stored scrobbles: distinct artists, "
+                 "tracks and albums not corrected yet are looked up by "
+                 "--jobs concurrent requests (results are cached in the "
+                 "database) and corrected in all rows at once")
+    parser.add_argument("--autocorrect-ttl", type=float, default=30,
+            metavar="DAYS",
+            help="re-check cached autocorrect results after DAYS days "
+                 "(default: 30)")
+    parser.add_argument("--autocorrect-negative-ttl", type=float, default=1,
+            metavar="DAYS",
+            help="retry failed autocorrect lookups after DAYS days "
+                 "(default: 1)")
     parser.add_argument("-d", "--db", dest="dbname", default="lastfm-backup.db3",
             help="SQLite database name")
     parser.add_argument("--drop", action="store_true",
@@ -423,10 +3046,51 @@ if __name__ == "__main__":
     parser.add_argument("--force", action="store_true",
             help="re-download all tracks (don't check for the last stored "
                  "timestamp)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+            help="download N pages concurrently (default: 1)")
+    parser.add_argument("--pool-size", type=int, default=None, metavar="N",
+            help="keep up to N connections to the API server open "
+                 "(default: --jobs times the number of users backed up at "
+                 "once, see --parallel-users)")
+    parser.add_argument("--rate", type=float, default=4, metavar="N",
+            help="make at most N requests per second, shared by all jobs "
+                 "(default: 4, 0 means no limit)")
+    parser.add_argument("--batch-size", type=int, default=200, metavar="N",
+            help="commit stored tracks in batches of (at least) N tracks, "
+                 "i.e. whole pages (default: 200); users backed up in "
+                 "parallel commit every page, so they don't lock each "
+                 "other out while downloading")
+    parser.add_argument("--synchronous", default="NORMAL", type=str.upper,
+            choices=("OFF", "NORMAL", "FULL", "EXTRA"),
+            help="SQLite synchronous level, lower is faster but a crash "
+                 "may lose the last committed batch (default: NORMAL)")
+    parser.add_argument("--from", dest="time_from", type=parse_time,
+            default=None, metavar="TIME",
+            help="back up only scrobbles since TIME (UNIX timestamp or "
+                 "ISO date, scrobbles only)")
+    parser.add_argument("--to", dest="time_to", type=parse_time,
+            default=None, metavar="TIME",
+            help="back up only scrobbles until TIME (UNIX timestamp or "
+                 "ISO date, scrobbles only); a TIME before the last backup "
+                 "backfills the range")
+    parser.add_argument("--window", type=float, default=None, metavar="DAYS",
+            help="split the backup into independent time windows of DAYS "
+                 "days (scrobbles only)")
     parser.add_argument("--tests", action="store_true",
             help="perform some sanity/unit tests")
-    parser.add_argument("-u", "--user", dest="username", default=None,
-            help="Last.FM user name", required=True)
+    parser.add_argument("--api-url", default=BASEURL, metavar="URL",
+            help="Last.FM API root URL, e.g. of a local replay server "
+                 "(default: {})".format(BASEURL))
+    parser.add_argument("--api-key", default=None, metavar="KEY",
+            help="Last.FM API key (default: API_KEY from this script)")
+    parser.add_argument("-u", "--user", dest="usernames", default=[],
+            action="append",
+            help="Last.FM user name (can be used multiple times)")
+    parser.add_argument("-U", "--users-file", default=None, metavar="FILE",
+            help="read Last.FM user names from FILE (one per line)")
+    parser.add_argument("-P", "--parallel-users", type=int, default=4,
+            metavar="N",
+            help="back up N users concurrently (default: 4)")
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true",
             help="increase verbosity")
 
@@ -444,31 +3108,231 @@ if __name__ == "__main__":
             help="export selected database into a tab-separated text file")
     export_opts.add_argument("--separator", default="\t",
             help="override default column separator (TAB)")
+    export_opts.add_argument("--format", default="plain",
+            choices=("plain", "csv", "jsonl"),
+            help="export format: separated columns, quoted CSV with a header "
+                 "or JSON Lines (default: plain); the file is compressed if "
+                 "its name ends with .gz or .xz")
+    export_opts.add_argument("--incremental", nargs="?", const="default",
+            default=None, metavar="TAG",
+            help="export only tracks newer than the last incremental export "
+                 "with the same TAG (default tag: default); tracks stored "
+                 "later with older timestamps are exported too, along with "
+                 "the tracks after them")
+
+    import_opts = parser.add_argument_group("Import")
+    import_opts.add_argument("--import", dest="import_files", nargs="+",
+            default=None, metavar="FILE",
+            help="import lastexport.py backups, plain or gzipped (e.g. "
+                 "segments of lastfm_segments.sh); user and type are taken "
+                 "from the command line, or from file names made by "
+                 "lastfm_backup.sh; files are parsed by --jobs processes")
+
+    db_opts = parser.add_argument_group("Database")
+    db_opts.add_argument("--normalized", action="store_true",
+            help="create new databases with the normalized schema (artists, "
+                 "tracks and albums stored only once, shared by all users)")
+    db_opts.add_argument("--migrate", action="store_true",
+            help="convert all per-user tables of the database into the "
+                 "normalized schema")
+
+    profile_opts = parser.add_argument_group("Profiling")
+    profile_opts.add_argument("--profile", default=None, metavar="FILE",
+            help="write a JSON summary of the run (of any mode) into FILE "
+                 "(- for stdout): time spent downloading, decoding, "
+                 "autocorrecting and saving pages, request latencies, "
+                 "retries and sleeps")
+    profile_opts.add_argument("--cprofile", default=None, metavar="FILE",
+            help="dump cProfile statistics of the run into FILE (only the "
+                 "main thread is profiled, use -j 1 -P 1 to include "
+                 "downloads)")
 
     stats_opts = parser.add_argument_group("Statistics")
     stats_opts.add_argument("--stats", action="store_true",
             help="print statistics for given username/scrobble type combination")
+    stats_opts.add_argument("--top", type=int, default=0, metavar="N",
+            help="print top N artists, tracks and albums along with --stats")
+    stats_opts.add_argument("--period", choices=list(STATS_PERIODS),
+            default=None,
+            help="print scrobble counts per period along with --stats")
+    stats_opts.add_argument("--rebuild-stats", action="store_true",
+            help="recompute statistics of given username/scrobble type "
+                 "combination from scratch")
+
+    verify_opts = parser.add_argument_group("Verify")
+    verify_opts.add_argument("--verify", action="store_true",
+            help="compare stored scrobbles with Last.FM in time windows "
+                 "(--window days, default: 365, limited by --from and --to) "
+                 "and download again only the missing ones")
+
+    watch_opts = parser.add_argument_group("Watch")
+    watch_opts.add_argument("--watch", action="store_true",
+            help="back up given users and keep polling them for new "
+                 "scrobbles and currently playing tracks until interrupted")
+    watch_opts.add_argument("--watch-interval", type=float, default=30,
+            metavar="SECONDS",
+            help="poll active users every SECONDS seconds (default: 30)")
+    watch_opts.add_argument("--watch-max", type=float, default=900,
+            metavar="SECONDS",
+            help="poll idle users less and less often, up to every SECONDS "
+                 "seconds (default: 900)")
+
+    analytics_opts = parser.add_argument_group("Analytics")
+    analytics_opts.add_argument("--analytics", action="store_true",
+            help="print listening analytics of given users (heatmap, "
+                 "streaks, sessions and trends of --top artists), needs "
+                 "NumPy; results are cached and updated incrementally")
+    analytics_opts.add_argument("--session-gap", type=float, default=30,
+            metavar="MINUTES",
+            help="start a new listening session after a pause longer than "
+                 "MINUTES minutes (default: 30)")
+    analytics_opts.add_argument("--trend-months", type=int, default=12,
+            metavar="N",
+            help="show artist trends of the last N months (default: 12)")
+
+    serve_opts = parser.add_argument_group("Query service")
+    serve_opts.add_argument("--serve", default=None, metavar="[HOST:]PORT",
+            help="answer JSON queries about the database over HTTP (users, "
+                 "stats, recent, top, periods, search, nowplaying) until "
+                 "interrupted, HOST is 127.0.0.1 by default")
+    serve_opts.add_argument("--serve-pool", type=int, default=4, metavar="N",
+            help="answer up to N queries at once, each with its own "
+                 "read-only database connection (default: 4)")
+
+    search_opts = parser.add_argument_group("Search")
+    search_opts.add_argument("--search", default=None, metavar="QUERY",
+            help="print scrobbles matching a full-text QUERY, newest first: "
+                 "words match artist, track or album, 'artist: word' only "
+                 "the artist, 'word*' is a prefix, \"a phrase\" in quotes; "
+                 "use --from and --to for a time range")
+    search_opts.add_argument("--search-limit", type=int, default=100,
+            metavar="N",
+            help="print at most N matches (default: 100)")
+    search_opts.add_argument("--search-index", action="store_true",
+            help="build (or rebuild) the search index of given "
+                 "username/scrobble type combination, --search builds it "
+                 "on its first use")
 
     args = parser.parse_args()
 
-    if not re.match("^[a-zA-Z][a-zA-Z0-9\-_]+$", args.username):
-        sys.stderr.write("Invalid username (only letters, numbers, - and _,"
-                " must begin with a letter)\n")
+    BASEURL = args.api_url
+    if args.api_key:
+        API_KEY = args.api_key
+    if not API_KEY:
+        print("Missing API key")
+        sys.exit(1)
+
+    if args.migrate:
+        with profiled():
+            db_migrate()
+        sys.exit(0)
+
+    if args.users_file:
+        with open(args.users_file) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    args.usernames.append(line)
+
+    if args.serve:
+        if args.serve_pool < 1:
+            sys.stderr.write("Query service pool size must be at least 1\n")
+            sys.exit(1)
+        with profiled():
+            db_serve()
+        sys.exit(0)
+
+    if not args.usernames and not args.import_files:
+        sys.stderr.write("At least one user name must be given\n")
+        sys.exit(1)
+
+    for username in args.usernames:
+        if not re.match(r"^[a-zA-Z][a-zA-Z0-9\-_]+$", username):
+            sys.stderr.write("Invalid username '{}' (only letters, numbers, "
+                    "- and _, must begin with a letter)\n".format(username))
+            sys.exit(1)
+    # Drop duplicates, keep the order
+    args.usernames = list(collections.OrderedDict.fromkeys(args.usernames))
+
+    if args.parallel_users < 1:
+        sys.stderr.write("Number of parallel users must be at least 1\n")
         sys.exit(1)
 
-    if not args.stypes:
+    if not args.stypes and not args.import_files:
         sys.stderr.write("At least one scrobble type must be selected\n")
         sys.exit(1)
 
-    if args.export:
+    if args.jobs < 1:
+        sys.stderr.write("Number of jobs must be at least 1\n")
+        sys.exit(1)
+
+    if args.watch and (args.time_to is not None or args.window):
+        sys.stderr.write("--to and --window can't be used with --watch\n")
+        sys.exit(1)
+
+    if args.watch_interval <= 0 or args.watch_max < args.watch_interval:
+        sys.stderr.write("Watch interval must be positive and not longer "
+                "than --watch-max\n")
+        sys.exit(1)
+
+    if args.session_gap <= 0 or args.trend_months < 2:
+        sys.stderr.write("Session gap must be positive and trends need at "
+                "least 2 months\n")
+        sys.exit(1)
+
+    if args.search_limit < 1:
+        sys.stderr.write("Search limit must be at least 1\n")
+        sys.exit(1)
+
+    if args.window is not None and args.window <= 0:
+        sys.stderr.write("Window length must be positive\n")
+        sys.exit(1)
+
+    if args.rate < 0:
+        sys.stderr.write("Request rate can't be negative\n")
+        sys.exit(1)
+
+    if args.pool_size is not None and args.pool_size < 1:
+        sys.stderr.write("Pool size must be at least 1\n")
+        sys.exit(1)
+
+    if args.export and not args.import_files:
         if len(args.stypes) > 1:
-            sys.stderr.write("Only one scrobble type can be selected"
+            sys.stderr.write("Only one scrobble type can be selected "
                              "for export\n")
             sys.exit(1)
-        db_export(args.stypes[0])
-    elif args.stats:
-        db_stats()
-    elif args.tests:
-        _tests()
-    else:
-        lastfm_process()
+        if len(args.usernames) > 1:
+            sys.stderr.write("Only one user can be selected for export\n")
+            sys.exit(1)
+
+    ok = True
+    with profiled():
+        if args.import_files:
+            db_import()
+        elif args.export:
+            db_export(args.usernames[0], args.stypes[0])
+        elif args.rebuild_stats:
+            db_stats_rebuild_all()
+        elif args.enrich:
+            db_enrich_all()
+        elif args.stats:
+            for username in args.usernames:
+                db_stats(username)
+        elif args.analytics:
+            for username in args.usernames:
+                db_analytics(username)
+        elif args.search_index:
+            db_search_index_all()
+        elif args.search is not None:
+            for username in args.usernames:
+                db_search(username)
+        elif args.tests:
+            _tests()
+        elif args.watch:
+            lastfm_watch()
+        elif args.verify:
+            ok = lastfm_verify()
+        else:
+            ok = lastfm_process()
+    if not ok:
+        sys.exit(1)
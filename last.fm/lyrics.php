@@ -12,6 +12,37 @@ function curl_get($url) {
     return $data;
 }
 
+// Database of lastfm-backup.py --watch, which polls the now playing tracks
+// anyway; leave empty to ask the Last.FM API directly
+$lastfm_db = "";
+// Now playing tracks not refreshed for this long are left by a stopped watch
+$lastfm_db_max_age = 600;
+
+function db_get_nowplaying($user) {
+    global $lastfm_db, $lastfm_db_max_age;
+    try {
+        $db = new SQLite3($lastfm_db, SQLITE3_OPEN_READONLY);
+        $db->enableExceptions(true);
+        $db->busyTimeout(5000);
+        $stmt = $db->prepare("SELECT artist, track FROM now_playing "
+                           . "WHERE username = :user AND updated >= :since");
+        $stmt->bindValue(":user", $user, SQLITE3_TEXT);
+        $stmt->bindValue(":since", time() - $lastfm_db_max_age, SQLITE3_INTEGER);
+        $current = $stmt->execute()->fetchArray(SQLITE3_NUM);
+        $db->close();
+    } catch (\Exception $e) {
+        echo "Exception: " . $e . "\n";
+        return false;
+    }
+
+    if($current === false) {
+        echo "No current track for user $user\n";
+        return false;
+    }
+
+    return $current;
+}
+
 function lastfm_get_nowplaying($user) {
     $lastfm_key = "ENTER_VALID_LASTFM_KEY";
     $api_url = "https://ws.audioscrobbler.com/2.0/?method=user.getrecenttracks"
@@ -64,7 +95,11 @@ if(empty($username)) {
     die;
 }
 
-$track = lastfm_get_nowplaying($username);
+if(!empty($lastfm_db)) {
+    $track = db_get_nowplaying($username);
+} else {
+    $track = lastfm_get_nowplaying($username);
+}
 if($track === false) {
     die;
 }